@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+准入控制模块
+上游变慢时请求会在 gunicorn 的积压队列里排队直到超时，最后所有人都收不到回答。
+收到消息后先估算回答还需要多久：消息已经排队的时间（钉钉消息的 createAt）加上
+按当前正在生成的请求数和最近的生成耗时估算的等待时间，超过 ADMISSION_MAX_WAIT
+或正在生成的请求数达到 ADMISSION_MAX_IN_FLIGHT 时，直接回复一条本地的繁忙提示，不调用 Gemini；
+sessionWebhook 已经过期的消息无法回复，直接丢弃
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, NamedTuple, Optional
+
+from config import Config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SHED_EXPIRED = "expired"
+SHED_QUEUE_FULL = "queue_full"
+SHED_SLOW = "slow"
+
+# 生成耗时的指数加权平均系数
+_LATENCY_ALPHA = 0.2
+
+
+class Decision(NamedTuple):
+    """准入结果"""
+    admitted: bool
+    reason: str  # 拒绝原因，接受时为空字符串
+    estimated_wait: float  # 预计多少秒后能回答
+
+
+def message_age(data: Dict[str, Any], now: Optional[float] = None) -> float:
+    """
+    消息从钉钉发出到现在经过的时间（秒），消息中没有 createAt 时为 0
+
+    Args:
+        data: webhook 消息
+        now: 当前时间戳（秒）
+    """
+    create_at = data.get('createAt')
+    if not create_at:
+        return 0.0
+    # 两边时钟可能有少量偏差，负数按 0 处理
+    return max(0.0, (now or time.time()) - int(create_at) / 1000.0)
+
+
+def session_webhook_expired(data: Dict[str, Any], now: Optional[float] = None) -> bool:
+    """
+    消息的 sessionWebhook 是否已经过期
+
+    Args:
+        data: webhook 消息
+        now: 当前时间戳（秒）
+    """
+    expired_time = data.get('sessionWebhookExpiredTime')
+    return bool(expired_time) and (now or time.time()) >= int(expired_time) / 1000.0
+
+
+class AdmissionController:
+    """按排队时间和预计等待时间决定是否处理消息"""
+
+    def __init__(
+        self,
+        max_wait: Optional[float] = None,
+        max_in_flight: Optional[int] = None,
+        concurrency: Optional[int] = None
+    ):
+        """
+        Args:
+            max_wait: 预计等待时间上限（秒），默认读取 ADMISSION_MAX_WAIT
+            max_in_flight: 进程内同时生成的请求数上限，默认读取 ADMISSION_MAX_IN_FLIGHT
+            concurrency: 上游能并行处理的请求数，用于估算排队等待，默认读取 ADMISSION_CONCURRENCY
+        """
+        self.max_wait = max_wait or Config.ADMISSION_MAX_WAIT
+        self.max_in_flight = max_in_flight or Config.ADMISSION_MAX_IN_FLIGHT
+        self.concurrency = concurrency or Config.ADMISSION_CONCURRENCY
+        self.in_flight = 0
+        self.latency = 0.0  # 最近生成耗时的加权平均（秒）
+        self._lock = threading.Lock()
+
+    def estimated_wait(self, queue_delay: float = 0.0, queued: int = 0) -> float:
+        """
+        估算一条新消息多久之后能得到回答
+
+        Args:
+            queue_delay: 消息已经排队的时间（秒）
+            queued: 在生成调度器中排队、尚未开始生成的请求数
+
+        Returns:
+            float: 预计时间（秒）
+        """
+        # 前面每排满一轮并发，就要多等一次生成耗时
+        rounds = 1 + (self.in_flight + queued) // self.concurrency
+        return queue_delay + self.latency * rounds
+
+    def expired(self, data: Dict[str, Any]) -> bool:
+        """
+        消息的 sessionWebhook 是否已经过期（无法回复，应直接丢弃）；过期时记录 shed 指标
+
+        Args:
+            data: webhook 消息
+        """
+        if not session_webhook_expired(data):
+            return False
+        self.shed(Decision(False, SHED_EXPIRED, 0.0))
+        return True
+
+    def check(self, data: Dict[str, Any], queued: int = 0) -> Decision:
+        """
+        调用 Gemini 之前判断负载是否允许处理这条消息；不记录 shed 指标，
+        消息之后仍可能由常见问题等直接回答，实际回复繁忙提示时再调用 shed()
+
+        Args:
+            data: webhook 消息
+            queued: 在生成调度器中排队、尚未开始生成的请求数
+
+        Returns:
+            Decision: 准入结果
+        """
+        queue_delay = message_age(data)
+        metrics.observe("admission_queue_delay_seconds", queue_delay)
+        estimated_wait = self.estimated_wait(queue_delay, queued)
+        if self.in_flight + queued >= self.max_in_flight:
+            return Decision(False, SHED_QUEUE_FULL, estimated_wait)
+        if estimated_wait > self.max_wait:
+            return Decision(False, SHED_SLOW, estimated_wait)
+        return Decision(True, "", estimated_wait)
+
+    def shed(self, decision: Decision) -> None:
+        """
+        记录一次拒绝处理（shed 指标和日志），在实际丢弃消息或回复繁忙提示时调用
+
+        Args:
+            decision: check() 返回的拒绝结果
+        """
+        metrics.inc("shed", reason=decision.reason)
+        logger.warning(
+            "拒绝处理消息（%s），正在生成 %d 个，预计等待 %.1f 秒",
+            decision.reason, self.in_flight, decision.estimated_wait
+        )
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """记录一次生成：计入正在生成的请求数，结束后更新生成耗时"""
+        with self._lock:
+            self.in_flight += 1
+        metrics.observe("admission_in_flight", self.in_flight)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start_time
+            with self._lock:
+                self.in_flight -= 1
+                self.latency = elapsed if not self.latency else (
+                    _LATENCY_ALPHA * elapsed + (1 - _LATENCY_ALPHA) * self.latency
+                )
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前状态，供 /metrics 使用"""
+        return {
+            "in_flight": self.in_flight,
+            "latency": round(self.latency, 3),
+            "estimated_wait": round(self.estimated_wait(), 3),
+        }
+
+
+# 进程级全局实例
+_controller: Optional[AdmissionController] = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> Optional[AdmissionController]:
+    """获取全局准入控制器，未启用 ADMISSION_ENABLED 时返回 None"""
+    global _controller
+
+    if not Config.ADMISSION_ENABLED:
+        return None
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController()
+    return _controller
@@ -6,28 +6,35 @@
 """
 
 import os
-import json
 import hmac
 import hashlib
 import base64
 import logging
 import time
+import threading
 from datetime import datetime
 from typing import Dict, Any, Optional
 
-import requests
 from flask import Flask, request, jsonify
-from google.cloud import aiplatform
-from vertexai.generative_models import GenerativeModel
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from deadline import register_request_deadline, send_timeout
+from http_pool import get_session
+from json_codec import dumps, loads, register_json_provider
+from log_pipeline import setup_logging, log_payload, clip
+from startup_profile import lazy_import, profile_phase, log_startup_report
+from token_estimator import prepare_generation, get_token_estimator, classify_question
+from thinking_budget import get_thinking_controller, output_token_limit
+from warmup import register_warmup_step
+
+# 配置日志（异步队列写出）
+setup_logging(logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# 每个请求从收到时开始计算截止时间
+register_request_deadline(app)
+# webhook 解析和 jsonify 使用更快的 JSON 实现
+register_json_provider(app)
 
 # 配置参数
 class Config:
@@ -40,6 +47,9 @@ class Config:
     GCP_LOCATION = os.getenv('GCP_LOCATION', 'us-central1')
     MODEL_NAME = 'gemini-2.5-flash'
     
+    # 初始化失败后多少秒内不再重试（秒）
+    AI_INIT_RETRY_INTERVAL = float(os.getenv('AI_INIT_RETRY_INTERVAL', 30))
+    
     # 应用配置
     PORT = int(os.getenv('PORT', 5000))
     DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
@@ -48,26 +58,57 @@ config = Config()
 
 # 全局变量存储模型实例
 model = None
+# 延迟初始化锁和最近一次初始化失败的时间
+_model_lock = threading.Lock()
+_init_failed_at: Optional[float] = None
 
 # 初始化 Vertex AI
 def init_vertex_ai():
     """初始化 Vertex AI 客户端"""
     global model
     try:
-        # 初始化 Vertex AI
-        aiplatform.init(
-            project=config.GCP_PROJECT_ID, 
-            location=config.GCP_LOCATION
-        )
+        # SDK 导入较重，延迟到初始化时加载
+        with profile_phase('app.load_sdk'):
+            aiplatform = lazy_import('google.cloud.aiplatform')
+            generative_models = lazy_import('vertexai.generative_models')
         
-        # 创建生成模型实例
-        model = GenerativeModel(config.MODEL_NAME)
+        with profile_phase('app.init_vertex_ai'):
+            # 初始化 Vertex AI
+            aiplatform.init(
+                project=config.GCP_PROJECT_ID, 
+                location=config.GCP_LOCATION
+            )
+            
+            # 创建生成模型实例
+            model = generative_models.GenerativeModel(config.MODEL_NAME)
         
         logger.info("Vertex AI 初始化成功")
+        log_startup_report()
     except Exception as e:
         logger.error(f"Vertex AI 初始化失败: {e}")
         raise
 
+def ensure_model():
+    """获取模型实例，未初始化时（例如由 gunicorn 加载）只由一个线程初始化；失败后 AI_INIT_RETRY_INTERVAL 秒内不再重试"""
+    global _init_failed_at
+    
+    if model:
+        return model
+    
+    with _model_lock:
+        if model is None and (
+            _init_failed_at is None or time.monotonic() - _init_failed_at >= config.AI_INIT_RETRY_INTERVAL
+        ):
+            try:
+                init_vertex_ai()
+                _init_failed_at = None
+            except Exception:
+                _init_failed_at = time.monotonic()
+    return model
+
+# gunicorn worker 启动时初始化模型，首个请求不再承担 SDK 加载和初始化的耗时
+register_warmup_step('vertex_ai', lambda priming: ensure_model() is not None)
+
 # 钉钉签名验证
 def verify_dingtalk_signature(timestamp: str, secret: str, sign: str) -> bool:
     """验证钉钉webhook签名"""
@@ -92,8 +133,7 @@ def verify_dingtalk_signature(timestamp: str, secret: str, sign: str) -> bool:
 # 与 Gemini 模型对话
 def chat_with_gemini(question: str) -> str:
     """调用 Gemini-2.5-Flash 模型处理问题"""
-    global model
-    
+    model = ensure_model()
     if not model:
         logger.error("Gemini模型未初始化")
         return "抱歉，AI服务暂时不可用，请稍后再试。"
@@ -102,14 +142,24 @@ def chat_with_gemini(question: str) -> str:
         # 开始计时
         start_time = time.time()
         
+        # 思考预算（默认关闭思考），开启自动调节时按问题类型调整
+        question_class = classify_question(question)
+        thinking = get_thinking_controller()
+        budget = thinking.budget_for(config.MODEL_NAME, question_class)
+        
+        # 裁剪超长输入，按问题类型确定输出长度
+        question, input_tokens, max_output_tokens = prepare_generation(question)
+        
         # 生成配置 - 关闭CoT，追求快速响应
         generation_config = {
             "temperature": 0.3,
             "top_p": 0.8,
             "top_k": 40,
-            "max_output_tokens": 1000,
+            "max_output_tokens": output_token_limit(max_output_tokens, budget),
             "response_mime_type": "text/plain"
         }
+        if budget is not None:
+            generation_config["thinking_config"] = {"thinking_budget": budget}
         
         # 安全设置
         safety_settings = {
@@ -130,16 +180,28 @@ def chat_with_gemini(question: str) -> str:
         end_time = time.time()
         response_time = end_time - start_time
         
+        # 用实际输入 token 数校准本地估算
+        usage = getattr(response, "usage_metadata", None)
+        get_token_estimator().record_usage(input_tokens, getattr(usage, "prompt_token_count", 0))
+        
+        candidate = response.candidates[0] if response.candidates else None
+        thinking.record(
+            config.MODEL_NAME, question_class, budget, 
+            candidate.text if candidate and candidate.content.parts else "",
+            candidate.finish_reason.name if candidate else None,
+            getattr(usage, "thoughts_token_count", 0)
+        )
+        
         # 检查响应
         if response.text:
-            logger.info(f"Gemini响应成功，耗时: {response_time:.2f}秒")
+            logger.info("Gemini响应成功，耗时: %.2f秒", response_time)
             return response.text.strip()
         else:
             logger.warning("Gemini返回空响应")
             return "抱歉，我无法处理这个问题，请换个方式提问。"
         
     except Exception as e:
-        logger.error(f"调用 Gemini 模型失败: {e}")
+        logger.error("调用 Gemini 模型失败: %s", e)
         return "抱歉，AI服务暂时不可用，请稍后再试。"
 
 # 发送钉钉消息
@@ -165,19 +227,19 @@ def send_dingtalk_message(webhook_url: str, message: str, at_mobiles: list = Non
             "Content-Type": "application/json"
         }
         
-        response = requests.post(webhook_url, json=data, headers=headers, timeout=10)
+        response = get_session().post(webhook_url, data=dumps(data), headers=headers, timeout=send_timeout())
         response.raise_for_status()
         
-        result = response.json()
+        result = loads(response.content)
         if result.get("errcode") == 0:
             logger.info("消息发送成功")
             return True
         else:
-            logger.error(f"消息发送失败: {result}")
+            logger.error("消息发送失败: %s", result)
             return False
             
     except Exception as e:
-        logger.error(f"发送钉钉消息失败: {e}")
+        logger.error("发送钉钉消息失败: %s", e)
         return False
 
 # 处理钉钉webhook消息
@@ -199,7 +261,8 @@ def handle_webhook():
             logger.warning("无效的请求数据")
             return jsonify({"error": "无效的请求数据"}), 400
         
-        logger.info(f"收到钉钉webhook消息: {json.dumps(data, ensure_ascii=False)}")
+        logger.info("收到钉钉webhook消息")
+        log_payload(logger, "消息详情", data, level=logging.INFO)
         
         # 检查是否是文本消息且包含机器人被@的情况
         msg_type = data.get('msgtype')
@@ -234,7 +297,7 @@ def handle_webhook():
             return jsonify({"success": True})
         
         # 调用AI模型处理问题
-        logger.info(f"处理问题: {question}")
+        logger.info("处理问题: %s", clip(question))
         ai_response = chat_with_gemini(question)
         
         # 获取发送者信息，用于@回复
@@ -250,7 +313,7 @@ def handle_webhook():
         return jsonify({"success": True})
         
     except Exception as e:
-        logger.error(f"处理webhook消息失败: {e}")
+        logger.error("处理webhook消息失败: %s", e)
         return jsonify({"error": "内部服务器错误"}), 500
 
 # 健康检查接口
@@ -6,8 +6,9 @@
 """
 
 import os
-import json
 import logging
+import threading
+from contextlib import nullcontext
 from datetime import datetime
 from typing import Dict, Any
 
@@ -15,12 +16,30 @@ from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 
 from config import get_config
+from log_pipeline import setup_logging, log_payload, clip
+from metrics import get_metrics
+from token_estimator import get_token_estimator
+from thinking_budget import get_thinking_controller
+from startup_profile import lazy_import, profile_phase, get_startup_report, log_startup_report
+from warmup import register_warmup_step
+from health_probe import get_health_prober
+from interim_ack import generate_with_interim_ack
+from admission import get_admission_controller
+from scheduler import get_scheduler
+from cancellation import get_cancellation_registry, cancel_scope, cancel_key, is_cancel_command
+from deadline import register_request_deadline
+from json_codec import register_json_provider
+from dingtalk_openapi import get_openapi_client
+from media import MediaError, parse_incoming_message
+from faq_cache import get_faq_cache
+from conversation_store import get_conversation_store, conversation_key, is_reset_command, select_context
+from gemini_simple import is_fallback_reply
 from utils import (
     verify_dingtalk_signature, 
     send_dingtalk_message, 
+    send_long_dingtalk_message, 
     parse_at_users, 
-    validate_webhook_data,
-    truncate_text
+    validate_webhook_data
 )
 from gemini_client import initialize_gemini_client, get_gemini_client
 
@@ -30,26 +49,32 @@ load_dotenv()
 # 创建Flask应用
 app = Flask(__name__)
 app.config.from_object(get_config())
+# 每个请求从收到时开始计算截止时间，令牌刷新、生成和发送共用
+register_request_deadline(app)
+# webhook 解析和 jsonify 使用更快的 JSON 实现
+register_json_provider(app)
 
-# 配置日志
-logging.basicConfig(
-    level=getattr(logging, app.config['LOG_LEVEL']),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# 配置日志（异步队列写出）
+setup_logging(app.config['LOG_LEVEL'])
 logger = logging.getLogger(__name__)
 
+# AI客户端延迟初始化锁
+_ai_client_lock = threading.Lock()
+
 # 初始化 Gemini 客户端
 def init_ai_client():
     """初始化AI客户端"""
     try:
-        success = initialize_gemini_client(
-            project_id=app.config['GCP_PROJECT_ID'],
-            location=app.config['GCP_LOCATION'],
-            model_name=app.config['MODEL_NAME']
-        )
+        with profile_phase('init_ai_client'):
+            success = initialize_gemini_client(
+                project_id=app.config['GCP_PROJECT_ID'],
+                location=app.config['GCP_LOCATION'],
+                model_name=app.config['MODEL_NAME']
+            )
         
         if success:
             logger.info("AI客户端初始化成功")
+            log_startup_report()
         else:
             logger.error("AI客户端初始化失败")
             
@@ -58,6 +83,46 @@ def init_ai_client():
         logger.error(f"AI客户端初始化异常: {e}")
         return False
 
+def ensure_ai_client():
+    """获取AI客户端，未初始化时（例如由 gunicorn 加载）在首次使用时初始化"""
+    gemini_client = get_gemini_client()
+    if gemini_client:
+        return gemini_client
+    
+    with _ai_client_lock:
+        if not get_gemini_client():
+            init_ai_client()
+    return get_gemini_client()
+
+def warmup_ai_client(priming: bool = False) -> bool:
+    """预热AI客户端：初始化并获取访问令牌，可选发送预热请求"""
+    gemini_client = ensure_ai_client()
+    return bool(gemini_client) and gemini_client.warmup(priming)
+
+register_warmup_step('ai_client', warmup_ai_client)
+
+def check_ai_auth(timeout: float) -> bool:
+    """健康探测：AI客户端已初始化且持有有效的访问令牌"""
+    gemini_client = ensure_ai_client()
+    return bool(gemini_client) and gemini_client.check_auth(timeout)
+
+# 后台健康探测，/health/ready 返回缓存结果
+get_health_prober().register('vertex_auth', check_ai_auth)
+register_warmup_step('health_prober', lambda priming: get_health_prober().start())
+
+def warmup_retrieval(priming: bool = False) -> bool:
+    """预热文档检索：加载索引，没有索引时先建立"""
+    if not app.config['RAG_ENABLED']:
+        return False
+    return lazy_import('retrieval').get_retriever() is not None
+
+register_warmup_step('retrieval', warmup_retrieval)
+
+def generate_faq_answer(question: str) -> str:
+    """后台刷新常见问题答案"""
+    gemini_client = ensure_ai_client()
+    return gemini_client.generate_content(question) if gemini_client else ""
+
 # 处理钉钉webhook消息
 @app.route('/webhook', methods=['POST'])
 def handle_webhook():
@@ -81,22 +146,50 @@ def handle_webhook():
             logger.warning("无效的请求数据")
             return jsonify({"error": "无效的请求数据"}), 400
         
-        logger.info(f"收到钉钉webhook消息")
-        logger.debug(f"消息详情: {json.dumps(data, ensure_ascii=False)}")
+        logger.info("收到钉钉webhook消息")
+        log_payload(logger, "消息详情", data)
         
         # 验证数据格式
         is_valid, error_msg = validate_webhook_data(data)
         if not is_valid:
-            logger.warning(f"数据验证失败: {error_msg}")
+            logger.warning("数据验证失败: %s", error_msg)
             return jsonify({"error": error_msg}), 400
         
-        # 获取消息内容
-        text_data = data.get('text', {})
-        content = text_data.get('content', '').strip()
         webhook_url = data.get('sessionWebhook', '')
         
-        # 解析并清理@用户的文本
-        question = parse_at_users(content)
+        # sessionWebhook 已过期的消息（在积压队列中等待太久）无法回复，不再处理
+        admission = get_admission_controller()
+        if admission and admission.expired(data):
+            return jsonify({"success": True})
+        
+        # 同一发送者的新消息视为重新提问，取代刚开始不久的生成
+        cancellation = get_cancellation_registry()
+        sender = cancel_key(data)
+        if cancellation:
+            cancellation.signal(sender)
+        
+        # 负载过高（排队太久或正在生成的请求太多）时不调用 Gemini；在下载图片和文件之前判断，
+        # 图片和文件消息直接回复繁忙提示，纯文本消息仍可以由常见问题直接回答
+        scheduler = get_scheduler()
+        decision = admission.check(data, scheduler.waiting if scheduler else 0) if admission else None
+        admitted = decision is None or decision.admitted
+        if not admitted and data.get('msgtype') != 'text':
+            admission.shed(decision)
+            send_dingtalk_message(webhook_url, app.config['BUSY_REPLY_TEXT'])
+            return jsonify({"success": True})
+        
+        # 获取消息内容：文本，以及图片和文件（下载、去重、缩放）
+        try:
+            incoming = parse_incoming_message(data, get_openapi_client())
+        except MediaError as e:
+            logger.warning("媒体消息处理失败: %s", e)
+            send_dingtalk_message(webhook_url, str(e))
+            return jsonify({"success": True})
+        
+        # 解析并清理@用户的文本，只发了图片或文件时使用默认提示
+        question = parse_at_users(incoming.text)
+        if not question and incoming.media:
+            question = app.config['MEDIA_DEFAULT_PROMPT']
         
         if not question:
             logger.info("消息内容为空，发送帮助信息")
@@ -104,35 +197,85 @@ def handle_webhook():
             send_dingtalk_message(webhook_url, help_message)
             return jsonify({"success": True})
         
+        # 获取发送者信息，用于@回复
+        sender_info = data.get('senderStaffId', '')
+        at_userids = [sender_info] if sender_info else []
+        
+        # 对话历史（持久化保存，worker 重启后仍然可用）
+        store = get_conversation_store()
+        conversation = conversation_key(data) if store else ''
+        if store and is_reset_command(question):
+            store.clear(conversation)
+            send_dingtalk_message(webhook_url, "已清除对话上下文，可以开始新的话题。")
+            return jsonify({"success": True})
+        
+        # 取消指令：停止该发送者正在进行的生成和尚未发出的回复
+        if cancellation and is_cancel_command(question):
+            cancellation.signal(sender, command=True)
+            send_dingtalk_message(webhook_url, app.config['CANCEL_REPLY_TEXT'])
+            return jsonify({"success": True})
+        
+        # 常见问题直接回答，不调用 Gemini；有对话历史时问题可能依赖上文，不使用常见问题
+        history = select_context(store.history(conversation)) if store else []
+        faq_cache = get_faq_cache() if not incoming.media and not history else None
+        faq_answer = faq_cache.lookup(question) if faq_cache else None
+        if faq_answer:
+            logger.info("命中常见问题: %s", clip(question))
+            send_long_dingtalk_message(webhook_url, faq_answer, at_userids=at_userids)
+            return jsonify({"success": True})
+        
+        # 负载过高且没有命中常见问题时回复繁忙提示
+        if not admitted:
+            admission.shed(decision)
+            send_dingtalk_message(webhook_url, app.config['BUSY_REPLY_TEXT'])
+            return jsonify({"success": True})
+        
         # 获取AI客户端
-        gemini_client = get_gemini_client()
+        gemini_client = ensure_ai_client()
         if not gemini_client:
             logger.error("AI客户端未初始化")
             error_message = "抱歉，AI服务暂时不可用，请稍后再试。"
             send_dingtalk_message(webhook_url, error_message)
             return jsonify({"error": "AI服务不可用"}), 503
         
-        # 调用AI模型处理问题
-        logger.info(f"处理问题: {question}")
-        ai_response = gemini_client.generate_content(question)
-        
-        # 截断过长的回复
-        ai_response = truncate_text(ai_response, 2000)
-        
-        # 获取发送者信息，用于@回复
-        sender_info = data.get('senderStaffId', '')
-        at_userids = [sender_info] if sender_info else []
-        
-        # 发送回复消息
-        if send_dingtalk_message(webhook_url, ai_response, at_userids=at_userids):
-            logger.info("回复消息发送成功")
-        else:
-            logger.error("回复消息发送失败")
+        # 调用AI模型处理问题，按优先级排队等待生成名额，超过阈值时先发送"正在思考"确认；
+        # 排队、生成和分段发送都可以被同一发送者的取消指令或新消息中止
+        logger.info("处理问题: %s", clip(question))
+        with cancel_scope(sender) as cancel_token:
+            with scheduler.slot(data, question, len(history) // 2) if scheduler else nullcontext(True) as acquired:
+                if acquired:
+                    with admission.track() if admission else nullcontext():
+                        ai_response = generate_with_interim_ack(
+                            lambda: gemini_client.generate_content(question, media_parts=incoming.media, history=history),
+                            lambda: send_dingtalk_message(webhook_url, app.config['INTERIM_ACK_TEXT'])
+                        )
+            if cancel_token.cancelled:
+                logger.info("生成已取消（%s），不再回复", cancel_token.reason)
+                return jsonify({"success": True})
+            if not acquired:
+                # 等到截止时间仍未获得生成名额
+                logger.warning("等待生成名额超时，回复繁忙提示")
+                send_dingtalk_message(webhook_url, app.config['BUSY_REPLY_TEXT'])
+                return jsonify({"success": True})
+            if store and not is_fallback_reply(ai_response):
+                store.append(conversation, question, ai_response)
+            if faq_cache:
+                # 问得多的问题缓存回答，并在后台提前刷新
+                faq_cache.learn(question, ai_response)
+                faq_cache.start(generate_faq_answer)
+            
+            # 发送回复消息，超长回复分段发送
+            if send_long_dingtalk_message(webhook_url, ai_response, at_userids=at_userids):
+                logger.info("回复消息发送成功")
+            elif cancel_token.cancelled:
+                logger.info("回复发送途中已取消，剩余分段未发送")
+            else:
+                logger.error("回复消息发送失败")
         
         return jsonify({"success": True})
         
     except Exception as e:
-        logger.error(f"处理webhook消息失败: {e}")
+        logger.error("处理webhook消息失败: %s", e)
         return jsonify({"error": "内部服务器错误"}), 500
 
 # 健康检查接口
@@ -150,13 +293,20 @@ def health_check():
         "ai_status": ai_status
     })
 
+# 就绪检查接口（负载均衡探测使用）
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """就绪检查接口，返回后台探测的缓存结果，不发起网络调用"""
+    ready, result = get_health_prober().readiness()
+    return jsonify(result), 200 if ready else 503
+
 # 测试接口
 @app.route('/test', methods=['GET'])
 def test_endpoint():
     """测试接口"""
     test_question = request.args.get('q', '你好')
     
-    gemini_client = get_gemini_client()
+    gemini_client = ensure_ai_client()
     if not gemini_client:
         return jsonify({
             "error": "AI客户端未初始化",
@@ -180,9 +330,28 @@ def info_endpoint():
         "location": app.config['GCP_LOCATION'],
         "model": app.config['MODEL_NAME'],
         "version": "1.0.0",
-        "debug": app.config['DEBUG']
+        "debug": app.config['DEBUG'],
+        "startup": get_startup_report()
     })
 
+# 指标接口
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """运行指标接口"""
+    snapshot = get_metrics().snapshot()
+    snapshot["token_estimator_calibration"] = round(get_token_estimator().calibration, 4)
+    snapshot["thinking_budgets"] = get_thinking_controller().snapshot()
+    faq_cache = get_faq_cache()
+    if faq_cache:
+        snapshot["faq"] = faq_cache.snapshot()
+    admission = get_admission_controller()
+    if admission:
+        snapshot["admission"] = admission.snapshot()
+    scheduler = get_scheduler()
+    if scheduler:
+        snapshot["scheduler"] = scheduler.snapshot()
+    return jsonify(snapshot)
+
 # 错误处理
 @app.errorhandler(404)
 def not_found(error):
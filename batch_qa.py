@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线批量问答工具
+从 JSONL 读取问题，按限定并发和速率调用 Gemini，结果逐行写入输出 JSONL。
+输出文件同时作为断点记录，中断后重新运行会跳过已成功的问题。
+
+输入每行格式：{"id": "q1", "prompt": "问题内容"}（也接受 question 字段，缺少 id 时使用行号）
+
+用法：
+    # 在线逐条调用
+    python batch_qa.py run questions.jsonl answers.jsonl --concurrency 8 --rate 5
+
+    # 大批量任务使用 Vertex AI 批量预测
+    python batch_qa.py prepare-batch questions.jsonl batch_requests.jsonl
+    gsutil cp batch_requests.jsonl gs://your-bucket/batch/input.jsonl
+    python batch_qa.py submit-batch gs://your-bucket/batch/input.jsonl gs://your-bucket/batch/output/
+    gsutil cat gs://your-bucket/batch/output/*/predictions.jsonl > predictions.jsonl
+    python batch_qa.py collect-batch questions.jsonl predictions.jsonl answers.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Any, Iterator, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from config import Config
+from http_pool import get_session
+from gemini_simple import SimpleGeminiClient, extract_response_text
+from thinking_budget import get_thinking_controller
+from token_estimator import prepare_generation, classify_question
+from utils import TokenBucket
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def read_prompts(path: str) -> Iterator[Tuple[str, str]]:
+    """
+    逐行读取输入问题
+
+    Args:
+        path: 输入 JSONL 文件路径
+
+    Yields:
+        tuple: (问题ID, 问题内容)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"跳过第 {line_no} 行，JSON 格式错误: {e}")
+                continue
+
+            prompt = item.get('prompt') or item.get('question') or ''
+            if not prompt:
+                logger.warning(f"跳过第 {line_no} 行，缺少问题内容")
+                continue
+            yield str(item.get('id', line_no)), prompt
+
+
+def load_completed_ids(path: str) -> Set[str]:
+    """
+    读取输出文件中已成功完成的问题ID，用于断点续跑
+
+    Args:
+        path: 输出 JSONL 文件路径
+
+    Returns:
+        set: 已完成的问题ID
+    """
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断时可能留下不完整的最后一行
+                continue
+            if item.get('status') == 'ok':
+                completed.add(str(item.get('id')))
+    return completed
+
+
+class ResultWriter:
+    """线程安全的结果写入器，每条结果立即落盘"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            if self._file.closed:
+                # 再次中断时仍在进行的问题，重新运行时会再次处理
+                return
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def answer_one(
+    client: SimpleGeminiClient,
+    limiter: TokenBucket,
+    item_id: str,
+    prompt: str,
+    max_output_tokens: Optional[int],
+    retries: int,
+    timeout: float
+) -> Dict[str, Any]:
+    """
+    回答单个问题，失败时按指数退避重试
+
+    Returns:
+        dict: 输出记录
+    """
+    last_error = ""
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        start_time = time.time()
+        try:
+            answer = client.generate_content_raw(
+                prompt, max_output_tokens=max_output_tokens, timeout=timeout, model_name=client.model_name
+            )
+            if not answer:
+                status = "empty"
+            elif answer.endswith(Config.DEADLINE_PARTIAL_NOTICE):
+                # 超时截断的回答不算完成，重新运行时会再次处理
+                status = "partial"
+            else:
+                status = "ok"
+            return {
+                "id": item_id,
+                "prompt": prompt,
+                "answer": answer,
+                "status": status,
+                "model": client.model_name,
+                "latency": round(time.time() - start_time, 3)
+            }
+        except Exception as e:
+            last_error = str(e)
+            logger.warning(f"问题 {item_id} 第 {attempt + 1} 次调用失败: {e}")
+            # 最后一次失败后不再等待
+            if attempt < retries:
+                time.sleep(min(2 ** attempt, 30))
+
+    return {"id": item_id, "prompt": prompt, "status": "error", "error": last_error}
+
+
+def run_online(args) -> int:
+    """逐条调用 Gemini 在线接口"""
+    client = SimpleGeminiClient(Config.GCP_PROJECT_ID, Config.GCP_LOCATION, args.model)
+    if not client.initialize():
+        print("❌ Gemini 客户端初始化失败")
+        return 1
+
+    completed = load_completed_ids(args.output)
+    if completed:
+        print(f"⏭️  跳过已完成的 {len(completed)} 个问题")
+
+    limiter = TokenBucket(args.rate, capacity=args.concurrency)
+    writer = ResultWriter(args.output)
+    counts = {"ok": 0, "partial": 0, "empty": 0, "error": 0}
+    counts_lock = threading.Lock()
+    start_time = time.time()
+
+    def record_result(future):
+        # 每个问题完成时立即写入，中断后重新运行不会丢失已完成的结果
+        if future.cancelled():
+            return
+        record = future.result()
+        writer.write(record)
+        with counts_lock:
+            counts[record["status"]] += 1
+            total = sum(counts.values())
+        if total % 50 == 0:
+            print(f"📈 已完成 {total} 个，耗时 {time.time() - start_time:.1f}秒")
+
+    # 只保留有限数量的待处理任务，避免一次性读入超大输入
+    max_pending = args.concurrency * 2
+    pending = set()
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    try:
+        for item_id, prompt in read_prompts(args.input):
+            if item_id in completed:
+                continue
+            future = executor.submit(
+                answer_one, client, limiter, item_id, prompt,
+                args.max_output_tokens, args.retries, args.timeout
+            )
+            future.add_done_callback(record_result)
+            pending.add(future)
+            while len(pending) >= max_pending:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+        wait(pending)
+    except KeyboardInterrupt:
+        # 尚未开始的问题直接取消，只等待正在调用的问题结束并写入
+        print("\n⏸️  已中断，等待正在进行的问题结束后退出；重新运行相同命令即可从断点继续")
+        executor.shutdown(wait=True, cancel_futures=True)
+        return 130
+    finally:
+        executor.shutdown(wait=False)
+        writer.close()
+
+    print(f"✅ 完成: 成功 {counts['ok']}，超时截断 {counts['partial']}，空响应 {counts['empty']}，失败 {counts['error']}，"
+          f"耗时 {time.time() - start_time:.1f}秒")
+    return 0 if counts['error'] == 0 else 2
+
+
+def prepare_batch(args) -> int:
+    """生成 Vertex AI 批量预测的输入文件"""
+    client = SimpleGeminiClient(Config.GCP_PROJECT_ID, Config.GCP_LOCATION, args.model)
+    thinking = get_thinking_controller()
+    count = 0
+    with open(args.batch_input, 'w', encoding='utf-8') as f:
+        for item_id, prompt in read_prompts(args.input):
+            budget = thinking.budget_for(args.model, classify_question(prompt))
+            prompt, _, max_output_tokens = prepare_generation(prompt, args.max_output_tokens)
+            body = client.build_request_body(prompt, max_output_tokens=max_output_tokens, thinking_budget=budget)
+            f.write(json.dumps({"id": item_id, "request": body}, ensure_ascii=False) + '\n')
+            count += 1
+
+    print(f"✅ 已生成 {count} 条批量请求: {args.batch_input}")
+    print("   请上传到 GCS 后执行 submit-batch")
+    return 0
+
+
+def submit_batch(args) -> int:
+    """提交 Vertex AI 批量预测任务"""
+    client = SimpleGeminiClient(Config.GCP_PROJECT_ID, Config.GCP_LOCATION, args.model)
+    if not client.initialize():
+        print("❌ Gemini 客户端初始化失败")
+        return 1
+
+    url = (f"https://{client.location}-aiplatform.googleapis.com/v1/projects/{client.project_id}"
+           f"/locations/{client.location}/batchPredictionJobs")
+    body = {
+        "displayName": f"dingtalk-batch-qa-{int(time.time())}",
+        "model": f"publishers/google/models/{client.model_name}",
+        "inputConfig": {
+            "instancesFormat": "jsonl",
+            "gcsSource": {"uris": [args.gcs_input]}
+        },
+        "outputConfig": {
+            "predictionsFormat": "jsonl",
+            "gcsDestination": {"outputUriPrefix": args.gcs_output}
+        }
+    }
+
+    response = get_session().post(url, json=body, headers=client.get_auth_headers(), timeout=30)
+    if response.status_code != 200:
+        print(f"❌ 提交批量预测任务失败: {response.status_code} {response.text}")
+        return 1
+
+    job = response.json()
+    print(f"✅ 批量预测任务已提交: {job.get('name')}")
+    print(f"   状态: {job.get('state')}")
+    return 0
+
+
+def collect_batch(args) -> int:
+    """将 Vertex AI 批量预测结果转换为与在线模式相同的输出格式"""
+    # 预测结果按 prepare-batch 写入的 id 匹配问题；结果中没有 id 时按原样带回的请求中的问题内容兜底匹配，
+    # 请求中是经过 prepare_generation 裁剪后的问题，这里用同样的方式裁剪后再建立映射
+    ids_by_prompt = {
+        prepare_generation(prompt, args.max_output_tokens)[0]: item_id
+        for item_id, prompt in read_prompts(args.input)
+    }
+
+    writer = ResultWriter(args.output)
+    count = 0
+    try:
+        with open(args.predictions, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+                request_body = item.get('request', {})
+                try:
+                    prompt = request_body['contents'][0]['parts'][0]['text']
+                except (KeyError, IndexError):
+                    prompt = ''
+                item_id = str(item.get('id') or ids_by_prompt.get(prompt, ''))
+
+                answer = extract_response_text(item.get('response') or {})
+                status = item.get('status') or ''
+                writer.write({
+                    "id": item_id,
+                    "prompt": prompt,
+                    "answer": answer,
+                    "status": "error" if status else ("ok" if answer else "empty"),
+                    "error": status or None,
+                    "model": args.model
+                })
+                count += 1
+    finally:
+        writer.close()
+
+    print(f"✅ 已转换 {count} 条批量预测结果: {args.output}")
+    return 0
+
+
+def main() -> int:
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='批量调用 Gemini 回答 JSONL 中的问题')
+    parser.add_argument('--model', default=Config.MODEL_NAME, help='模型名称')
+    parser.add_argument('--max-output-tokens', type=int, default=None, help='最大输出token数，默认按问题类型自动确定')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='在线逐条调用，支持断点续跑')
+    run_parser.add_argument('input', help='输入 JSONL')
+    run_parser.add_argument('output', help='输出 JSONL（同时作为断点记录）')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='并发数')
+    run_parser.add_argument('--rate', type=float, default=2.0, help='每秒最多请求数')
+    run_parser.add_argument('--retries', type=int, default=2, help='失败重试次数')
+    run_parser.add_argument('--timeout', type=float, default=Config.REQUEST_TIMEOUT, help='单个问题的生成超时（秒）')
+    run_parser.set_defaults(func=run_online)
+
+    prepare_parser = subparsers.add_parser('prepare-batch', help='生成 Vertex AI 批量预测输入文件')
+    prepare_parser.add_argument('input', help='输入 JSONL')
+    prepare_parser.add_argument('batch_input', help='批量预测请求 JSONL')
+    prepare_parser.set_defaults(func=prepare_batch)
+
+    submit_parser = subparsers.add_parser('submit-batch', help='提交 Vertex AI 批量预测任务')
+    submit_parser.add_argument('gcs_input', help='GCS 上的批量请求文件，例如 gs://bucket/input.jsonl')
+    submit_parser.add_argument('gcs_output', help='GCS 输出目录前缀，例如 gs://bucket/output/')
+    submit_parser.set_defaults(func=submit_batch)
+
+    collect_parser = subparsers.add_parser('collect-batch', help='转换批量预测结果')
+    collect_parser.add_argument('input', help='原始输入 JSONL')
+    collect_parser.add_argument('predictions', help='下载到本地的 predictions.jsonl')
+    collect_parser.add_argument('output', help='输出 JSONL')
+    collect_parser.set_defaults(func=collect_batch)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成取消模块
+用户发送"算了"、"取消"，或者紧接着换一种说法重新提问时，原来的回答已经没有用了：
+正在进行的 Vertex AI 请求立即断开（服务端随之停止生成），排队等待的生成名额和尚未发出的分段消息
+都不再继续，worker 马上可以处理其他请求。
+
+每个正在生成的请求持有一个 CancelToken（按 (会话ID, 发送者) 登记），生成和发送的各个阶段
+通过 current_cancel_token() 取得当前请求的令牌并注册取消回调。
+
+同一发送者的下一条消息可能由另一个 gunicorn worker 接收：取消信号写入在 master 进程中创建、
+fork 后各 worker 共享的内存（按键哈希分槽，记录最近一次取消/新消息的时间和写入者的键指纹），
+每个 worker 的后台线程每隔 CANCEL_POLL_INTERVAL 秒检查本进程正在生成的请求；
+分到同一个槽的其他发送者的信号指纹不同，不会误取消
+"""
+
+import os
+import re
+import mmap
+import hashlib
+import time
+import zlib
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from config import Config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 取消指令
+_CANCEL_RE = re.compile(r'^\s*(/cancel|/stop|算了|取消|不用了|别说了|停|停止|stop|cancel)[\s!！。.~～吧]*$', re.I)
+
+REASON_COMMAND = "command"
+REASON_SUPERSEDED = "superseded"
+
+
+class GenerationCancelled(Exception):
+    """生成已被取消"""
+
+
+def is_cancel_command(text: str) -> bool:
+    """判断消息是否为取消指令"""
+    return bool(_CANCEL_RE.match(text))
+
+
+def cancel_key(data: Dict[str, Any]) -> Tuple[str, str]:
+    """消息的取消键：(机器人:会话ID, 发送者)，同一个群里的不同机器人互不影响"""
+    conversation = data.get('conversationId', '')
+    robot = data.get('robotCode', '')
+    return (
+        f"{robot}:{conversation}" if robot and conversation else conversation,
+        data.get('senderStaffId') or data.get('senderId', '')
+    )
+
+
+class CancelToken:
+    """一个请求的取消令牌"""
+
+    def __init__(self, key: Tuple[str, str], started_at: float):
+        """
+        Args:
+            key: (会话ID, 发送者)
+            started_at: 请求开始时间（时间戳），早于该时间的取消信号不影响本请求
+        """
+        self.key = key
+        self.started_at = started_at
+        self.reason = ""
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], object]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        """是否已取消"""
+        return self._event.is_set()
+
+    def cancel(self, reason: str):
+        """
+        取消请求，依次执行已注册的回调
+
+        Args:
+            reason: 取消原因（command / superseded）
+        """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        metrics.inc("generation_cancelled", reason=reason)
+        logger.info("取消正在进行的生成（%s）", reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning("执行取消回调失败: %s", e)
+
+    def add_callback(self, callback: Callable[[], object]):
+        """注册取消时执行的回调，已取消时立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], object]):
+        """移除回调（对应的阶段已经结束）"""
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self):
+        """
+        已取消时抛出异常
+
+        Raises:
+            GenerationCancelled: 请求已取消
+        """
+        if self._event.is_set():
+            raise GenerationCancelled(self.reason)
+
+
+class CancellationRegistry:
+    """按发送者登记正在生成的请求，并在进程间传递取消信号"""
+
+    def __init__(self, slots: Optional[int] = None, supersede_window: Optional[float] = None):
+        """
+        Args:
+            slots: 共享内存中的信号槽数，默认读取 CANCEL_SLOTS
+            supersede_window: 新消息在请求开始后多少秒内到达时视为重新提问并取消原请求，
+                默认读取 CANCEL_SUPERSEDE_WINDOW，0 表示只响应取消指令
+        """
+        self.slots = slots or Config.CANCEL_SLOTS
+        self.supersede_window = Config.CANCEL_SUPERSEDE_WINDOW if supersede_window is None else supersede_window
+        # 匿名共享映射在 fork 后由父子进程共用：_times 前一半记录取消指令时间，后一半记录新消息时间，
+        # _fingerprints 对应位置记录写入该时间的键指纹
+        self._shared = mmap.mmap(-1, self.slots * 4 * 8)
+        view = memoryview(self._shared)
+        self._times = view[:self.slots * 2 * 8].cast('d')
+        self._fingerprints = view[self.slots * 2 * 8:].cast('Q')
+        # 正在生成的请求及其键指纹
+        self._tokens: Dict[CancelToken, int] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread_pid: Optional[int] = None
+
+    def _slot(self, key: Tuple[str, str]) -> int:
+        return zlib.crc32(f"{key[0]}\x1f{key[1]}".encode('utf-8')) % self.slots
+
+    @staticmethod
+    def _fingerprint(key: Tuple[str, str]) -> int:
+        # 与分槽使用不同的哈希函数，同槽的两个键指纹也相同的概率可以忽略
+        digest = hashlib.blake2b(f"{key[0]}\x1f{key[1]}".encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def _read(self, index: int, fingerprint: int) -> float:
+        # signal() 先写指纹再写时间：读时间前后指纹都是本键时，读到的时间才是本键写入的
+        if self._fingerprints[index] != fingerprint:
+            return 0.0
+        at = self._times[index]
+        return at if self._fingerprints[index] == fingerprint else 0.0
+
+    def _should_cancel(self, token: CancelToken, command_at: float, message_at: float) -> Optional[str]:
+        if command_at > token.started_at:
+            return REASON_COMMAND
+        if self.supersede_window > 0 and token.started_at < message_at <= token.started_at + self.supersede_window:
+            return REASON_SUPERSEDED
+        return None
+
+    def signal(self, key: Tuple[str, str], command: bool = False):
+        """
+        发送者发来新消息或取消指令：记录信号，并立即取消本进程中该发送者正在进行的请求
+
+        Args:
+            key: (会话ID, 发送者)
+            command: 是否为取消指令；否则按重新提问处理，只取消 supersede_window 内开始的请求
+        """
+        if not key[0]:
+            return
+        now = time.time()
+        index = self._slot(key) + (0 if command else self.slots)
+        self._fingerprints[index] = self._fingerprint(key)
+        self._times[index] = now
+        with self._lock:
+            tokens = [token for token in self._tokens if token.key == key]
+        for token in tokens:
+            reason = self._should_cancel(token, now if command else 0.0, 0.0 if command else now)
+            if reason:
+                token.cancel(reason)
+
+    def begin(self, key: Tuple[str, str]) -> CancelToken:
+        """登记一个开始生成的请求"""
+        token = CancelToken(key, time.time())
+        if key[0]:
+            with self._lock:
+                self._tokens[token] = self._fingerprint(key)
+            self.start()
+            self._wakeup.set()
+        return token
+
+    def end(self, token: CancelToken):
+        """请求结束，取消登记"""
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def poll(self):
+        """检查其他进程写入的信号，取消本进程中受影响的请求"""
+        with self._lock:
+            tokens = list(self._tokens.items())
+        for token, fingerprint in tokens:
+            slot = self._slot(token.key)
+            reason = self._should_cancel(
+                token, self._read(slot, fingerprint), self._read(self.slots + slot, fingerprint)
+            )
+            if reason:
+                token.cancel(reason)
+
+    def _run(self):
+        while True:
+            # 没有正在生成的请求时不轮询
+            if not self._tokens:
+                self._wakeup.wait()
+                self._wakeup.clear()
+            time.sleep(Config.CANCEL_POLL_INTERVAL)
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"检查取消信号失败: {e}")
+
+    def start(self):
+        """启动后台轮询线程；gunicorn fork 出的 worker 中会重新启动"""
+        pid = os.getpid()
+        if self._thread_pid == pid:
+            return
+        with self._lock:
+            if self._thread_pid == pid:
+                return
+            threading.Thread(target=self._run, name='cancel-poll', daemon=True).start()
+            self._thread_pid = pid
+
+
+# 当前请求的取消令牌
+_current: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar('cancel_token', default=None)
+
+
+def current_cancel_token() -> Optional[CancelToken]:
+    """获取当前请求的取消令牌，不在可取消的请求中时为 None"""
+    return _current.get()
+
+
+def check_cancelled():
+    """
+    当前请求已取消时抛出异常
+
+    Raises:
+        GenerationCancelled: 请求已取消
+    """
+    token = _current.get()
+    if token is not None:
+        token.check()
+
+
+@contextmanager
+def cancel_scope(key: Tuple[str, str]) -> Iterator[CancelToken]:
+    """
+    在 with 块内登记当前请求，生成和发送步骤可以被同一发送者的取消指令或新消息中止
+
+    Args:
+        key: (会话ID, 发送者)
+    """
+    registry = get_cancellation_registry()
+    token = registry.begin(key) if registry else CancelToken(key, time.time())
+    context_token = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(context_token)
+        if registry:
+            registry.end(token)
+
+
+# 进程级全局实例；在 gunicorn master 中导入时创建，worker 共享信号内存
+_registry: Optional[CancellationRegistry] = CancellationRegistry() if Config.CANCEL_ENABLED else None
+
+
+def get_cancellation_registry() -> Optional[CancellationRegistry]:
+    """获取全局取消登记表，未启用 CANCEL_ENABLED 时返回 None"""
+    return _registry
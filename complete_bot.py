@@ -8,205 +8,139 @@
 """
 
 import os
-import json
 import logging
-import time
-import hmac
-import hashlib
-import base64
-import urllib.parse
+import functools
+import threading
+from contextlib import nullcontext
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from typing import Any, Dict, Tuple
 
-import requests
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 
+from tenants import initialize_tenant_registry, get_tenant_registry
+from utils import verify_dingtalk_signature
+from health_probe import get_health_prober
+from log_pipeline import setup_logging, log_payload, clip
+from metrics import get_metrics
+from token_estimator import get_token_estimator
+from thinking_budget import get_thinking_controller
+from interim_ack import generate_with_interim_ack
+from admission import get_admission_controller
+from scheduler import get_scheduler
+from cancellation import get_cancellation_registry, cancel_scope, cancel_key, is_cancel_command
+from deadline import register_request_deadline
+from json_codec import register_json_provider
+from stream_mode import StreamClient
+from media import MediaError, parse_incoming_message
+from faq_cache import get_faq_cache
+from conversation_store import get_conversation_store, conversation_key, is_reset_command, select_context
+from gemini_simple import SimpleGeminiClient, is_fallback_reply
+from config import Config
+from warmup import register_warmup_step
+
 # 加载环境变量
 load_dotenv()
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# 配置日志（异步队列写出）
+setup_logging(os.getenv('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
 
 # 创建Flask应用
 app = Flask(__name__)
+# 每个请求从收到时开始计算截止时间，令牌刷新、生成和发送共用
+register_request_deadline(app)
+# webhook 解析和 jsonify 使用更快的 JSON 实现
+register_json_provider(app)
 
 
-class DingTalkBot:
-    """钉钉机器人消息发送类"""
-    
-    def __init__(self, access_token: str, secret: str = ""):
-        self.access_token = access_token
-        self.secret = secret
-    
-    def send_message(
-        self, 
-        msg: str, 
-        at_user_ids: Optional[List[str]] = None,
-        at_mobiles: Optional[List[str]] = None,
-        is_at_all: bool = False
-    ) -> dict:
-        """发送消息到钉钉群"""
-        try:
-            # 构建请求URL
-            url = f'https://oapi.dingtalk.com/robot/send?access_token={self.access_token}'
-            
-            # 如果有secret，添加签名
-            if self.secret:
-                timestamp = str(round(time.time() * 1000))
-                string_to_sign = f'{timestamp}\n{self.secret}'
-                hmac_code = hmac.new(
-                    self.secret.encode('utf-8'), 
-                    string_to_sign.encode('utf-8'), 
-                    digestmod=hashlib.sha256
-                ).digest()
-                sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
-                url += f'&timestamp={timestamp}&sign={sign}'
-            
-            # 构建消息体
-            body = {
-                "at": {
-                    "isAtAll": is_at_all,
-                    "atUserIds": at_user_ids or [],
-                    "atMobiles": at_mobiles or []
-                },
-                "text": {
-                    "content": msg
-                },
-                "msgtype": "text"
-            }
-            
-            # 发送请求
-            headers = {'Content-Type': 'application/json'}
-            resp = requests.post(url, json=body, headers=headers, timeout=10)
-            resp.raise_for_status()
-            
-            result = resp.json()
-            logger.info("钉钉消息发送成功")
-            return result
-            
-        except Exception as e:
-            logger.error(f"钉钉消息发送失败: {e}")
-            return {"errcode": -1, "errmsg": str(e)}
+# 全局实例（所有机器人共用一个 Gemini 客户端）
+gemini_client = None
+_gemini_client_lock = threading.Lock()
+# Stream 模式的长连接
+stream_clients = []
 
+# 钉钉机器人（TENANTS_FILE 中的多个机器人，或环境变量中的单个机器人）在导入时初始化：
+# 由 gunicorn 加载（preload_app）时在 master 中创建，fork 出的 worker 共用各机器人的 Gemini 份额和 robot/send 限额
+tenants_ready = initialize_tenant_registry()
 
-class GeminiClient:
-    """Gemini AI客户端"""
+
+def init_gemini_client() -> bool:
+    """初始化Gemini客户端，并登记后台健康探测"""
+    global gemini_client
     
-    def __init__(self, project_id: str, location: str = "us-central1"):
-        self.project_id = project_id
-        self.location = location
-        self.model_name = "gemini-1.5-flash"
-        self.credentials = None
+    gcp_project_id = os.getenv('GCP_PROJECT_ID')
+    if not gcp_project_id:
+        logger.error("请设置 GCP_PROJECT_ID 环境变量")
+        return False
     
-    def initialize(self) -> bool:
-        """初始化认证"""
-        try:
-            from google.auth import default
-            from google.auth.transport.requests import Request
-            
-            self.credentials, _ = default()
-            self.credentials.refresh(Request())
-            
-            logger.info("Gemini客户端初始化成功")
-            return True
-        except Exception as e:
-            logger.error(f"Gemini客户端初始化失败: {e}")
-            return False
+    client = SimpleGeminiClient(gcp_project_id, model_name=Config.MODEL_NAME)
+    if not client.initialize():
+        logger.error("Gemini客户端初始化失败")
+        return False
+    gemini_client = client
     
-    def generate_content(self, prompt: str) -> str:
-        """生成AI回复"""
-        if not self.credentials:
-            return "AI服务未初始化"
-        
-        try:
-            from google.auth.transport.requests import Request
-            
-            # 刷新令牌
-            self.credentials.refresh(Request())
-            
-            # 构建API请求
-            url = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.model_name}:generateContent"
-            
-            data = {
-                "contents": [{
-                    "role": "user",
-                    "parts": [{"text": prompt}]
-                }],
-                "generation_config": {
-                    "temperature": 0.3,
-                    "top_p": 0.8,
-                    "top_k": 40,
-                    "max_output_tokens": 1000
-                }
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {self.credentials.token}",
-                "Content-Type": "application/json"
-            }
-            
-            start_time = time.time()
-            response = requests.post(url, json=data, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
-            response_time = time.time() - start_time
-            
-            # 解析响应
-            if "candidates" in result and len(result["candidates"]) > 0:
-                candidate = result["candidates"][0]
-                if "content" in candidate and "parts" in candidate["content"]:
-                    parts = candidate["content"]["parts"]
-                    if len(parts) > 0 and "text" in parts[0]:
-                        logger.info(f"Gemini响应成功，耗时: {response_time:.2f}秒")
-                        return parts[0]["text"].strip()
-            
-            return "抱歉，我无法处理这个问题。"
-            
-        except Exception as e:
-            logger.error(f"调用Gemini失败: {e}")
-            return "抱歉，AI服务暂时不可用。"
+    # 后台健康探测，/health/ready 返回缓存结果
+    get_health_prober().register('vertex_auth', gemini_client.check_auth)
+    return True
 
 
-# 全局实例
-dingtalk_bot = None
-gemini_client = None
+def ensure_gemini_client():
+    """获取Gemini客户端，未初始化时（例如由 gunicorn 加载）在 worker 中首次使用时初始化"""
+    if gemini_client:
+        return gemini_client
+    
+    with _gemini_client_lock:
+        if not gemini_client:
+            init_gemini_client()
+    return gemini_client
+
+
+# gunicorn worker 开始接收请求前初始化Gemini客户端并启动健康探测
+register_warmup_step('ai_client', lambda priming: bool(ensure_gemini_client()) and gemini_client.warmup(priming))
+register_warmup_step('health_prober', lambda priming: get_health_prober().start())
 
 
 def init_services():
-    """初始化服务"""
-    global dingtalk_bot, gemini_client
-    
-    # 初始化钉钉机器人
-    access_token = os.getenv('DINGTALK_ACCESS_TOKEN')
-    secret = os.getenv('DINGTALK_SECRET', '')
-    
-    if not access_token:
-        logger.error("请设置 DINGTALK_ACCESS_TOKEN 环境变量")
+    """初始化服务（直接运行本文件时使用）"""
+    if not tenants_ready:
         return False
-    
-    dingtalk_bot = DingTalkBot(access_token, secret)
     logger.info("钉钉机器人初始化成功")
     
-    # 初始化Gemini客户端
-    gcp_project_id = os.getenv('GCP_PROJECT_ID')
-    if not gcp_project_id:
-        logger.error("请设置 GCP_PROJECT_ID 环境变量")
+    if not ensure_gemini_client():
         return False
+    get_health_prober().start()
     
-    gemini_client = GeminiClient(gcp_project_id)
-    if not gemini_client.initialize():
-        logger.error("Gemini客户端初始化失败")
-        return False
+    if Config.DINGTALK_STREAM_MODE:
+        start_stream_clients()
     
     return True
 
 
+def start_stream_clients() -> int:
+    """
+    Stream 模式：为每个配置了应用凭证的机器人建立长连接，消息按 HTTP 回调相同的流程处理
+    
+    Returns:
+        int: 建立的连接数
+    """
+    registry = get_tenant_registry()
+    for name in registry.names():
+        tenant = registry.get(name)
+        openapi = tenant.reply_router.openapi
+        if openapi is None:
+            logger.warning("机器人 %s 未配置应用凭证，无法使用 Stream 模式", name)
+            continue
+        client = StreamClient(
+            openapi.app_key, openapi.app_secret,
+            functools.partial(process_message, tenant=tenant, signalled=True), name=name
+        )
+        client.start()
+        stream_clients.append(client)
+    logger.info("已启动 %d 个 Stream 连接", len(stream_clients))
+    return len(stream_clients)
+
+
 def extract_user_message(data: Dict[str, Any]) -> str:
     """从钉钉请求中提取用户消息"""
     try:
@@ -266,43 +200,142 @@ def get_at_user_info(data: Dict[str, Any]) -> Dict[str, Any]:
         return {'at_user_ids': [], 'at_mobiles': [], 'sender_nick': ''}
 
 
-@app.route('/webhook', methods=['POST'])
-def handle_dingtalk_webhook():
-    """处理钉钉机器人webhook请求"""
+def process_message(data: Dict[str, Any], tenant, signalled: bool = False) -> Tuple[Dict[str, Any], int]:
+    """
+    处理一条机器人消息：提取问题、生成回答并回复；HTTP 回调和 Stream 模式共用
+
+    Args:
+        data: 钉钉机器人消息
+        tenant: 消息所属的机器人
+        signalled: 收到消息时是否已经发出取消信号（Stream 模式在收到消息时发出，这里不再重复）
+
+    Returns:
+        tuple: (响应数据, HTTP 状态码)
+    """
+    reply_router = tenant.reply_router
+    
+    # 检查消息类型
+    msg_type = data.get('msgtype')
+    if msg_type not in ('text', 'picture', 'file', 'richText'):
+        logger.info("忽略不支持的消息类型: %s", msg_type)
+        return {"success": True}, 200
+    
+    # sessionWebhook 已过期的消息（排队太久）不再处理
+    admission = get_admission_controller()
+    if admission and admission.expired(data):
+        return {"success": True}, 200
+    
+    # 同一发送者的新消息视为重新提问，取代刚开始不久的生成
+    cancellation = get_cancellation_registry()
+    sender = cancel_key(data)
+    if cancellation and not signalled:
+        cancellation.signal(sender)
+    
+    # 记录会话的 sessionWebhook，确定回复目标
+    reply_target = reply_router.remember(data)
+    
+    # 负载过高（排队太久或正在生成的请求太多）时不调用 Gemini；在下载图片和文件之前判断，
+    # 图片和文件消息直接回复繁忙提示，纯文本消息仍可以由常见问题直接回答
+    scheduler = get_scheduler()
+    decision = admission.check(data, scheduler.waiting if scheduler else 0) if admission else None
+    admitted = decision is None or decision.admitted
+    if not admitted and msg_type != 'text':
+        admission.shed(decision)
+        reply_router.send(reply_target, Config.BUSY_REPLY_TEXT)
+        return {"success": True}, 200
+    
+    # 2. 提取用户消息：文本，以及图片和文件（下载、去重、缩放）
     try:
-        # 1. 接收钉钉发送的消息
-        data = request.get_json()
-        if not data:
-            logger.warning("收到空的请求数据")
-            return jsonify({"error": "无效的请求数据"}), 400
-        
-        logger.info("收到钉钉webhook请求")
-        logger.debug(f"请求数据: {json.dumps(data, ensure_ascii=False)}")
-        
-        # 检查消息类型
-        msg_type = data.get('msgtype')
-        if msg_type != 'text':
-            logger.info(f"忽略非文本消息类型: {msg_type}")
-            return jsonify({"success": True})
-        
-        # 2. 提取用户消息
-        user_message = extract_user_message(data)
-        if not user_message:
-            logger.warning("提取到空的用户消息")
-            # 发送帮助信息
-            help_msg = "您好！我是AI助手，请@我并发送您的问题。"
-            dingtalk_bot.send_message(help_msg)
-            return jsonify({"success": True})
-        
-        logger.info(f"提取到用户消息: {user_message}")
-        
-        # 获取@用户信息
-        at_info = get_at_user_info(data)
-        
-        # 3. 调用Gemini处理消息
-        logger.info("调用Gemini处理消息...")
-        ai_response = gemini_client.generate_content(user_message)
-        logger.info(f"Gemini响应: {ai_response}")
+        incoming = parse_incoming_message(data, reply_router.openapi)
+    except MediaError as e:
+        logger.warning("媒体消息处理失败: %s", e)
+        reply_router.send(reply_target, str(e))
+        return {"success": True}, 200
+    
+    user_message = extract_user_message(data) if msg_type == 'text' else incoming.text
+    if not user_message and incoming.media:
+        user_message = Config.MEDIA_DEFAULT_PROMPT
+    if not user_message:
+        logger.warning("提取到空的用户消息")
+        # 发送帮助信息
+        help_msg = "您好！我是AI助手，请@我并发送您的问题。"
+        reply_router.send(reply_target, help_msg)
+        return {"success": True}, 200
+    
+    logger.info("提取到用户消息: %s", clip(user_message))
+    
+    # 获取@用户信息
+    at_info = get_at_user_info(data)
+    
+    # 对话历史（持久化保存，worker 重启后仍然可用）；不同机器人的对话分开保存
+    store = get_conversation_store()
+    conversation = f"{tenant.name}:{conversation_key(data)}" if store else ''
+    if store and is_reset_command(user_message):
+        store.clear(conversation)
+        reply_router.send(reply_target, "已清除对话上下文，可以开始新的话题。")
+        return {"success": True}, 200
+    
+    # 取消指令：停止该发送者正在进行的生成和尚未发出的回复
+    if cancellation and is_cancel_command(user_message):
+        if not signalled:
+            cancellation.signal(sender, command=True)
+        reply_router.send(reply_target, Config.CANCEL_REPLY_TEXT)
+        return {"success": True}, 200
+    
+    # 排队、生成和分段发送都可以被同一发送者的取消指令或新消息中止
+    with cancel_scope(sender) as cancel_token:
+        # 3. 常见问题直接回答，不调用 Gemini，也不占用调用份额；有对话历史时问题可能依赖上文，不使用常见问题
+        history = select_context(store.history(conversation)) if store else []
+        faq_cache = get_faq_cache() if not incoming.media and not history else None
+        ai_response = faq_cache.lookup(user_message) if faq_cache else None
+        if ai_response:
+            logger.info("命中常见问题: %s", clip(user_message))
+        else:
+            # 负载过高且没有命中常见问题时回复繁忙提示
+            if not admitted:
+                admission.shed(decision)
+                reply_router.send(reply_target, Config.BUSY_REPLY_TEXT)
+                return {"success": True}, 200
+            gemini_client = ensure_gemini_client()
+            if not gemini_client:
+                logger.error("Gemini客户端未初始化")
+                reply_router.send(reply_target, "抱歉，AI服务暂时不可用，请稍后再试。")
+                return {"error": "AI服务不可用"}, 503
+            # 调用Gemini处理消息，按优先级排队等待生成名额，超过阈值时先发送"正在思考"确认
+            if not tenant.try_acquire_gemini():
+                # 该机器人的 Gemini 调用份额已用尽，不影响其他机器人
+                get_metrics().inc("tenant_quota_rejected", tenant=tenant.name)
+                logger.warning("机器人 %s 的 Gemini 调用份额已用尽", tenant.name)
+                reply_router.send(reply_target, "当前提问人数较多，请稍后再试。")
+                return {"success": True}, 200
+            
+            get_metrics().inc("tenant_requests", tenant=tenant.name)
+            logger.info("调用Gemini处理消息（机器人: %s）...", tenant.name)
+            with scheduler.slot(data, user_message, len(history) // 2) if scheduler else nullcontext(True) as acquired:
+                if acquired:
+                    with admission.track() if admission else nullcontext():
+                        ai_response = generate_with_interim_ack(
+                            lambda: gemini_client.generate_content(
+                                user_message, model_name=tenant.model_name, media_parts=incoming.media, history=history
+                            ),
+                            lambda: reply_router.send(reply_target, Config.INTERIM_ACK_TEXT)
+                        )
+                    logger.info("Gemini响应: %s", clip(ai_response))
+            if cancel_token.cancelled:
+                logger.info("生成已取消（%s），不再回复", cancel_token.reason)
+                return {"success": True}, 200
+            if not acquired:
+                # 等到截止时间仍未获得生成名额
+                logger.warning("等待生成名额超时，回复繁忙提示")
+                reply_router.send(reply_target, Config.BUSY_REPLY_TEXT)
+                return {"success": True}, 200
+            
+            if store and not is_fallback_reply(ai_response):
+                store.append(conversation, user_message, ai_response)
+            if faq_cache and not tenant.model_name:
+                # 问得多的问题缓存回答，并在后台提前刷新（固定模型的机器人不参与，避免答案混用）
+                faq_cache.learn(user_message, ai_response)
+                faq_cache.start(gemini_client.generate_content)
         
         # 4. 发送响应到钉钉机器人webhook
         # 构建回复消息
@@ -312,29 +345,63 @@ def handle_dingtalk_webhook():
             reply_message = ai_response
         
         logger.info("发送响应到钉钉群...")
-        result = dingtalk_bot.send_message(
-            msg=reply_message,
+        result = reply_router.send_long(
+            reply_target,
+            reply_message,
             at_user_ids=at_info['at_user_ids']
         )
         
         if result.get("errcode") == 0:
             logger.info("消息发送成功")
-            return jsonify({"success": True})
+            return {"success": True}, 200
+        elif cancel_token.cancelled:
+            logger.info("回复发送途中已取消，剩余分段未发送")
+            return {"success": True}, 200
         else:
-            logger.error(f"消息发送失败: {result.get('errmsg')}")
-            return jsonify({"error": "消息发送失败"}), 500
+            logger.error("消息发送失败: %s", result.get('errmsg'))
+            return {"error": "消息发送失败"}, 500
+
+
+@app.route('/webhook', methods=['POST'])
+@app.route('/webhook/<tenant_name>', methods=['POST'])
+def handle_dingtalk_webhook(tenant_name=None):
+    """处理钉钉机器人webhook请求，/webhook/<tenant_name> 指定机器人，/webhook 按 robotCode 识别"""
+    try:
+        # 1. 接收钉钉发送的消息
+        data = request.get_json()
+        if not data:
+            logger.warning("收到空的请求数据")
+            return jsonify({"error": "无效的请求数据"}), 400
+        
+        logger.info("收到钉钉webhook请求")
+        log_payload(logger, "请求数据", data)
+        
+        # 确定消息所属的机器人
+        registry = get_tenant_registry()
+        tenant = registry.resolve(tenant_name, data) if registry else None
+        if tenant is None:
+            logger.warning("未知的机器人: %s", tenant_name or data.get('robotCode'))
+            return jsonify({"error": "未知的机器人"}), 404
+        
+        if tenant.webhook_secret and not verify_dingtalk_signature(
+            request.headers.get('timestamp', ''), tenant.webhook_secret, request.headers.get('sign', '')
+        ):
+            logger.warning("机器人 %s 签名验证失败", tenant.name)
+            return jsonify({"error": "签名验证失败"}), 401
+        
+        result, status = process_message(data, tenant)
+        return jsonify(result), status
     
     except Exception as e:
-        logger.error(f"处理webhook请求失败: {e}")
+        logger.error("处理webhook请求失败: %s", e)
         return jsonify({"error": "内部服务器错误"}), 500
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查接口"""
-    global dingtalk_bot, gemini_client
-    
-    dingtalk_status = "ready" if dingtalk_bot else "not_ready"
+    registry = get_tenant_registry()
+    dingtalk_status = "ready" if registry else "not_ready"
     gemini_status = "ready" if gemini_client else "not_ready"
     
     return jsonify({
@@ -343,15 +410,27 @@ def health_check():
         "services": {
             "dingtalk": dingtalk_status,
             "gemini": gemini_status
-        }
+        },
+        "tenants": registry.names() if registry else [],
+        "stream": {client.name: client.connected.is_set() for client in stream_clients}
     })
 
 
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """就绪检查接口，返回后台探测的缓存结果，不发起网络调用"""
+    ready, result = get_health_prober().readiness()
+    return jsonify(result), 200 if ready else 503
+
+
 @app.route('/test', methods=['GET'])
 def test_endpoint():
     """测试接口"""
     test_message = request.args.get('msg', '你好')
+    registry = get_tenant_registry()
+    tenant = registry.get(request.args.get('tenant', '')) or registry.resolve(None, {}) if registry else None
     
+    gemini_client = ensure_gemini_client()
     if not gemini_client:
         return jsonify({"error": "Gemini客户端未初始化"}), 503
     
@@ -359,8 +438,8 @@ def test_endpoint():
     ai_response = gemini_client.generate_content(test_message)
     
     # 测试发送到钉钉
-    if dingtalk_bot:
-        result = dingtalk_bot.send_message(f"🧪 测试消息: {ai_response}")
+    if tenant and tenant.bot.access_token:
+        result = tenant.bot.send_message(f"🧪 测试消息: {ai_response}")
         send_status = "success" if result.get("errcode") == 0 else "failed"
     else:
         send_status = "dingtalk_not_ready"
@@ -373,6 +452,24 @@ def test_endpoint():
     })
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """运行指标接口"""
+    snapshot = get_metrics().snapshot()
+    snapshot["token_estimator_calibration"] = round(get_token_estimator().calibration, 4)
+    snapshot["thinking_budgets"] = get_thinking_controller().snapshot()
+    faq_cache = get_faq_cache()
+    if faq_cache:
+        snapshot["faq"] = faq_cache.snapshot()
+    admission = get_admission_controller()
+    if admission:
+        snapshot["admission"] = admission.snapshot()
+    scheduler = get_scheduler()
+    if scheduler:
+        snapshot["scheduler"] = scheduler.snapshot()
+    return jsonify(snapshot)
+
+
 if __name__ == '__main__':
     # 初始化服务
     if not init_services():
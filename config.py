@@ -19,7 +19,20 @@ class Config:
     # GCP Vertex AI 配置
     GCP_PROJECT_ID = os.getenv('GCP_PROJECT_ID', '')
     GCP_LOCATION = os.getenv('GCP_LOCATION', 'us-central1')
-    MODEL_NAME = 'gemini-2.5-flash'
+    MODEL_NAME = os.getenv('MODEL_NAME', 'gemini-2.5-flash')
+    
+    # 模型路由：简单问题使用 lite 模型，复杂问题使用 pro 模型
+    MODEL_ROUTING_ENABLED = os.getenv('MODEL_ROUTING_ENABLED', 'True').lower() == 'true'
+    MODEL_LITE = os.getenv('MODEL_LITE', 'gemini-2.5-flash-lite')
+    MODEL_PRO = os.getenv('MODEL_PRO', 'gemini-2.5-pro')
+    
+    # 思考预算（Gemini 2.5）：0 表示关闭思考，pro 模型不能关闭，最小为 128
+    THINKING_BUDGET_LITE = int(os.getenv('THINKING_BUDGET_LITE', 0))
+    THINKING_BUDGET_FLASH = int(os.getenv('THINKING_BUDGET_FLASH', 0))
+    THINKING_BUDGET_PRO = int(os.getenv('THINKING_BUDGET_PRO', 1024))
+    # 按问题类型自动寻找能保持回答非空的最小思考预算
+    THINKING_AUTOTUNE = os.getenv('THINKING_AUTOTUNE', 'False').lower() == 'true'
+    THINKING_PROBE_INTERVAL = int(os.getenv('THINKING_PROBE_INTERVAL', 50))
     
     # Google Cloud 认证
     GOOGLE_APPLICATION_CREDENTIALS = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', '')
@@ -30,10 +43,154 @@ class Config:
     
     # 日志配置
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_JSON = os.getenv('LOG_JSON', 'False').lower() == 'true'
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0.01))
+    LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', 2000))
+    LOG_TEXT_MAX_CHARS = int(os.getenv('LOG_TEXT_MAX_CHARS', 200))
     
-    # 超时配置
+    # 超时配置：REQUEST_TIMEOUT 是从收到 webhook 起整个请求的截止时间，
+    # AI_TIMEOUT 是单次生成的上限；gunicorn 的 worker 超时在此基础上留出余量
     REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', 30))
     AI_TIMEOUT = int(os.getenv('AI_TIMEOUT', 15))
+    # 为发送回答预留的时间，以及截止时间已到时发送仍可使用的最短超时
+    DEADLINE_SEND_RESERVE = float(os.getenv('DEADLINE_SEND_RESERVE', 3.0))
+    DEADLINE_MIN_SEND_TIMEOUT = float(os.getenv('DEADLINE_MIN_SEND_TIMEOUT', 2.0))
+    # 生成超时但已有部分内容时，附在回答末尾的说明
+    DEADLINE_PARTIAL_NOTICE = os.getenv('DEADLINE_PARTIAL_NOTICE', '\n\n（回答时间过长，以上为已生成的部分内容）')
+    
+    # 连接池配置
+    HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 10))
+    HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 20))
+    
+    # Worker 预热配置
+    WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'True').lower() == 'true'
+    WARMUP_PRIMING = os.getenv('WARMUP_PRIMING', 'False').lower() == 'true'
+    WARMUP_TIMEOUT = int(os.getenv('WARMUP_TIMEOUT', 5))
+    
+    # 回答超过阈值仍未生成完成时，先发送一条确认消息
+    INTERIM_ACK_ENABLED = os.getenv('INTERIM_ACK_ENABLED', 'True').lower() == 'true'
+    INTERIM_ACK_SECONDS = float(os.getenv('INTERIM_ACK_SECONDS', 3.0))
+    INTERIM_ACK_TEXT = os.getenv('INTERIM_ACK_TEXT', '正在思考…')
+    
+    # 后台健康探测
+    HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', 30))
+    HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT', 5))
+    
+    # 回复通道：sessionWebhook 缓存、自定义机器人 robot/send 限额、OpenAPI 应用凭证（可选）；
+    # robot/send 只能发到自定义机器人所在的群，DINGTALK_ROBOT_CONVERSATION_ID 为该群的 conversationId
+    SESSION_WEBHOOK_CACHE_SIZE = int(os.getenv('SESSION_WEBHOOK_CACHE_SIZE', 10000))
+    SESSION_WEBHOOK_EXPIRY_MARGIN = float(os.getenv('SESSION_WEBHOOK_EXPIRY_MARGIN', 30))
+    ROBOT_SEND_PER_MINUTE = int(os.getenv('ROBOT_SEND_PER_MINUTE', 20))
+    DINGTALK_ROBOT_CONVERSATION_ID = os.getenv('DINGTALK_ROBOT_CONVERSATION_ID', '')
+    DINGTALK_APP_KEY = os.getenv('DINGTALK_APP_KEY', '')
+    DINGTALK_APP_SECRET = os.getenv('DINGTALK_APP_SECRET', '')
+    DINGTALK_ROBOT_CODE = os.getenv('DINGTALK_ROBOT_CODE', '')
+    
+    # 图片和文件消息：下载大小上限、图片缩放后的长边像素和 JPEG 质量、处理线程数、处理结果缓存字节数
+    MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', 20 * 1024 * 1024))
+    IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 1536))
+    IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 85))
+    MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', 2))
+    MEDIA_CACHE_BYTES = int(os.getenv('MEDIA_CACHE_BYTES', 64 * 1024 * 1024))
+    MEDIA_DEFAULT_PROMPT = os.getenv('MEDIA_DEFAULT_PROMPT', '请描述并解读这份内容。')
+    
+    # 内部文档检索增强：文档目录、索引目录、每次放入提示的文档块数和最低相似度、切分长度、哈希维度、后台增量重建间隔（秒，0 表示不重建）
+    RAG_ENABLED = os.getenv('RAG_ENABLED', 'False').lower() == 'true'
+    RAG_DOCS_DIR = os.getenv('RAG_DOCS_DIR', 'docs')
+    RAG_INDEX_DIR = os.getenv('RAG_INDEX_DIR', '.rag_index')
+    RAG_TOP_K = int(os.getenv('RAG_TOP_K', 3))
+    RAG_MIN_SCORE = float(os.getenv('RAG_MIN_SCORE', 0.15))
+    RAG_MAX_CONTEXT_CHARS = int(os.getenv('RAG_MAX_CONTEXT_CHARS', 2400))
+    RAG_CHUNK_CHARS = int(os.getenv('RAG_CHUNK_CHARS', 600))
+    RAG_CHUNK_OVERLAP = int(os.getenv('RAG_CHUNK_OVERLAP', 80))
+    RAG_HASH_DIM = int(os.getenv('RAG_HASH_DIM', 2 ** 18))
+    RAG_REINDEX_INTERVAL = float(os.getenv('RAG_REINDEX_INTERVAL', 300))
+    
+    # 常见问题快速回答：人工整理的问答文件、问到多少次后自动缓存回答（0 表示不学习）、学习答案有效期（秒）、
+    # 最多缓存的问题数，以及提前刷新的时间窗口（秒）、最少命中次数、每轮最多刷新数和检查间隔（秒）
+    FAQ_ENABLED = os.getenv('FAQ_ENABLED', 'True').lower() == 'true'
+    FAQ_FILE = os.getenv('FAQ_FILE', '')
+    FAQ_LEARN_THRESHOLD = int(os.getenv('FAQ_LEARN_THRESHOLD', 3))
+    FAQ_TTL = float(os.getenv('FAQ_TTL', 3600))
+    FAQ_MAX_ENTRIES = int(os.getenv('FAQ_MAX_ENTRIES', 1000))
+    FAQ_REFRESH_AHEAD = float(os.getenv('FAQ_REFRESH_AHEAD', 300))
+    FAQ_REFRESH_MIN_HITS = int(os.getenv('FAQ_REFRESH_MIN_HITS', 2))
+    FAQ_REFRESH_BATCH = int(os.getenv('FAQ_REFRESH_BATCH', 10))
+    FAQ_REFRESH_INTERVAL = float(os.getenv('FAQ_REFRESH_INTERVAL', 60))
+    
+    # 对话历史：SQLite 数据库路径、进程内缓存的会话数、每个会话保留的记录数（一问一答为两条）、
+    # 放进请求的历史字符数上限、记录保留时间（秒）和后台压缩间隔（秒）
+    HISTORY_ENABLED = os.getenv('HISTORY_ENABLED', 'True').lower() == 'true'
+    HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', 'data/conversations.db')
+    HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', 2000))
+    HISTORY_MAX_TURNS = int(os.getenv('HISTORY_MAX_TURNS', 20))
+    HISTORY_CONTEXT_CHARS = int(os.getenv('HISTORY_CONTEXT_CHARS', 4000))
+    HISTORY_RETENTION_SECONDS = float(os.getenv('HISTORY_RETENTION_SECONDS', 7 * 24 * 3600))
+    HISTORY_COMPACT_INTERVAL = float(os.getenv('HISTORY_COMPACT_INTERVAL', 600))
+    
+    # Stream 模式（complete_bot.py）：通过长连接接收消息代替 HTTP 回调；处理线程数、WebSocket ping 间隔和超时（秒）、重连退避范围（秒）
+    DINGTALK_STREAM_MODE = os.getenv('DINGTALK_STREAM_MODE', 'False').lower() == 'true'
+    STREAM_WORKERS = int(os.getenv('STREAM_WORKERS', 8))
+    STREAM_PING_INTERVAL = float(os.getenv('STREAM_PING_INTERVAL', 30))
+    STREAM_PING_TIMEOUT = float(os.getenv('STREAM_PING_TIMEOUT', 10))
+    STREAM_RECONNECT_MIN = float(os.getenv('STREAM_RECONNECT_MIN', 1))
+    STREAM_RECONNECT_MAX = float(os.getenv('STREAM_RECONNECT_MAX', 60))
+    
+    # 准入控制：预计回答时间（已排队时间 + 估算的等待）超过 ADMISSION_MAX_WAIT 秒，或进程内正在生成的请求数
+    # 达到 ADMISSION_MAX_IN_FLIGHT 时直接回复繁忙提示；ADMISSION_CONCURRENCY 是估算等待时假设的上游并行数
+    ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'True').lower() == 'true'
+    ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 20))
+    ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 32))
+    ADMISSION_CONCURRENCY = int(os.getenv('ADMISSION_CONCURRENCY', 4))
+    BUSY_REPLY_TEXT = os.getenv('BUSY_REPLY_TEXT', '当前繁忙，请稍后再试。')
+    
+    # 生成调度：进程内同时生成的请求数，超出时按优先级排队（单聊优先、开销小的优先、VIP 群优先），
+    # 排队每满 SCHEDULER_AGING_SECONDS 秒优先级提高 1；VIP 群为逗号分隔的 conversationId
+    SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'True').lower() == 'true'
+    SCHEDULER_SLOTS = int(os.getenv('SCHEDULER_SLOTS', 4))
+    SCHEDULER_AGING_SECONDS = float(os.getenv('SCHEDULER_AGING_SECONDS', 5))
+    SCHEDULER_LONG_INPUT_TOKENS = int(os.getenv('SCHEDULER_LONG_INPUT_TOKENS', 500))
+    SCHEDULER_VIP_GROUPS = [group.strip() for group in os.getenv('SCHEDULER_VIP_GROUPS', '').split(',') if group.strip()]
+    SCHEDULER_VIP_BOOST = float(os.getenv('SCHEDULER_VIP_BOOST', 2))
+    # 会话之间加权公平排队的权重，格式为 conversationId:权重，逗号分隔，未列出的会话权重为 1
+    SCHEDULER_GROUP_WEIGHTS = {
+        key.strip(): float(value)
+        for key, _, value in (item.partition(':') for item in os.getenv('SCHEDULER_GROUP_WEIGHTS', '').split(','))
+        if key.strip() and value.strip()
+    }
+    
+    # gunicorn：gthread worker 数和每个 worker 的线程数；线程数要多于 SCHEDULER_SLOTS，超出名额的请求才会排队等待调度，
+    # 同时生成的请求总数为 GUNICORN_WORKERS × SCHEDULER_SLOTS
+    GUNICORN_WORKERS = int(os.getenv('GUNICORN_WORKERS', 2))
+    GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', 0)) or SCHEDULER_SLOTS * 2
+    
+    # 消息合并（Stream 模式）：同一发送者连续发来的文本消息等待片刻合并为一条再回答；
+    # 没有打字节奏记录时的等待窗口，以及按打字节奏自适应的上下限（秒）
+    DEBOUNCE_ENABLED = os.getenv('DEBOUNCE_ENABLED', 'True').lower() == 'true'
+    DEBOUNCE_WINDOW = float(os.getenv('DEBOUNCE_WINDOW', 1.2))
+    DEBOUNCE_MIN = float(os.getenv('DEBOUNCE_MIN', 0.5))
+    DEBOUNCE_MAX = float(os.getenv('DEBOUNCE_MAX', 3.0))
+    
+    # 生成取消：取消指令（"算了"、"取消"等）或同一发送者在生成开始后 CANCEL_SUPERSEDE_WINDOW 秒内的新消息
+    # 中止正在进行的生成和尚未发出的回复；worker 之间通过共享内存信号槽（CANCEL_SLOTS）每 CANCEL_POLL_INTERVAL 秒同步
+    CANCEL_ENABLED = os.getenv('CANCEL_ENABLED', 'True').lower() == 'true'
+    CANCEL_SUPERSEDE_WINDOW = float(os.getenv('CANCEL_SUPERSEDE_WINDOW', 15))
+    CANCEL_POLL_INTERVAL = float(os.getenv('CANCEL_POLL_INTERVAL', 0.1))
+    CANCEL_SLOTS = int(os.getenv('CANCEL_SLOTS', 65536))
+    CANCEL_REPLY_TEXT = os.getenv('CANCEL_REPLY_TEXT', '好的，已停止回答。')
+    
+    # 多机器人：JSON 配置文件路径（格式见 tenants.example.json），以及按 quota_share 分配的 Gemini 总调用速率
+    TENANTS_FILE = os.getenv('TENANTS_FILE', '')
+    GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', 600))
+    
+    # 钉钉单条消息最大字节数，超长回复按段落/句子分段发送
+    DINGTALK_MAX_MESSAGE_BYTES = int(os.getenv('DINGTALK_MAX_MESSAGE_BYTES', 6000))
+    
+    # Token 预算配置（本地估算）
+    MAX_INPUT_TOKENS = int(os.getenv('MAX_INPUT_TOKENS', 8000))
+    MAX_OUTPUT_TOKENS = int(os.getenv('MAX_OUTPUT_TOKENS', 4096))
+    CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 16000))
 
 class DevelopmentConfig(Config):
     """开发环境配置"""
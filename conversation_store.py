@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对话历史持久化模块
+每轮问答追加写入 SQLite（WAL 模式，多个 gunicorn worker 可以同时读写），较长的内容用 zlib 压缩保存；
+worker 回收或重新部署后，会话的最近几轮在首次访问时从数据库加载，之后使用进程内缓存。
+后台线程定期压缩：删除过期会话和超出保留轮数的旧记录，并回收数据库空间
+"""
+
+import os
+import re
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from config import Config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ROLE_USER = "user"
+ROLE_MODEL = "model"
+
+# 超过该字节数的内容压缩保存
+_COMPRESS_MIN_BYTES = 256
+_CODEC_PLAIN = 0
+_CODEC_ZLIB = 1
+
+# 清除上下文的指令
+_RESET_RE = re.compile(r'^\s*(/reset|/clear|清除上下文|清空上下文|重新开始|新话题)\s*$', re.I)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation TEXT NOT NULL,
+    role TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    codec INTEGER NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_turns_conversation ON turns (conversation, id);
+"""
+
+
+class Turn(NamedTuple):
+    """一条对话记录"""
+    role: str
+    text: str
+
+
+def conversation_key(data: Dict[str, Any]) -> str:
+    """
+    确定 webhook 消息所属的对话：单聊按会话，群聊中每个成员与机器人的对话分开
+
+    Args:
+        data: webhook 消息
+
+    Returns:
+        str: 对话标识，无法确定时为空字符串
+    """
+    conversation_id = data.get('conversationId', '')
+    if not conversation_id or str(data.get('conversationType', '')) == "1":
+        return conversation_id
+    return f"{conversation_id}:{data.get('senderStaffId') or data.get('senderId', '')}"
+
+
+def is_reset_command(text: str) -> bool:
+    """判断消息是否为清除上下文的指令"""
+    return bool(_RESET_RE.match(text))
+
+
+def _encode(text: str) -> Tuple[int, bytes]:
+    raw = text.encode('utf-8')
+    if len(raw) >= _COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(raw, 6)
+        if len(compressed) < len(raw):
+            return _CODEC_ZLIB, compressed
+    return _CODEC_PLAIN, raw
+
+
+def _decode(codec: int, body: bytes) -> str:
+    if codec == _CODEC_ZLIB:
+        body = zlib.decompress(body)
+    return bytes(body).decode('utf-8')
+
+
+class ConversationStore:
+    """对话历史存储：SQLite 追加写入，最近访问的会话缓存在进程内"""
+
+    def __init__(self, path: Optional[str] = None, cache_size: Optional[int] = None, max_turns: Optional[int] = None):
+        """
+        Args:
+            path: 数据库文件路径，默认读取 HISTORY_DB_PATH
+            cache_size: 进程内缓存的会话数，默认读取 HISTORY_CACHE_SIZE
+            max_turns: 每个会话加载和保留的最近记录数（一问一答为两条），默认读取 HISTORY_MAX_TURNS
+        """
+        self.path = path or Config.HISTORY_DB_PATH
+        self.cache_size = cache_size or Config.HISTORY_CACHE_SIZE
+        self.max_turns = max_turns or Config.HISTORY_MAX_TURNS
+        # 缓存的会话历史，以及对应的最后一条记录ID（用于发现其他 worker 写入的新记录）
+        self._cache: "OrderedDict[str, Tuple[int, List[Turn]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._local = threading.local()
+        self._thread_pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        with connection:
+            connection.executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """每个线程一个连接；gunicorn fork 后在子进程中重新建立"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # 新建数据库时启用增量回收空间，必须在建表之前设置
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _load(self, conversation: str) -> Tuple[int, List[Turn]]:
+        rows = self._connection().execute(
+            "SELECT id, role, codec, body FROM turns WHERE conversation = ? ORDER BY id DESC LIMIT ?",
+            (conversation, self.max_turns)
+        ).fetchall()
+        rows.reverse()
+        last_id = rows[-1][0] if rows else 0
+        return last_id, [Turn(role, _decode(codec, body)) for _, role, codec, body in rows]
+
+    def _cache_put(self, conversation: str, last_id: int, turns: List[Turn]):
+        with self._cache_lock:
+            self._cache[conversation] = (last_id, turns)
+            self._cache.move_to_end(conversation)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def history(self, conversation: str) -> List[Turn]:
+        """
+        获取会话的最近几轮对话，首次访问时从数据库加载
+
+        Args:
+            conversation: 对话标识
+
+        Returns:
+            list: 按时间顺序排列的对话记录
+        """
+        if not conversation:
+            return []
+        start_time = time.perf_counter()
+        with self._cache_lock:
+            cached = self._cache.get(conversation)
+        try:
+            # 同一会话的消息可能由其他 worker 处理，用最后一条记录ID判断缓存是否仍然最新
+            row = self._connection().execute(
+                "SELECT MAX(id) FROM turns WHERE conversation = ?", (conversation,)
+            ).fetchone()
+            latest_id = row[0] or 0
+            if cached is not None and cached[0] == latest_id:
+                metrics.inc("history_cache_hits")
+                return list(cached[1])
+            last_id, turns = self._load(conversation)
+        except sqlite3.Error as e:
+            # 数据库暂时不可用时不带历史回答
+            logger.error(f"读取对话历史失败: {e}")
+            return list(cached[1]) if cached is not None else []
+
+        self._cache_put(conversation, last_id, turns)
+        metrics.inc("history_loads")
+        metrics.observe("history_load_seconds", time.perf_counter() - start_time)
+        return list(turns)
+
+    def append(self, conversation: str, question: str, answer: str):
+        """
+        追加一轮问答
+
+        Args:
+            conversation: 对话标识
+            question: 用户问题
+            answer: 模型回答
+        """
+        if not conversation:
+            return
+        self.start()
+        now = time.time()
+        rows = []
+        for role, text in ((ROLE_USER, question), (ROLE_MODEL, answer)):
+            codec, body = _encode(text)
+            rows.append((conversation, role, now, codec, body))
+
+        with self._cache_lock:
+            cached = self._cache.get(conversation)
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                previous_id = connection.execute(
+                    "SELECT MAX(id) FROM turns WHERE conversation = ?", (conversation,)
+                ).fetchone()[0] or 0
+                connection.executemany(
+                    "INSERT INTO turns (conversation, role, created_at, codec, body) VALUES (?, ?, ?, ?, ?)", rows
+                )
+                last_id = connection.execute("SELECT last_insert_rowid()").fetchone()[0]
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.error(f"保存对话历史失败: {e}")
+            return
+
+        # 缓存原本就是最新的才直接追加，否则下次访问时重新加载
+        if cached is not None and cached[0] == previous_id:
+            turns = (cached[1] + [Turn(ROLE_USER, question), Turn(ROLE_MODEL, answer)])[-self.max_turns:]
+            self._cache_put(conversation, last_id, turns)
+        metrics.inc("history_appends")
+
+    def clear(self, conversation: str):
+        """清除会话的全部历史"""
+        self._connection().execute("DELETE FROM turns WHERE conversation = ?", (conversation,))
+        with self._cache_lock:
+            self._cache.pop(conversation, None)
+
+    def compact(self, retention_seconds: Optional[float] = None) -> int:
+        """
+        压缩存储：删除超过保留期的记录和每个会话超出 max_turns 的旧记录，并回收空间
+
+        Args:
+            retention_seconds: 记录保留时间（秒），默认读取 HISTORY_RETENTION_SECONDS
+
+        Returns:
+            int: 删除的记录数
+        """
+        retention_seconds = retention_seconds or Config.HISTORY_RETENTION_SECONDS
+        start_time = time.time()
+        connection = self._connection()
+        deleted = connection.execute(
+            "DELETE FROM turns WHERE created_at < ?", (start_time - retention_seconds,)
+        ).rowcount
+        deleted += connection.execute(
+            """
+            DELETE FROM turns WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY conversation ORDER BY id DESC) AS rank FROM turns
+                ) WHERE rank > ?
+            )
+            """,
+            (self.max_turns,)
+        ).rowcount
+        if deleted:
+            connection.execute("PRAGMA incremental_vacuum")
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        metrics.inc("history_compacted_turns", deleted)
+        metrics.observe("history_compact_seconds", time.time() - start_time)
+        if deleted:
+            logger.info("对话历史压缩完成，删除 %d 条记录", deleted)
+        return deleted
+
+    def _run(self):
+        while True:
+            time.sleep(Config.HISTORY_COMPACT_INTERVAL)
+            try:
+                self.compact()
+            except sqlite3.Error as e:
+                logger.error(f"压缩对话历史失败: {e}")
+
+    def start(self):
+        """启动后台压缩线程；gunicorn fork 出的 worker 中会重新启动"""
+        pid = os.getpid()
+        if self._thread_pid == pid:
+            return
+        with self._lock:
+            if self._thread_pid == pid:
+                return
+            threading.Thread(target=self._run, name='history-compact', daemon=True).start()
+            self._thread_pid = pid
+
+
+def select_context(history: List[Turn], max_chars: Optional[int] = None) -> List[Turn]:
+    """
+    从最近的记录往前选取放进请求的对话历史，总长度不超过 max_chars，且从用户提问开始
+
+    Args:
+        history: 对话记录
+        max_chars: 历史内容的最大字符数，默认读取 HISTORY_CONTEXT_CHARS
+
+    Returns:
+        list: 选中的对话记录
+    """
+    max_chars = max_chars or Config.HISTORY_CONTEXT_CHARS
+    selected: List[Turn] = []
+    used = 0
+    for turn in reversed(history):
+        used += len(turn.text)
+        if used > max_chars:
+            break
+        selected.append(turn)
+    selected.reverse()
+    # Gemini 要求对话以用户提问开始、两种角色交替
+    while selected and selected[0].role != ROLE_USER:
+        selected.pop(0)
+    return selected
+
+
+# 进程级全局存储
+_store: Optional[ConversationStore] = None
+_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> Optional[ConversationStore]:
+    """获取全局对话历史存储，未启用 HISTORY_ENABLED 或数据库无法打开时返回 None"""
+    global _store
+
+    if not Config.HISTORY_ENABLED:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                try:
+                    store = ConversationStore()
+                except (OSError, sqlite3.Error) as e:
+                    logger.error(f"打开对话历史数据库失败: {e}")
+                    return None
+                store.start()
+                _store = store
+    return _store
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求截止时间模块
+每个 webhook 请求在收到时创建一个截止时间，令牌刷新、模型生成和消息发送都从剩余时间中
+计算各自的超时，保证整个请求在 gunicorn 杀掉 worker 之前结束
+"""
+
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求截止时间已到"""
+
+
+class Deadline:
+    """单个请求的截止时间"""
+
+    def __init__(self, seconds: float):
+        """
+        Args:
+            seconds: 从现在起的可用时间（秒）
+        """
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """剩余时间（秒），已过期时为负数"""
+        return self.expires_at - time.monotonic()
+
+    def expired(self, reserve: float = 0.0) -> bool:
+        """
+        是否已经（或在预留时间内即将）到期
+
+        Args:
+            reserve: 需要为后续步骤预留的时间（秒）
+        """
+        return self.remaining() <= reserve
+
+    def timeout(self, cap: Optional[float] = None, reserve: float = 0.0) -> float:
+        """
+        计算某一步骤可用的超时时间
+
+        Args:
+            cap: 该步骤自身的超时上限
+            reserve: 需要为后续步骤预留的时间（秒）
+
+        Returns:
+            float: 超时时间（秒）
+
+        Raises:
+            DeadlineExceeded: 剩余时间不足
+        """
+        available = self.remaining() - reserve
+        if available <= 0:
+            raise DeadlineExceeded(f"请求已超过截止时间（{self.seconds:.0f}秒）")
+        return available if cap is None else min(cap, available)
+
+
+# 当前请求的截止时间
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar('deadline', default=None)
+
+
+def get_deadline() -> Optional[Deadline]:
+    """获取当前请求的截止时间，不在请求中时为 None"""
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float] = None) -> Iterator[Deadline]:
+    """
+    在 with 块内设置当前截止时间
+
+    Args:
+        seconds: 可用时间（秒），默认读取 REQUEST_TIMEOUT
+    """
+    deadline = Deadline(Config.REQUEST_TIMEOUT if seconds is None else seconds)
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def generation_timeout(default: Optional[float] = None) -> float:
+    """
+    模型生成可用的超时时间：不超过 AI_TIMEOUT，并为发送回答预留 DEADLINE_SEND_RESERVE
+
+    Args:
+        default: 不在请求中时使用的超时，默认 AI_TIMEOUT
+
+    Raises:
+        DeadlineExceeded: 剩余时间不足
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return Config.AI_TIMEOUT if default is None else default
+    return deadline.timeout(Config.AI_TIMEOUT, reserve=Config.DEADLINE_SEND_RESERVE)
+
+
+def send_timeout(cap: float = 10.0) -> float:
+    """
+    发送消息可用的超时时间
+
+    回答已经生成，即使截止时间已到也至少给发送留出 DEADLINE_MIN_SEND_TIMEOUT，
+    避免生成的内容被丢弃
+
+    Args:
+        cap: 发送请求自身的超时上限
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return cap
+    return min(cap, max(deadline.remaining(), Config.DEADLINE_MIN_SEND_TIMEOUT))
+
+
+def register_request_deadline(app, endpoints: Optional[set] = None):
+    """
+    为 Flask 应用的请求设置截止时间：收到请求时开始计时，请求结束时清除
+
+    Args:
+        app: Flask 应用
+        endpoints: 需要设置截止时间的端点名，默认所有请求
+    """
+    from flask import request
+
+    @app.before_request
+    def _start_deadline():
+        if endpoints is None or request.endpoint in endpoints:
+            _current.set(Deadline(Config.REQUEST_TIMEOUT))
+
+    @app.teardown_request
+    def _clear_deadline(exc):
+        _current.set(None)
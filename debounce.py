@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+消息合并模块
+用户经常把一个问题分成几条消息连续发出，每条都单独生成回答既浪费调用次数又刷屏。
+同一会话中同一发送者的文本消息先缓存，等待窗口内没有新消息后合并成一条再处理，只生成一个回答。
+
+等待窗口按每个发送者的打字节奏自适应：记录连续消息间隔的加权平均，窗口取其 1.5 倍，
+限制在 DEBOUNCE_MIN～DEBOUNCE_MAX 秒之间；从第一条消息算起最多等待 2 倍 DEBOUNCE_MAX。
+图片、文件以及清除上下文等指令不等待，先处理已缓存的消息，再立即处理该消息；
+取消指令丢弃该发送者已缓存的消息，只处理取消指令本身
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from cancellation import is_cancel_command
+from config import Config
+from conversation_store import is_reset_command
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 打字间隔的加权平均系数
+_CADENCE_ALPHA = 0.3
+# 记录打字节奏的发送者数
+_CADENCE_SIZE = 4096
+
+
+def sender_key(data: Dict[str, Any]) -> Tuple[str, str]:
+    """消息的合并键：(会话ID, 发送者)"""
+    return data.get('conversationId', ''), data.get('senderStaffId') or data.get('senderId', '')
+
+
+def merge_messages(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    把连续的文本消息合并为一条：内容按行拼接，回复地址等取最后一条，
+    createAt 取第一条（准入控制按最早的消息计算排队时间）
+
+    Args:
+        messages: 按时间顺序排列的文本消息
+
+    Returns:
+        dict: 合并后的消息
+    """
+    if len(messages) == 1:
+        return messages[0]
+    merged = dict(messages[-1])
+    merged['text'] = dict(merged.get('text') or {})
+    merged['text']['content'] = "\n".join(
+        (message.get('text') or {}).get('content', '').strip() for message in messages
+    )
+    if messages[0].get('createAt'):
+        merged['createAt'] = messages[0]['createAt']
+    return merged
+
+
+class _Pending:
+    """一个发送者尚未处理的消息"""
+
+    __slots__ = ('messages', 'first_at', 'timer')
+
+    def __init__(self, now: float):
+        self.messages: List[Dict[str, Any]] = []
+        self.first_at = now
+        self.timer: Optional[threading.Timer] = None
+
+
+class MessageDebouncer:
+    """按 (会话, 发送者) 合并连续文本消息"""
+
+    def __init__(
+        self,
+        dispatch: Callable[[Dict[str, Any]], Any],
+        window: Optional[float] = None,
+        min_window: Optional[float] = None,
+        max_window: Optional[float] = None
+    ):
+        """
+        Args:
+            dispatch: 处理消息的函数，参数为（合并后的）消息
+            window: 没有打字节奏记录时的等待窗口（秒），默认读取 DEBOUNCE_WINDOW
+            min_window: 等待窗口下限（秒），默认读取 DEBOUNCE_MIN
+            max_window: 等待窗口上限（秒），默认读取 DEBOUNCE_MAX
+        """
+        self.dispatch = dispatch
+        self.window = window or Config.DEBOUNCE_WINDOW
+        self.min_window = min_window or Config.DEBOUNCE_MIN
+        self.max_window = max_window or Config.DEBOUNCE_MAX
+        self._pending: Dict[Tuple[str, str], _Pending] = {}
+        # 发送者 -> (连续消息间隔的加权平均, 上一条消息的时间)
+        self._cadence: "OrderedDict[Tuple[str, str], Tuple[Optional[float], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def window_for(self, key: Tuple[str, str]) -> float:
+        """发送者当前的等待窗口（秒）"""
+        gap = self._cadence.get(key, (None, 0.0))[0]
+        if gap is None:
+            return self.window
+        return min(max(gap * 1.5, self.min_window), self.max_window)
+
+    def _record_cadence(self, key: Tuple[str, str], now: float):
+        gap, last_at = self._cadence.get(key, (None, 0.0))
+        interval = now - last_at
+        # 只统计连续输入时的间隔，停顿很久之后的新消息不计入
+        if last_at and interval <= 2 * self.max_window:
+            gap = interval if gap is None else _CADENCE_ALPHA * interval + (1 - _CADENCE_ALPHA) * gap
+        self._cadence[key] = (gap, now)
+        self._cadence.move_to_end(key)
+        while len(self._cadence) > _CADENCE_SIZE:
+            self._cadence.popitem(last=False)
+
+    def _should_wait(self, data: Dict[str, Any]) -> bool:
+        if data.get('msgtype') != 'text':
+            return False
+        content = (data.get('text') or {}).get('content', '')
+        return not (is_reset_command(content) or is_cancel_command(content))
+
+    def offer(self, data: Dict[str, Any]):
+        """
+        提交一条消息：文本消息等待合并，其他消息立即处理，取消指令丢弃已缓存的消息
+
+        Args:
+            data: 机器人消息
+        """
+        key = sender_key(data)
+        now = time.monotonic()
+        with self._lock:
+            self._record_cadence(key, now)
+            pending = self._pending.get(key)
+            if not self._should_wait(data):
+                flushed = self._take(key) if pending else None
+                if flushed and is_cancel_command((data.get('text') or {}).get('content', '')):
+                    logger.info("收到取消指令，丢弃 %d 条未处理的消息", len(flushed))
+                    flushed = None
+            else:
+                if pending is None:
+                    pending = self._pending[key] = _Pending(now)
+                elif pending.timer is not None:
+                    pending.timer.cancel()
+                pending.messages.append(data)
+                delay = min(self.window_for(key), pending.first_at + 2 * self.max_window - now)
+                pending.timer = threading.Timer(max(delay, 0.0), self._flush, args=(key, pending))
+                pending.timer.daemon = True
+                pending.timer.start()
+                return
+
+        if flushed:
+            self._dispatch(flushed)
+        self.dispatch(data)
+
+    def _take(self, key: Tuple[str, str]) -> List[Dict[str, Any]]:
+        """取出发送者缓存的消息（调用方持有锁）"""
+        pending = self._pending.pop(key)
+        if pending.timer is not None:
+            pending.timer.cancel()
+        return pending.messages
+
+    def _flush(self, key: Tuple[str, str], pending: _Pending):
+        with self._lock:
+            # 计时器触发前可能已被新消息或其他消息类型取走
+            if self._pending.get(key) is not pending:
+                return
+            messages = self._take(key)
+        self._dispatch(messages)
+
+    def _dispatch(self, messages: List[Dict[str, Any]]):
+        if len(messages) > 1:
+            metrics.inc("debounce_merged", len(messages) - 1)
+            logger.info("合并了 %d 条连续消息", len(messages))
+        try:
+            self.dispatch(merge_messages(messages))
+        except Exception as e:
+            logger.error("处理合并后的消息失败: %s", e)
+
+    @property
+    def pending(self) -> int:
+        """等待合并的发送者数"""
+        return len(self._pending)
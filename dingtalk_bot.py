@@ -11,13 +11,19 @@ import hmac
 import hashlib
 import base64
 import urllib.parse
-import requests
 import logging
 from datetime import datetime
 from typing import Optional, List
 
 from dotenv import load_dotenv
 
+from config import Config
+from deadline import send_timeout
+from http_pool import get_session
+from json_codec import dumps, loads
+from message_segmenter import send_in_segments
+from gemini_simple import SimpleGeminiClient, EMPTY_REPLY, NOT_INITIALIZED_REPLY, UNAVAILABLE_REPLY
+
 # 加载环境变量
 load_dotenv()
 
@@ -28,6 +34,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 本脚本原有的失败提示语
+_LEGACY_REPLIES = {
+    NOT_INITIALIZED_REPLY: "AI服务未初始化",
+    EMPTY_REPLY: "抱歉，我无法处理这个问题。",
+    UNAVAILABLE_REPLY: "抱歉，AI服务暂时不可用。",
+}
+
 
 class DingTalkBot:
     """钉钉机器人消息发送类"""
@@ -48,7 +61,9 @@ class DingTalkBot:
         msg: str, 
         at_user_ids: Optional[List[str]] = None,
         at_mobiles: Optional[List[str]] = None,
-        is_at_all: bool = False
+        is_at_all: bool = False,
+        msgtype: str = "text",
+        title: str = "AI助手回复"
     ) -> dict:
         """
         发送钉钉自定义机器人群消息
@@ -58,127 +73,134 @@ class DingTalkBot:
             at_user_ids: @的用户ID列表
             at_mobiles: @的手机号列表
             is_at_all: 是否@所有人
+            msgtype: 消息类型，text 或 markdown
+            title: markdown 消息的会话列表标题
             
         Returns:
             dict: 钉钉API响应
         """
-        try:
-            # 构建请求URL
-            url = f'https://oapi.dingtalk.com/robot/send?access_token={self.access_token}'
-            
-            # 如果有secret，添加签名
-            if self.secret:
-                timestamp = str(round(time.time() * 1000))
-                string_to_sign = f'{timestamp}\n{self.secret}'
-                hmac_code = hmac.new(
-                    self.secret.encode('utf-8'), 
-                    string_to_sign.encode('utf-8'), 
-                    digestmod=hashlib.sha256
-                ).digest()
-                sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
-                url += f'&timestamp={timestamp}&sign={sign}'
-            
-            # 构建消息体
-            body = {
-                "at": {
-                    "isAtAll": is_at_all,
-                    "atUserIds": at_user_ids or [],
-                    "atMobiles": at_mobiles or []
-                },
-                "text": {
-                    "content": msg
-                },
-                "msgtype": "text"
-            }
+        # 构建请求URL
+        url = f'https://oapi.dingtalk.com/robot/send?access_token={self.access_token}'
+        
+        # 如果有secret，添加签名
+        if self.secret:
+            timestamp = str(round(time.time() * 1000))
+            string_to_sign = f'{timestamp}\n{self.secret}'
+            hmac_code = hmac.new(
+                self.secret.encode('utf-8'), 
+                string_to_sign.encode('utf-8'), 
+                digestmod=hashlib.sha256
+            ).digest()
+            sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
+            url += f'&timestamp={timestamp}&sign={sign}'
+        
+        return self._post(url, self._build_body(msg, at_user_ids, at_mobiles, is_at_all, msgtype, title))
+    
+    def send_session_message(
+        self, 
+        session_webhook: str,
+        msg: str, 
+        at_user_ids: Optional[List[str]] = None,
+        msgtype: str = "text",
+        title: str = "AI助手回复"
+    ) -> dict:
+        """
+        通过会话的 sessionWebhook 回复消息，无需 access_token 和签名，也不占用 robot/send 的限额
+        
+        Args:
+            session_webhook: webhook 消息中的 sessionWebhook
+            msg: 消息内容
+            at_user_ids: @的用户ID列表
+            msgtype: 消息类型，text 或 markdown
+            title: markdown 消息的会话列表标题
             
-            # 发送请求
+        Returns:
+            dict: 钉钉API响应
+        """
+        return self._post(session_webhook, self._build_body(msg, at_user_ids, None, False, msgtype, title))
+    
+    @staticmethod
+    def _build_body(
+        msg: str, 
+        at_user_ids: Optional[List[str]],
+        at_mobiles: Optional[List[str]],
+        is_at_all: bool,
+        msgtype: str,
+        title: str
+    ) -> dict:
+        """构建消息体"""
+        body = {
+            "at": {
+                "isAtAll": is_at_all,
+                "atUserIds": at_user_ids or [],
+                "atMobiles": at_mobiles or []
+            },
+            "msgtype": msgtype
+        }
+        if msgtype == "markdown":
+            body["markdown"] = {"title": title, "text": msg}
+        else:
+            body["text"] = {"content": msg}
+        return body
+    
+    @staticmethod
+    def _post(url: str, body: dict) -> dict:
+        """发送请求，失败时返回 errcode 为 -1 的结果而不是抛出异常"""
+        try:
             headers = {'Content-Type': 'application/json'}
-            resp = requests.post(url, json=body, headers=headers, timeout=10)
+            resp = get_session().post(url, data=dumps(body), headers=headers, timeout=send_timeout())
             resp.raise_for_status()
             
-            result = resp.json()
+            result = loads(resp.content)
             logger.info("钉钉消息发送成功：%s", result)
             return result
             
         except Exception as e:
             logger.error("钉钉消息发送失败：%s", e)
             return {"errcode": -1, "errmsg": str(e)}
+    
+    def send_long_message(
+        self, 
+        msg: str, 
+        at_user_ids: Optional[List[str]] = None,
+        max_bytes: Optional[int] = None
+    ) -> dict:
+        """
+        发送可能超过单条消息长度限制的回复，按段落/句子边界分段依次发送
+        
+        Args:
+            msg: 消息内容
+            at_user_ids: @的用户ID列表，只在第一段中@
+            max_bytes: 每段最大字节数，默认读取 DINGTALK_MAX_MESSAGE_BYTES
+            
+        Returns:
+            dict: 最后一次发送的钉钉API响应
+        """
+        last_result = {"errcode": -1, "errmsg": "消息为空"}
+        
+        def send_segment(segment: str, msgtype: str, index: int) -> bool:
+            nonlocal last_result
+            last_result = self.send_message(
+                segment, 
+                at_user_ids=at_user_ids if index == 0 else None,
+                msgtype=msgtype
+            )
+            return last_result.get("errcode") == 0
+        
+        send_in_segments(msg, send_segment, max_bytes or Config.DINGTALK_MAX_MESSAGE_BYTES, at_user_ids)
+        return last_result
 
 
-class GeminiClient:
-    """简化版Gemini客户端"""
+class GeminiClient(SimpleGeminiClient):
+    """简化版Gemini客户端，失败时返回本脚本原有的提示语"""
     
     def __init__(self, project_id: str, location: str = "us-central1"):
-        self.project_id = project_id
-        self.location = location
-        self.model_name = "gemini-1.5-flash"
-        self.credentials = None
-    
-    def initialize(self) -> bool:
-        """初始化认证"""
-        try:
-            from google.auth import default
-            from google.auth.transport.requests import Request
-            
-            self.credentials, _ = default()
-            self.credentials.refresh(Request())
-            
-            logger.info("Gemini客户端初始化成功")
-            return True
-        except Exception as e:
-            logger.error("Gemini客户端初始化失败：%s", e)
-            return False
+        super().__init__(project_id, location, model_name=Config.MODEL_NAME)
     
-    def generate_content(self, prompt: str) -> str:
+    def generate_content(self, prompt: str, *args, **kwargs) -> str:
         """生成AI回复"""
-        if not self.credentials:
-            return "AI服务未初始化"
-        
-        try:
-            from google.auth.transport.requests import Request
-            
-            # 刷新令牌
-            self.credentials.refresh(Request())
-            
-            # 构建API请求
-            url = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.model_name}:generateContent"
-            
-            data = {
-                "contents": [{
-                    "role": "user",
-                    "parts": [{"text": prompt}]
-                }],
-                "generation_config": {
-                    "temperature": 0.3,
-                    "top_p": 0.8,
-                    "top_k": 40,
-                    "max_output_tokens": 1000
-                }
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {self.credentials.token}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(url, json=data, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
-            
-            # 解析响应
-            if "candidates" in result and len(result["candidates"]) > 0:
-                candidate = result["candidates"][0]
-                if "content" in candidate and "parts" in candidate["content"]:
-                    parts = candidate["content"]["parts"]
-                    if len(parts) > 0 and "text" in parts[0]:
-                        return parts[0]["text"].strip()
-            
-            return "抱歉，我无法处理这个问题。"
-            
-        except Exception as e:
-            logger.error("调用Gemini失败：%s", e)
-            return "抱歉，AI服务暂时不可用。"
+        text = super().generate_content(prompt, *args, **kwargs)
+        return _LEGACY_REPLIES.get(text, text)
 
 
 def main():
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+钉钉开放平台（OpenAPI）机器人消息发送
+企业内部应用机器人可以通过 OpenAPI 向群或单聊用户发送消息，
+不受自定义机器人 robot/send 每分钟 20 条的限制，但需要应用凭证
+"""
+
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from config import Config
+from deadline import send_timeout
+from http_pool import get_session
+from json_codec import JSON_HEADERS, dumps, dumps_str, loads
+
+logger = logging.getLogger(__name__)
+
+OPENAPI_BASE = "https://api.dingtalk.com"
+
+# 应用访问令牌提前刷新的时间（秒）
+_TOKEN_REFRESH_MARGIN = 300
+
+
+class DingTalkOpenAPI:
+    """钉钉 OpenAPI 机器人消息客户端"""
+
+    def __init__(self, app_key: str, app_secret: str, robot_code: str):
+        """
+        Args:
+            app_key: 应用 AppKey
+            app_secret: 应用 AppSecret
+            robot_code: 机器人编码，企业内部应用机器人通常与 AppKey 相同
+        """
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.robot_code = robot_code or app_key
+        self._access_token = ""
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def _get_access_token(self) -> str:
+        """获取应用访问令牌，过期前才刷新"""
+        with self._lock:
+            if self._access_token and time.time() < self._expires_at:
+                return self._access_token
+
+            resp = get_session().post(
+                f"{OPENAPI_BASE}/v1.0/oauth2/accessToken",
+                data=dumps({"appKey": self.app_key, "appSecret": self.app_secret}),
+                headers=JSON_HEADERS,
+                timeout=send_timeout()
+            )
+            resp.raise_for_status()
+            result = loads(resp.content)
+            self._access_token = result["accessToken"]
+            self._expires_at = time.time() + int(result.get("expireIn", 7200)) - _TOKEN_REFRESH_MARGIN
+            return self._access_token
+
+    def _post(self, path: str, body: Dict[str, Any]) -> dict:
+        """调用 OpenAPI，返回与 robot/send 一致的 errcode/errmsg 结构"""
+        try:
+            headers = {
+                "x-acs-dingtalk-access-token": self._get_access_token(),
+                "Content-Type": "application/json"
+            }
+            resp = get_session().post(f"{OPENAPI_BASE}{path}", data=dumps(body), headers=headers, timeout=send_timeout())
+            result = loads(resp.content) if resp.content else {}
+            if resp.status_code != 200:
+                return {"errcode": resp.status_code, "errmsg": result.get("message", resp.text)}
+            return {"errcode": 0, "errmsg": "ok", **result}
+        except Exception as e:
+            logger.error("钉钉 OpenAPI 调用失败：%s", e)
+            return {"errcode": -1, "errmsg": str(e)}
+
+    @staticmethod
+    def _message(msg: str, msgtype: str, title: str) -> Dict[str, str]:
+        if msgtype == "markdown":
+            return {"msgKey": "sampleMarkdown", "msgParam": dumps_str({"title": title, "text": msg})}
+        return {"msgKey": "sampleText", "msgParam": dumps_str({"content": msg})}
+
+    def send_group_message(
+        self,
+        open_conversation_id: str,
+        msg: str,
+        msgtype: str = "text",
+        title: str = "AI助手回复"
+    ) -> dict:
+        """
+        发送群消息
+
+        Args:
+            open_conversation_id: 群会话ID（webhook 消息中的 conversationId）
+            msg: 消息内容
+            msgtype: 消息类型，text 或 markdown
+            title: markdown 消息的会话列表标题
+
+        Returns:
+            dict: 包含 errcode/errmsg 的结果
+        """
+        body = {
+            "robotCode": self.robot_code,
+            "openConversationId": open_conversation_id,
+            **self._message(msg, msgtype, title)
+        }
+        return self._post("/v1.0/robot/groupMessages/send", body)
+
+    def send_user_message(
+        self,
+        user_ids: List[str],
+        msg: str,
+        msgtype: str = "text",
+        title: str = "AI助手回复"
+    ) -> dict:
+        """
+        发送单聊消息
+
+        Args:
+            user_ids: 接收人的 userId（webhook 消息中的 senderStaffId）
+            msg: 消息内容
+            msgtype: 消息类型，text 或 markdown
+            title: markdown 消息的会话列表标题
+
+        Returns:
+            dict: 包含 errcode/errmsg 的结果
+        """
+        body = {
+            "robotCode": self.robot_code,
+            "userIds": user_ids,
+            **self._message(msg, msgtype, title)
+        }
+        return self._post("/v1.0/robot/oToMessages/batchSend", body)
+
+    def get_download_url(self, download_code: str, robot_code: str = "") -> str:
+        """
+        用图片或文件消息中的 downloadCode 换取临时下载地址
+
+        Args:
+            download_code: 消息中的 downloadCode
+            robot_code: 接收消息的机器人编码，默认使用客户端的机器人编码
+
+        Returns:
+            str: 下载地址
+
+        Raises:
+            RuntimeError: 获取下载地址失败
+        """
+        result = self._post(
+            "/v1.0/robot/messageFiles/download",
+            {"downloadCode": download_code, "robotCode": robot_code or self.robot_code}
+        )
+        if result.get("errcode") != 0 or not result.get("downloadUrl"):
+            raise RuntimeError(f"获取文件下载地址失败: {result.get('errmsg')}")
+        return result["downloadUrl"]
+
+
+def create_openapi_client(app_key: str, app_secret: str, robot_code: str = "") -> Optional[DingTalkOpenAPI]:
+    """
+    根据配置创建 OpenAPI 客户端，未配置应用凭证时返回 None
+
+    Args:
+        app_key: 应用 AppKey
+        app_secret: 应用 AppSecret
+        robot_code: 机器人编码
+    """
+    if not app_key or not app_secret:
+        return None
+    return DingTalkOpenAPI(app_key, app_secret, robot_code)
+
+
+# 进程级默认客户端，使用 DINGTALK_APP_KEY 等环境变量
+_default_client: Optional[DingTalkOpenAPI] = None
+_default_client_lock = threading.Lock()
+
+
+def get_openapi_client() -> Optional[DingTalkOpenAPI]:
+    """获取按环境变量配置的全局 OpenAPI 客户端，未配置应用凭证时返回 None"""
+    global _default_client
+
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = create_openapi_client(
+                    Config.DINGTALK_APP_KEY, Config.DINGTALK_APP_SECRET, Config.DINGTALK_ROBOT_CODE
+                )
+    return _default_client
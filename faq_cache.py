@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常见问题快速回答模块
+大部分提问集中在几百个常见问题上：问题归一化后在进程内字典中查找，命中时直接回答，不调用 Gemini。
+
+答案来源有两种：
+- 人工整理：FAQ_FILE 指定的 JSON 文件（格式见 faq.example.json），不过期
+- 自动学习：同一问题被问到 FAQ_LEARN_THRESHOLD 次后缓存 Gemini 的回答，FAQ_TTL 秒后过期
+
+后台线程定期检查即将过期、且近期仍有人问的学习答案，提前重新生成，热门问题不会因为过期而等待上游
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from config import Config
+from gemini_simple import is_fallback_reply
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 归一化时去掉的标点和空白
+_STRIP_RE = re.compile(r'[\s\W_]+', re.UNICODE)
+# 与时间相关、答案会很快过时的问题不自动学习
+_VOLATILE_RE = re.compile(r'今天|明天|昨天|现在|最新|今年|本周|几点|几号|天气|股价|汇率|today|tomorrow|now|latest|weather', re.I)
+
+
+def normalize_question(text: str) -> str:
+    """
+    问题归一化：全角转半角、转小写、去掉标点和空白
+
+    Args:
+        text: 问题
+
+    Returns:
+        str: 归一化后的问题
+    """
+    return _STRIP_RE.sub('', unicodedata.normalize('NFKC', text).lower())
+
+
+class _Entry:
+    """一个问题的答案和热度"""
+
+    __slots__ = ('question', 'answer', 'expires_at', 'recent_hits', 'total_hits', 'refreshing')
+
+    def __init__(self, question: str, answer: str, expires_at: Optional[float]):
+        self.question = question
+        self.answer = answer
+        self.expires_at = expires_at  # None 表示人工整理的答案，不过期
+        self.recent_hits = 0  # 上次刷新以来的命中次数
+        self.total_hits = 0
+        self.refreshing = False
+
+
+class FAQCache:
+    """常见问题答案缓存"""
+
+    def __init__(
+        self,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        learn_threshold: Optional[int] = None
+    ):
+        """
+        Args:
+            ttl: 自动学习的答案有效期（秒），默认读取 FAQ_TTL
+            max_entries: 最多缓存的问题数，默认读取 FAQ_MAX_ENTRIES
+            learn_threshold: 问题被问到多少次后开始缓存答案，默认读取 FAQ_LEARN_THRESHOLD，0 表示不自动学习
+        """
+        self.ttl = ttl or Config.FAQ_TTL
+        self.max_entries = max_entries or Config.FAQ_MAX_ENTRIES
+        self.learn_threshold = Config.FAQ_LEARN_THRESHOLD if learn_threshold is None else learn_threshold
+        self._entries: Dict[str, _Entry] = {}
+        # 未命中问题的提问次数，用于判断是否值得学习
+        self._miss_counts: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread_pid: Optional[int] = None
+
+    def load_curated(self, path: str) -> int:
+        """
+        加载人工整理的问答
+
+        Args:
+            path: JSON 文件，内容为 [{"question": ..., "aliases": [...], "answer": ...}]
+
+        Returns:
+            int: 加载的问题数（含别名）
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            items = json.load(f)
+
+        count = 0
+        with self._lock:
+            for item in items:
+                # 别名共用同一个条目，热度合并计算
+                entry = _Entry(item['question'], item['answer'], None)
+                for question in [item['question']] + list(item.get('aliases', [])):
+                    key = normalize_question(question)
+                    if key:
+                        self._entries[key] = entry
+                        count += 1
+        logger.info("已加载 %d 条常见问题", count)
+        return count
+
+    def lookup(self, question: str) -> Optional[str]:
+        """
+        查找问题的答案，同时记录问题热度
+
+        Args:
+            question: 用户问题
+
+        Returns:
+            str: 答案，没有或已过期时为 None
+        """
+        key = normalize_question(question)
+        entry = self._entries.get(key)
+        if entry is not None and (entry.expires_at is None or entry.expires_at > time.time()):
+            # 热度只用于挑选刷新对象，并发下少量计数误差可以接受，不加锁
+            entry.recent_hits += 1
+            entry.total_hits += 1
+            metrics.inc("faq_hits", source="curated" if entry.expires_at is None else "learned")
+            return entry.answer
+
+        metrics.inc("faq_misses")
+        if self.learn_threshold > 0 and key:
+            with self._lock:
+                self._miss_counts[key] = self._miss_counts.get(key, 0) + 1
+                self._miss_counts.move_to_end(key)
+                while len(self._miss_counts) > self.max_entries * 4:
+                    self._miss_counts.popitem(last=False)
+        return None
+
+    def learn(self, question: str, answer: str) -> bool:
+        """
+        记录 Gemini 的回答；问题被问到的次数达到阈值时才缓存
+
+        Args:
+            question: 用户问题
+            answer: generate_content 返回的回答
+
+        Returns:
+            bool: 是否缓存了该回答
+        """
+        key = normalize_question(question)
+        if (self.learn_threshold <= 0 or not key or not answer or is_fallback_reply(answer)
+                or _VOLATILE_RE.search(question)):
+            return False
+
+        with self._lock:
+            if self._miss_counts.get(key, 0) < self.learn_threshold:
+                return False
+            current = self._entries.get(key)
+            if current is not None and current.expires_at is None:
+                return False
+            self._miss_counts.pop(key, None)
+            self._entries[key] = _Entry(question, answer, time.time() + self.ttl)
+            self._evict()
+        metrics.inc("faq_learned")
+        return True
+
+    def _evict(self):
+        """超过容量时先删除过期的学习答案，再删除总命中最少的学习答案"""
+        if len(self._entries) <= self.max_entries:
+            return
+        now = time.time()
+        learned = [(key, entry) for key, entry in self._entries.items() if entry.expires_at is not None]
+        for key, entry in learned:
+            if entry.expires_at <= now:
+                del self._entries[key]
+        overflow = len(self._entries) - self.max_entries
+        if overflow > 0:
+            learned = [(key, entry) for key, entry in learned if key in self._entries]
+            learned.sort(key=lambda item: item[1].total_hits)
+            for key, _ in learned[:overflow]:
+                del self._entries[key]
+
+    def due_for_refresh(self, now: Optional[float] = None) -> List[str]:
+        """
+        挑选需要提前刷新的问题：即将过期（剩余不足 FAQ_REFRESH_AHEAD 秒），且上次刷新以来命中不少于
+        FAQ_REFRESH_MIN_HITS 次；按热度降序，最多 FAQ_REFRESH_BATCH 个
+
+        Returns:
+            list: 归一化后的问题
+        """
+        now = now or time.time()
+        with self._lock:
+            candidates = [
+                (entry.recent_hits, key) for key, entry in self._entries.items()
+                if entry.expires_at is not None and not entry.refreshing
+                and entry.expires_at - now <= Config.FAQ_REFRESH_AHEAD
+                and entry.recent_hits >= Config.FAQ_REFRESH_MIN_HITS
+            ]
+        candidates.sort(reverse=True)
+        return [key for _, key in candidates[:Config.FAQ_REFRESH_BATCH]]
+
+    def refresh(self, key: str, generate: Callable[[str], str]) -> bool:
+        """
+        重新生成一个问题的答案；失败时保留旧答案直到过期
+
+        Args:
+            key: 归一化后的问题
+            generate: 生成函数，参数为问题，返回回答
+
+        Returns:
+            bool: 是否刷新成功
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        entry.refreshing = True
+        try:
+            answer = generate(entry.question)
+        except Exception as e:
+            logger.warning("刷新常见问题答案失败: %s", e)
+            answer = ""
+        finally:
+            entry.refreshing = False
+
+        if not answer or is_fallback_reply(answer):
+            metrics.inc("faq_refresh_failures")
+            return False
+        with self._lock:
+            if self._entries.get(key) is entry:
+                self._entries[key] = _Entry(entry.question, answer, time.time() + self.ttl)
+                self._entries[key].total_hits = entry.total_hits
+        metrics.inc("faq_refreshed")
+        return True
+
+    def _run(self, generate: Callable[[str], str]):
+        while True:
+            time.sleep(Config.FAQ_REFRESH_INTERVAL)
+            try:
+                for key in self.due_for_refresh():
+                    self.refresh(key, generate)
+            except Exception as e:
+                logger.error(f"刷新常见问题答案异常: {e}")
+
+    def start(self, generate: Callable[[str], str]):
+        """
+        启动后台刷新线程；gunicorn fork 出的 worker 中会重新启动
+
+        Args:
+            generate: 生成函数，参数为问题，返回回答
+        """
+        pid = os.getpid()
+        if self._thread_pid == pid or self.learn_threshold <= 0:
+            return
+        with self._lock:
+            if self._thread_pid == pid:
+                return
+            threading.Thread(target=self._run, args=(generate,), name='faq-refresh', daemon=True).start()
+            self._thread_pid = pid
+
+    def snapshot(self) -> Dict[str, Any]:
+        """缓存状态，供 /metrics 使用"""
+        now = time.time()
+        entries = list({id(entry): entry for entry in list(self._entries.values())}.values())
+        return {
+            "curated": sum(1 for entry in entries if entry.expires_at is None),
+            "learned": sum(1 for entry in entries if entry.expires_at is not None and entry.expires_at > now),
+            "hottest": [
+                {"question": entry.question[:50], "hits": entry.total_hits}
+                for entry in sorted(entries, key=lambda entry: entry.total_hits, reverse=True)[:10]
+            ],
+        }
+
+
+# 进程级全局缓存
+_faq_cache: Optional[FAQCache] = None
+_faq_lock = threading.Lock()
+
+
+def get_faq_cache() -> Optional[FAQCache]:
+    """获取全局常见问题缓存，未启用 FAQ_ENABLED 时返回 None；首次获取时加载 FAQ_FILE"""
+    global _faq_cache
+
+    if not Config.FAQ_ENABLED:
+        return None
+    if _faq_cache is None:
+        with _faq_lock:
+            if _faq_cache is None:
+                cache = FAQCache()
+                if Config.FAQ_FILE:
+                    try:
+                        cache.load_curated(Config.FAQ_FILE)
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.error(f"读取常见问题文件失败: {e}")
+                _faq_cache = cache
+    return _faq_cache
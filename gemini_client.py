@@ -7,24 +7,62 @@ GCP Vertex AI 集成模块
 import os
 import time
 import logging
-from typing import Optional
+import itertools
+import functools
+from typing import Any, Dict, Optional, Sequence, TYPE_CHECKING
 
-try:
-    # 尝试新版本的导入方式
-    import vertexai
+import requests
+
+from cancellation import GenerationCancelled, check_cancelled, current_cancel_token
+from config import Config
+from deadline import DeadlineExceeded, generation_timeout
+from gemini_simple import (
+    extract_response_text, read_sse_stream, TIMEOUT_REPLY, EMPTY_REPLY, UNAVAILABLE_REPLY, CANCELLED_REPLY
+)
+from http_pool import get_session
+from json_codec import dumps
+from metrics import metrics
+from model_router import get_model_router
+from thinking_budget import get_thinking_controller, output_token_limit
+from token_estimator import prepare_generation, get_token_estimator, classify_question
+from startup_profile import lazy_import, profile_phase
+
+if TYPE_CHECKING:
     from vertexai.generative_models import GenerativeModel, ChatSession
-    USE_VERTEXAI = True
-except ImportError:
-    try:
-        # 尝试旧版本的导入方式
-        from google.cloud import aiplatform
-        from google.cloud.aiplatform.gapic.schema import predict
-        USE_VERTEXAI = False
-    except ImportError:
-        raise ImportError("请安装 vertexai 或 google-cloud-aiplatform 包")
 
 logger = logging.getLogger(__name__)
 
+# Vertex AI SDK 导入较重，延迟到首次初始化时加载；None 表示尚未加载
+USE_VERTEXAI: Optional[bool] = None
+
+
+def _load_vertex_sdk() -> bool:
+    """
+    按需加载 Vertex AI SDK
+    
+    Returns:
+        bool: 是否使用新版本 vertexai
+    """
+    global USE_VERTEXAI
+    
+    if USE_VERTEXAI is not None:
+        return USE_VERTEXAI
+    
+    try:
+        # 尝试新版本的导入方式
+        lazy_import('vertexai')
+        lazy_import('vertexai.generative_models')
+        USE_VERTEXAI = True
+    except ImportError:
+        try:
+            # 尝试旧版本的导入方式
+            lazy_import('google.cloud.aiplatform')
+            USE_VERTEXAI = False
+        except ImportError:
+            raise ImportError("请安装 vertexai 或 google-cloud-aiplatform 包")
+    
+    return USE_VERTEXAI
+
 class GeminiClient:
     """Gemini AI 客户端"""
     
@@ -40,8 +78,12 @@ class GeminiClient:
         self.project_id = project_id
         self.location = location
         self.model_name = model_name
-        self.model: Optional[GenerativeModel] = None
-        self.chat_session: Optional[ChatSession] = None
+        self.model: Optional["GenerativeModel"] = None
+        # 路由到的其他模型实例，按模型名缓存
+        self._models: Dict[str, "GenerativeModel"] = {}
+        self.chat_session: Optional["ChatSession"] = None
+        self._credentials = None
+        self._auth_request = None
         
     def initialize(self) -> bool:
         """
@@ -51,22 +93,11 @@ class GeminiClient:
             bool: 是否初始化成功
         """
         try:
-            if USE_VERTEXAI:
-                # 使用新版本 vertexai
-                vertexai.init(
-                    project=self.project_id,
-                    location=self.location
-                )
-                self.model = GenerativeModel(self.model_name)
-            else:
-                # 使用旧版本 google-cloud-aiplatform
-                from google.cloud import aiplatform
-                aiplatform.init(
-                    project=self.project_id,
-                    location=self.location
-                )
-                # 旧版本不支持 GenerativeModel，需要使用不同的方法
-                self.model = None
+            with profile_phase('gemini_client.load_sdk'):
+                use_vertexai = _load_vertex_sdk()
+            
+            with profile_phase('gemini_client.initialize'):
+                self._init_sdk(use_vertexai)
             
             logger.info(f"Vertex AI 初始化成功，模型: {self.model_name}")
             return True
@@ -75,40 +106,156 @@ class GeminiClient:
             logger.error(f"Vertex AI 初始化失败: {e}")
             return False
     
+    def _init_sdk(self, use_vertexai: bool):
+        """初始化已加载的 SDK 并创建模型实例"""
+        if use_vertexai:
+            # 使用新版本 vertexai
+            vertexai = lazy_import('vertexai')
+            generative_models = lazy_import('vertexai.generative_models')
+            vertexai.init(
+                project=self.project_id,
+                location=self.location
+            )
+            self.model = generative_models.GenerativeModel(self.model_name)
+            self._models[self.model_name] = self.model
+        else:
+            # 使用旧版本 google-cloud-aiplatform
+            aiplatform = lazy_import('google.cloud.aiplatform')
+            aiplatform.init(
+                project=self.project_id,
+                location=self.location
+            )
+            # 旧版本不支持 GenerativeModel，需要使用不同的方法
+            self.model = None
+    
+    def _get_legacy_token(self, timeout: Optional[float] = None) -> str:
+        """
+        获取 REST 调用使用的访问令牌，令牌失效时才刷新
+        
+        Args:
+            timeout: 刷新请求的超时时间（秒），None 使用 google-auth 默认值
+        """
+        if self._credentials is None:
+            google_auth = lazy_import('google.auth')
+            auth_transport = lazy_import('google.auth.transport.requests')
+            self._credentials, _ = google_auth.default()
+            self._auth_request = auth_transport.Request(session=get_session())
+        
+        if not self._credentials.valid:
+            auth_request = self._auth_request
+            if timeout is not None:
+                auth_request = functools.partial(auth_request, timeout=timeout)
+            self._credentials.refresh(auth_request)
+        
+        return self._credentials.token
+    
+    def _get_model(self, model_name: str) -> "GenerativeModel":
+        """获取指定名称的模型实例，首次使用时创建"""
+        model = self._models.get(model_name)
+        if model is None:
+            generative_models = lazy_import('vertexai.generative_models')
+            model = self._models[model_name] = generative_models.GenerativeModel(model_name)
+        return model
+    
+    def route_model(self, prompt: str, history_turns: int = 0) -> str:
+        """
+        按问题复杂度选择模型
+        
+        Args:
+            prompt: 输入提示
+            history_turns: 当前会话已有的对话轮数
+            
+        Returns:
+            str: 模型名称
+        """
+        router = get_model_router()
+        if router is None:
+            return self.model_name
+        return router.route(prompt, history_turns).model_name
+    
+    def check_auth(self, timeout: float = 5) -> bool:
+        """
+        检查访问令牌是否有效，失效时刷新
+        
+        Args:
+            timeout: 刷新请求的超时时间（秒）
+            
+        Returns:
+            bool: 是否持有有效的访问令牌
+        """
+        self._get_legacy_token(timeout)
+        return self._credentials.valid
+    
+    def warmup(self, priming: bool = False) -> bool:
+        """
+        预热客户端：建立到 Vertex AI 的连接并获取访问令牌，可选发送一个极小的预热请求
+        
+        Args:
+            priming: 是否发送预热请求
+            
+        Returns:
+            bool: 是否预热成功
+        """
+        try:
+            if USE_VERTEXAI and self.model:
+                # count_tokens 不产生生成费用，但会完成认证和建立 gRPC 通道
+                self.model.count_tokens("ping")
+            else:
+                self._get_legacy_token()
+            
+            if priming:
+                self.generate_content("ping", max_output_tokens=1, model_name=self.model_name)
+            return True
+        except Exception as e:
+            logger.warning(f"Gemini 客户端预热失败: {e}")
+            return False
+    
     def generate_content(
         self, 
         prompt: str, 
         temperature: float = 0.3,
         top_p: float = 0.8,
         top_k: int = 40,
-        max_output_tokens: int = 1000
+        max_output_tokens: Optional[int] = None,
+        model_name: Optional[str] = None,
+        history_turns: int = 0,
+        media_parts: Sequence[Any] = (),
+        history: Sequence[Any] = ()
     ) -> str:
         """
         生成内容
         
         Args:
-            prompt: 输入提示
+            prompt: 输入提示，超过 MAX_INPUT_TOKENS 时会被裁剪
             temperature: 温度参数
             top_p: top_p参数
             top_k: top_k参数
-            max_output_tokens: 最大输出token数
+            max_output_tokens: 最大输出token数，None 表示按问题类型和剩余预算自动确定
+            model_name: 指定模型，None 表示按问题复杂度路由（未启用路由时使用客户端模型）
+            history_turns: 当前会话已有的对话轮数，参与复杂度判断
+            media_parts: 图片等媒体片段（media.MediaPart），放在文本之前
+            history: 之前的对话记录（conversation_store.Turn），按时间顺序
             
         Returns:
-            str: 生成的内容
+            str: 生成的内容；超过截止时间时返回已生成的部分内容
         """
         try:
             # 开始计时
             start_time = time.time()
+            timeout = generation_timeout()
+            
+            history_turns = history_turns or len(history) // 2
+            if model_name is None:
+                model_name = self.route_model(prompt, history_turns)
+            
+            question_class = classify_question(prompt)
+            thinking = get_thinking_controller()
+            # 只把与问题相关的内部文档块放进提示；输出长度按原始问题确定，输入超长时只裁剪文档部分
+            augment = lazy_import('retrieval').augment_prompt if Config.RAG_ENABLED else None
+            prompt, input_tokens, max_output_tokens = prepare_generation(prompt, max_output_tokens, history, augment)
             
             if USE_VERTEXAI and self.model:
                 # 使用新版本 vertexai
-                generation_config = {
-                    "temperature": temperature,
-                    "top_p": top_p,
-                    "top_k": top_k,
-                    "max_output_tokens": max_output_tokens,
-                }
-                
                 safety_settings = {
                     "HARM_CATEGORY_HARASSMENT": "BLOCK_MEDIUM_AND_ABOVE",
                     "HARM_CATEGORY_HATE_SPEECH": "BLOCK_MEDIUM_AND_ABOVE",
@@ -116,85 +263,221 @@ class GeminiClient:
                     "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_MEDIUM_AND_ABOVE",
                 }
                 
-                response = self.model.generate_content(
-                    prompt,
-                    generation_config=generation_config,
-                    safety_settings=safety_settings
+                contents = prompt
+                if media_parts or history:
+                    generative_models = lazy_import('vertexai.generative_models')
+                    parts = [
+                        generative_models.Part.from_data(part.data, mime_type=part.mime_type) 
+                        for part in media_parts
+                    ] + [generative_models.Part.from_text(prompt)]
+                    contents = [
+                        generative_models.Content(role=turn.role, parts=[generative_models.Part.from_text(turn.text)])
+                        for turn in history
+                    ] + [generative_models.Content(role="user", parts=parts)]
+                
+                def open_stream(model_name: str):
+                    budget = thinking.budget_for(model_name, question_class)
+                    generation_config = {
+                        "temperature": temperature,
+                        "top_p": top_p,
+                        "top_k": top_k,
+                        "max_output_tokens": output_token_limit(max_output_tokens, budget),
+                    }
+                    if budget is not None:
+                        generation_config["thinking_config"] = {"thinking_budget": budget}
+                    responses = iter(self._get_model(model_name).generate_content(
+                        contents,
+                        generation_config=generation_config,
+                        safety_settings=safety_settings,
+                        stream=True
+                    ))
+                    # 流式接口在读取第一段时才发出请求，模型不存在等错误在这里抛出
+                    first = next(responses, None)
+                    return responses, ([first] if first is not None else []), budget
+                
+                # 流式生成，每收到一段检查一次截止时间，到期时停止接收并保留已生成的内容
+                check_cancelled()
+                not_found = lazy_import('google.api_core.exceptions').NotFound
+                try:
+                    responses, first, budget = open_stream(model_name)
+                except not_found:
+                    if model_name == self.model_name:
+                        raise
+                    # 路由到的模型在当前区域不可用时退回默认模型
+                    logger.warning("模型 %s 不可用，改用 %s", model_name, self.model_name)
+                    metrics.inc("route_fallbacks", model=model_name)
+                    model_name = self.model_name
+                    responses, first, budget = open_stream(model_name)
+                
+                texts = []
+                usage = None
+                finish_reason = None
+                truncated = False
+                cancel_token = current_cancel_token()
+                for chunk in itertools.chain(first, responses):
+                    if cancel_token is not None and cancel_token.cancelled:
+                        # SDK 的流只能在两段之间中止：关闭流后服务端随之停止生成
+                        getattr(responses, "close", lambda: None)()
+                        raise GenerationCancelled(cancel_token.reason)
+                    candidate = chunk.candidates[0] if chunk.candidates else None
+                    if candidate is not None:
+                        texts.extend(
+                            getattr(part, "text", "") for part in candidate.content.parts 
+                            if not getattr(part, "thought", False)
+                        )
+                        finish_reason = candidate.finish_reason.name
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    if time.time() - start_time >= timeout:
+                        truncated = True
+                        break
+                text = "".join(texts).strip()
+                
+                if truncated:
+                    return self._partial_answer(text, model_name, timeout)
+                
+                # 用实际输入 token 数校准本地估算；图片和文件的 token 不在估算值中，带媒体的请求不参与校准
+                if not media_parts:
+                    get_token_estimator().record_usage(input_tokens, getattr(usage, "prompt_token_count", 0))
+                
+                thinking.record(
+                    model_name, question_class, budget, text, finish_reason,
+                    getattr(usage, "thoughts_token_count", 0)
                 )
                 
-                if response.text:
+                if text:
                     end_time = time.time()
                     response_time = end_time - start_time
-                    logger.info(f"Gemini响应成功，耗时: {response_time:.2f}秒")
-                    return response.text.strip()
+                    metrics.observe("gemini_latency_seconds", response_time, model=model_name)
+                    logger.info("Gemini响应成功，模型: %s，耗时: %.2f秒", model_name, response_time)
+                    return text
                 else:
                     logger.warning("Gemini返回空响应")
-                    return "抱歉，我无法处理这个问题，请换个方式提问。"
+                    return EMPTY_REPLY
             else:
                 # 使用旧版本方式或降级处理
-                return self._generate_content_legacy(prompt, temperature, top_p, top_k, max_output_tokens)
+                return self._generate_content_legacy(
+                    prompt, temperature, top_p, top_k, max_output_tokens, input_tokens, model_name, 
+                    question_class, timeout, media_parts, history
+                )
                 
+        except DeadlineExceeded as e:
+            logger.error("Gemini 生成超时: %s", e)
+            return TIMEOUT_REPLY
+        except GenerationCancelled:
+            return CANCELLED_REPLY
         except Exception as e:
-            logger.error(f"调用 Gemini 模型失败: {e}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
+            metrics.inc("gemini_errors", model=model_name)
+            logger.error("调用 Gemini 模型失败: %s", e)
+            return UNAVAILABLE_REPLY
     
-    def _generate_content_legacy(self, prompt: str, temperature: float, top_p: float, top_k: int, max_output_tokens: int) -> str:
+    def _generate_content_legacy(
+        self, 
+        prompt: str, 
+        temperature: float, 
+        top_p: float, 
+        top_k: int, 
+        max_output_tokens: int, 
+        input_tokens: int = 0,
+        model_name: Optional[str] = None,
+        question_class: str = "general",
+        timeout: Optional[float] = None,
+        media_parts: Sequence[Any] = (),
+        history: Sequence[Any] = ()
+    ) -> str:
         """
         使用旧版本API生成内容
         """
         try:
-            import requests
-            import json
-            
-            # 使用 REST API 调用
-            from google.auth import default
-            from google.auth.transport.requests import Request
+            start_time = time.time()
+            if timeout is None:
+                timeout = generation_timeout()
             
-            # 获取认证
-            credentials, project_id = default()
-            credentials.refresh(Request())
+            # 使用 REST API 调用，获取认证
+            token = self._get_legacy_token(timeout)
+            model_name = model_name or self.model_name
+            thinking = get_thinking_controller()
+            budget = thinking.budget_for(model_name, question_class)
             
             # 构建API URL
-            url = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.model_name}:generateContent"
+            url = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{model_name}:streamGenerateContent"
             
             # 构建请求数据
+            contents = [{"role": turn.role, "parts": [{"text": turn.text}]} for turn in history]
+            contents.append({
+                "role": "user",
+                "parts": [part.to_rest() for part in media_parts] + [{"text": prompt}]
+            })
             data = {
-                "contents": [{
-                    "role": "user",
-                    "parts": [{"text": prompt}]
-                }],
+                "contents": contents,
                 "generation_config": {
                     "temperature": temperature,
                     "top_p": top_p,
                     "top_k": top_k,
-                    "max_output_tokens": max_output_tokens
+                    "max_output_tokens": output_token_limit(max_output_tokens, budget)
                 }
             }
+            if budget is not None:
+                data["generation_config"]["thinking_config"] = {"thinking_budget": budget}
             
             # 发送请求
             headers = {
-                "Authorization": f"Bearer {credentials.token}",
+                "Authorization": f"Bearer {token}",
                 "Content-Type": "application/json"
             }
             
-            response = requests.post(url, json=data, headers=headers, timeout=30)
+            # 流式调用，超时时保留已生成的部分内容
+            check_cancelled()
+            remaining = max(timeout - (time.time() - start_time), 0.1)
+            response = get_session().post(
+                url, params={"alt": "sse"}, data=dumps(data), headers=headers, 
+                timeout=(min(remaining, 5), remaining), stream=True
+            )
+            if not response.ok:
+                response.close()
             response.raise_for_status()
             
-            result = response.json()
+            result, truncated = read_sse_stream(response, max(timeout - (time.time() - start_time), 0.1))
+            if truncated:
+                return self._partial_answer(extract_response_text(result), model_name, timeout)
+            
+            # 用实际输入 token 数校准本地估算；带图片和文件的请求不参与校准
+            usage = result.get("usageMetadata") or {}
+            if not media_parts:
+                get_token_estimator().record_usage(input_tokens, usage.get("promptTokenCount", 0))
             
             # 解析响应
-            if "candidates" in result and len(result["candidates"]) > 0:
-                candidate = result["candidates"][0]
-                if "content" in candidate and "parts" in candidate["content"]:
-                    parts = candidate["content"]["parts"]
-                    if len(parts) > 0 and "text" in parts[0]:
-                        return parts[0]["text"].strip()
+            text = extract_response_text(result)
+            candidates = result.get("candidates") or [{}]
+            thinking.record(
+                model_name, question_class, budget, text, 
+                candidates[0].get("finishReason"), usage.get("thoughtsTokenCount", 0)
+            )
+            if text:
+                return text
             
-            return "抱歉，我无法处理这个问题，请换个方式提问。"
+            return EMPTY_REPLY
             
+        except (DeadlineExceeded, requests.exceptions.Timeout) as e:
+            logger.error("Gemini 生成超时: %s", e)
+            return TIMEOUT_REPLY
+        except GenerationCancelled:
+            return CANCELLED_REPLY
         except Exception as e:
-            logger.error(f"使用旧版本API调用失败: {e}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
+            logger.error("使用旧版本API调用失败: %s", e)
+            return UNAVAILABLE_REPLY
+    
+    def _partial_answer(self, text: str, model_name: str, timeout: float) -> str:
+        """
+        生成超时时返回已生成的部分内容
+        
+        Raises:
+            DeadlineExceeded: 超时且没有生成任何内容
+        """
+        metrics.inc("deadline_exceeded", model=model_name, partial=bool(text))
+        if not text:
+            raise DeadlineExceeded(f"生成超时（{timeout:.1f}秒）")
+        logger.warning("生成超时（%.1f秒），返回已生成的部分内容", timeout)
+        return text + Config.DEADLINE_PARTIAL_NOTICE
     
     def start_chat(self) -> bool:
         """
@@ -238,15 +521,15 @@ class GeminiClient:
             response_time = end_time - start_time
             
             if response.text:
-                logger.info(f"聊天回复成功，耗时: {response_time:.2f}秒")
+                logger.info("聊天回复成功，耗时: %.2f秒", response_time)
                 return response.text.strip()
             else:
                 logger.warning("聊天回复为空")
-                return "抱歉，我无法处理这个问题，请换个方式提问。"
+                return EMPTY_REPLY
                 
         except Exception as e:
-            logger.error(f"发送聊天消息失败: {e}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
+            logger.error("发送聊天消息失败: %s", e)
+            return UNAVAILABLE_REPLY
     
     def reset_chat(self):
         """重置聊天会话"""
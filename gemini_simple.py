@@ -7,16 +7,181 @@
 
 import os
 import time
-import json
+import socket
 import logging
-from typing import Optional
+import threading
+import functools
+from typing import Optional, Dict, Any, Sequence, Tuple
 
 import requests
-from google.auth import default
-from google.auth.transport.requests import Request
+
+from cancellation import GenerationCancelled, check_cancelled, current_cancel_token
+from config import Config
+from deadline import DeadlineExceeded, generation_timeout
+from http_pool import get_session
+from json_codec import Fragment, dumps, loads
+from metrics import metrics
+from model_router import get_model_router
+from thinking_budget import get_thinking_controller, output_token_limit
+from token_estimator import prepare_generation, get_token_estimator, classify_question
+from startup_profile import lazy_import, profile_phase
 
 logger = logging.getLogger(__name__)
 
+# 生成超时且没有任何内容时的回复
+TIMEOUT_REPLY = "抱歉，回答超时，请稍后再试或把问题拆分得更具体一些。"
+# 模型没有返回文本、服务不可用、客户端未初始化时的回复
+EMPTY_REPLY = "抱歉，我无法处理这个问题，请换个方式提问。"
+UNAVAILABLE_REPLY = "抱歉，AI服务暂时不可用，请稍后再试。"
+NOT_INITIALIZED_REPLY = "AI服务未初始化，请稍后再试。"
+# 生成被用户取消时的回复（不会发送给用户）
+CANCELLED_REPLY = "回答已取消。"
+FALLBACK_REPLIES = frozenset({TIMEOUT_REPLY, EMPTY_REPLY, UNAVAILABLE_REPLY, NOT_INITIALIZED_REPLY, CANCELLED_REPLY})
+
+# 安全设置
+SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    }
+]
+# 每次请求都相同，预先编码一次
+SAFETY_SETTINGS_FRAGMENT = Fragment(SAFETY_SETTINGS)
+
+
+def extract_response_text(result: Dict[str, Any]) -> str:
+    """
+    从 generateContent 响应中提取文本
+    
+    Args:
+        result: 接口响应数据
+        
+    Returns:
+        str: 生成的文本，没有文本时为空字符串
+    """
+    if "candidates" in result and len(result["candidates"]) > 0:
+        candidate = result["candidates"][0]
+        if "content" in candidate and "parts" in candidate["content"]:
+            parts = candidate["content"]["parts"]
+            if len(parts) > 0 and "text" in parts[0]:
+                return parts[0]["text"].strip()
+    return ""
+
+
+def is_fallback_reply(text: str) -> bool:
+    """
+    判断回答是否为生成失败时的提示语或超时截断的部分内容（这类回答不应被缓存或复用）
+    
+    Args:
+        text: generate_content 返回的内容
+    """
+    return text in FALLBACK_REPLIES or text.endswith(Config.DEADLINE_PARTIAL_NOTICE)
+
+
+def abort_response(response: requests.Response):
+    """
+    中止流式响应：先关闭底层 socket 的读写，另一个线程中阻塞的读取才会立即返回，再关闭响应
+    （只调用 response.close() 时，阻塞的读取要等服务端发来下一段数据才返回）
+    
+    socket 通过 urllib3 的公开属性 HTTPResponse.connection.sock 获取；获取不到时
+    （例如 urllib3 改变了实现）记录 stream_abort_fallback 指标，退回只关闭响应
+    
+    Args:
+        response: 以 stream=True 发起的请求响应
+    """
+    sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    elif not getattr(response.raw, 'closed', True):
+        metrics.inc("stream_abort_fallback")
+        logger.warning("无法获取流式响应的底层连接，只能关闭响应，正在进行的读取要等下一段数据才会结束")
+    response.close()
+
+
+def read_sse_stream(response: requests.Response, timeout: float) -> Tuple[Dict[str, Any], bool]:
+    """
+    读取 streamGenerateContent?alt=sse 的流式响应，合并为与 generateContent 相同结构的结果
+    
+    超过 timeout 仍未结束时关闭连接（服务端随之停止生成），返回已收到的部分内容；
+    当前请求被取消时同样立即关闭连接
+    
+    Args:
+        response: 以 stream=True 发起的请求响应
+        timeout: 读取整个流的最长时间（秒）
+        
+    Returns:
+        tuple: (合并后的响应数据, 是否因超时被截断)
+        
+    Raises:
+        GenerationCancelled: 当前请求已被取消
+    """
+    texts = []
+    finish_reason = None
+    usage: Dict[str, Any] = {}
+    expired = threading.Event()
+    
+    def cancel():
+        expired.set()
+        abort_response(response)
+    
+    def abort():
+        abort_response(response)
+    
+    watchdog = threading.Timer(timeout, cancel)
+    watchdog.daemon = True
+    watchdog.start()
+    cancel_token = current_cancel_token()
+    if cancel_token is not None:
+        cancel_token.add_callback(abort)
+    try:
+        for line in response.iter_lines(chunk_size=None):
+            if not line.startswith(b"data:"):
+                continue
+            chunk = loads(line[5:])
+            candidates = chunk.get("candidates") or [{}]
+            for part in candidates[0].get("content", {}).get("parts", []):
+                if "text" in part and not part.get("thought"):
+                    texts.append(part["text"])
+            finish_reason = candidates[0].get("finishReason", finish_reason)
+            usage = chunk.get("usageMetadata", usage)
+    except Exception:
+        # 超时或取消时关闭连接会使阻塞中的读取抛出异常
+        if not expired.is_set() and not (cancel_token and cancel_token.cancelled):
+            raise
+    finally:
+        watchdog.cancel()
+        if cancel_token is not None:
+            cancel_token.remove_callback(abort)
+        response.close()
+    
+    if cancel_token is not None:
+        cancel_token.check()
+    
+    result = {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": "".join(texts)}]},
+            "finishReason": finish_reason
+        }],
+        "usageMetadata": usage
+    }
+    return result, expired.is_set()
+
+
 class SimpleGeminiClient:
     """简化版 Gemini AI 客户端"""
     
@@ -33,6 +198,7 @@ class SimpleGeminiClient:
         self.location = location
         self.model_name = model_name
         self.credentials = None
+        self._auth_request = None
         
     def initialize(self) -> bool:
         """
@@ -42,11 +208,18 @@ class SimpleGeminiClient:
             bool: 是否初始化成功
         """
         try:
-            # 获取默认认证
-            self.credentials, _ = default()
+            # google.auth 导入较重，延迟到初始化时加载
+            with profile_phase('gemini_simple.load_auth'):
+                google_auth = lazy_import('google.auth')
+                auth_transport = lazy_import('google.auth.transport.requests')
             
-            # 测试认证
-            self.credentials.refresh(Request())
+            with profile_phase('gemini_simple.initialize'):
+                # 获取默认认证
+                self.credentials, _ = google_auth.default()
+                self._auth_request = auth_transport.Request(session=get_session())
+                
+                # 测试认证
+                self.credentials.refresh(self._auth_request)
             
             logger.info(f"Gemini 客户端初始化成功，模型: {self.model_name}")
             return True
@@ -55,13 +228,270 @@ class SimpleGeminiClient:
             logger.error(f"Gemini 客户端初始化失败: {e}")
             return False
     
+    def _ensure_token(self, timeout: Optional[float] = None):
+        """
+        访问令牌失效或即将过期时才刷新，避免每次请求都去获取令牌
+        
+        Args:
+            timeout: 刷新请求的超时时间（秒），None 使用 google-auth 默认值
+        """
+        if not self.credentials.valid:
+            auth_request = self._auth_request
+            if timeout is not None:
+                auth_request = functools.partial(auth_request, timeout=timeout)
+            self.credentials.refresh(auth_request)
+    
+    def check_auth(self, timeout: float = 5) -> bool:
+        """
+        检查访问令牌是否有效，失效时刷新
+        
+        Args:
+            timeout: 刷新请求的超时时间（秒）
+            
+        Returns:
+            bool: 是否持有有效的访问令牌
+        """
+        if not self.credentials:
+            return False
+        self._ensure_token(timeout)
+        return self.credentials.valid
+    
+    def warmup(self, priming: bool = False) -> bool:
+        """
+        预热客户端：确保持有有效的访问令牌，可选发送一个极小的预热请求
+        
+        Args:
+            priming: 是否发送预热请求
+            
+        Returns:
+            bool: 是否预热成功
+        """
+        if not self.credentials:
+            return False
+        
+        try:
+            self._ensure_token()
+            if priming:
+                self.generate_content("ping", max_output_tokens=1, model_name=self.model_name)
+            return True
+        except Exception as e:
+            logger.warning(f"Gemini 客户端预热失败: {e}")
+            return False
+    
+    def model_url(self, method: str = "generateContent", model_name: Optional[str] = None) -> str:
+        """
+        构建模型接口地址
+        
+        Args:
+            method: 接口方法，例如 generateContent
+            model_name: 模型名称，默认使用客户端模型
+            
+        Returns:
+            str: 接口URL
+        """
+        return f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{model_name or self.model_name}:{method}"
+    
+    def get_auth_headers(self, timeout: Optional[float] = None) -> Dict[str, str]:
+        """
+        获取带有效访问令牌的请求头
+        
+        Args:
+            timeout: 需要刷新令牌时的超时时间（秒）
+        """
+        self._ensure_token(timeout)
+        return {
+            "Authorization": f"Bearer {self.credentials.token}",
+            "Content-Type": "application/json"
+        }
+    
+    def build_request_body(
+        self, 
+        prompt: str, 
+        temperature: float = 0.3,
+        top_p: float = 0.8,
+        top_k: int = 40,
+        max_output_tokens: int = 1000,
+        thinking_budget: Optional[int] = None,
+        media_parts: Sequence[Any] = (),
+        history: Sequence[Any] = ()
+    ) -> Dict[str, Any]:
+        """
+        构建 generateContent 请求数据
+        
+        Args:
+            prompt: 输入提示
+            temperature: 温度参数
+            top_p: top_p参数
+            top_k: top_k参数
+            max_output_tokens: 回答部分的最大输出token数
+            thinking_budget: 思考预算，None 表示不设置（模型不支持思考预算）
+            media_parts: 图片等媒体片段（media.MediaPart），放在文本之前
+            history: 之前的对话记录（conversation_store.Turn），按时间顺序
+            
+        Returns:
+            dict: 请求数据
+        """
+        generation_config = {
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "max_output_tokens": output_token_limit(max_output_tokens, thinking_budget)
+        }
+        if thinking_budget is not None:
+            generation_config["thinking_config"] = {"thinking_budget": thinking_budget}
+        
+        contents = [{"role": turn.role, "parts": [{"text": turn.text}]} for turn in history]
+        contents.append({
+            "role": "user",
+            "parts": [part.to_rest() for part in media_parts] + [{"text": prompt}]
+        })
+        return {
+            "contents": contents,
+            "generation_config": generation_config,
+            "safety_settings": SAFETY_SETTINGS
+        }
+    
+    def generate_content_raw(
+        self, 
+        prompt: str, 
+        temperature: float = 0.3,
+        top_p: float = 0.8,
+        top_k: int = 40,
+        max_output_tokens: Optional[int] = None,
+        timeout: Optional[float] = None,
+        model_name: Optional[str] = None,
+        history_turns: int = 0,
+        media_parts: Sequence[Any] = (),
+        history: Sequence[Any] = ()
+    ) -> str:
+        """
+        生成内容，失败时抛出异常而不是返回提示语
+        
+        Args:
+            prompt: 输入提示，超过 MAX_INPUT_TOKENS 时会被裁剪
+            temperature: 温度参数
+            top_p: top_p参数
+            top_k: top_k参数
+            max_output_tokens: 最大输出token数，None 表示按问题类型和剩余预算自动确定
+            timeout: 生成超时时间（秒），None 表示按当前请求的截止时间计算（不在请求中时为 AI_TIMEOUT）
+            model_name: 指定模型，None 表示按问题复杂度路由（未启用路由时使用客户端模型）
+            history_turns: 当前会话已有的对话轮数，参与复杂度判断
+            media_parts: 图片等媒体片段（media.MediaPart）
+            history: 之前的对话记录（conversation_store.Turn），按时间顺序
+            
+        Returns:
+            str: 生成的内容，模型未返回文本时为空字符串；超时前已生成部分内容时返回部分内容
+            
+        Raises:
+            DeadlineExceeded: 超时且没有生成任何内容
+            GenerationCancelled: 当前请求已被取消
+        """
+        if not self.credentials:
+            raise RuntimeError("Gemini 客户端未初始化")
+        
+        # 开始计时
+        start_time = time.time()
+        if timeout is None:
+            timeout = generation_timeout()
+        
+        history_turns = history_turns or len(history) // 2
+        if model_name is None:
+            model_name = self.route_model(prompt, history_turns)
+        
+        question_class = classify_question(prompt)
+        thinking = get_thinking_controller()
+        # 只把与问题相关的内部文档块放进提示；输出长度按原始问题确定，输入超长时只裁剪文档部分
+        augment = lazy_import('retrieval').augment_prompt if Config.RAG_ENABLED else None
+        prompt, input_tokens, max_output_tokens = prepare_generation(prompt, max_output_tokens, history, augment)
+        
+        def post(model_name: str):
+            budget = thinking.budget_for(model_name, question_class)
+            data = self.build_request_body(
+                prompt, temperature, top_p, top_k, max_output_tokens, budget, 
+                media_parts=media_parts, history=history
+            )
+            # 流式调用，超时时可以保留已生成的部分内容
+            check_cancelled()
+            remaining = max(timeout - (time.time() - start_time), 0.1)
+            response = get_session().post(
+                self.model_url("streamGenerateContent", model_name=model_name), 
+                params={"alt": "sse"},
+                data=dumps({**data, "safety_settings": SAFETY_SETTINGS_FRAGMENT}), 
+                headers=self.get_auth_headers(remaining), 
+                timeout=(min(remaining, 5), remaining),
+                stream=True
+            )
+            return response, budget
+        
+        # 发送请求
+        response, budget = post(model_name)
+        if response.status_code == 404 and model_name != self.model_name:
+            # 路由到的模型在当前区域不可用时退回默认模型
+            logger.warning("模型 %s 不可用，改用 %s", model_name, self.model_name)
+            metrics.inc("route_fallbacks", model=model_name)
+            response.close()
+            model_name = self.model_name
+            response, budget = post(model_name)
+        if not response.ok:
+            metrics.inc("gemini_errors", model=model_name)
+            response.close()
+        response.raise_for_status()
+        
+        result, truncated = read_sse_stream(response, max(timeout - (time.time() - start_time), 0.1))
+        
+        # 结束计时
+        response_time = time.time() - start_time
+        metrics.observe("gemini_latency_seconds", response_time, model=model_name)
+        
+        # 用实际输入 token 数校准本地估算；图片和文件的 token 不在估算值中，带媒体的请求不参与校准
+        usage = result.get("usageMetadata") or {}
+        if not media_parts:
+            get_token_estimator().record_usage(input_tokens, usage.get("promptTokenCount", 0))
+        
+        text = extract_response_text(result)
+        if truncated:
+            metrics.inc("deadline_exceeded", model=model_name, partial=bool(text))
+            if not text:
+                raise DeadlineExceeded(f"生成超时（{timeout:.1f}秒）")
+            logger.warning("生成超时（%.1f秒），返回已生成的部分内容", timeout)
+            return text + Config.DEADLINE_PARTIAL_NOTICE
+        
+        candidates = result.get("candidates") or [{}]
+        thinking.record(
+            model_name, question_class, budget, text, 
+            candidates[0].get("finishReason"), usage.get("thoughtsTokenCount", 0)
+        )
+        if text:
+            logger.info("Gemini响应成功，模型: %s，耗时: %.2f秒", model_name, response_time)
+        return text
+    
+    def route_model(self, prompt: str, history_turns: int = 0) -> str:
+        """
+        按问题复杂度选择模型
+        
+        Args:
+            prompt: 输入提示
+            history_turns: 当前会话已有的对话轮数
+            
+        Returns:
+            str: 模型名称
+        """
+        router = get_model_router()
+        if router is None:
+            return self.model_name
+        return router.route(prompt, history_turns).model_name
+    
     def generate_content(
         self, 
         prompt: str, 
         temperature: float = 0.3,
         top_p: float = 0.8,
         top_k: int = 40,
-        max_output_tokens: int = 1000
+        max_output_tokens: Optional[int] = None,
+        model_name: Optional[str] = None,
+        history_turns: int = 0,
+        media_parts: Sequence[Any] = (),
+        history: Sequence[Any] = ()
     ) -> str:
         """
         生成内容
@@ -71,89 +501,41 @@ class SimpleGeminiClient:
             temperature: 温度参数
             top_p: top_p参数
             top_k: top_k参数
-            max_output_tokens: 最大输出token数
+            max_output_tokens: 最大输出token数，None 表示自动确定
+            model_name: 指定模型，None 表示按问题复杂度路由
+            history_turns: 当前会话已有的对话轮数
+            media_parts: 图片等媒体片段（media.MediaPart）
+            history: 之前的对话记录（conversation_store.Turn），按时间顺序
             
         Returns:
             str: 生成的内容
         """
         if not self.credentials:
-            return "AI服务未初始化，请稍后再试。"
+            return NOT_INITIALIZED_REPLY
         
         try:
-            # 开始计时
-            start_time = time.time()
-            
-            # 刷新认证令牌
-            self.credentials.refresh(Request())
-            
-            # 构建API URL
-            url = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.model_name}:generateContent"
-            
-            # 构建请求数据
-            data = {
-                "contents": [{
-                    "role": "user",
-                    "parts": [{"text": prompt}]
-                }],
-                "generation_config": {
-                    "temperature": temperature,
-                    "top_p": top_p,
-                    "top_k": top_k,
-                    "max_output_tokens": max_output_tokens
-                },
-                "safety_settings": [
-                    {
-                        "category": "HARM_CATEGORY_HARASSMENT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    }
-                ]
-            }
-            
-            # 发送请求
-            headers = {
-                "Authorization": f"Bearer {self.credentials.token}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(url, json=data, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
-            
-            # 结束计时
-            end_time = time.time()
-            response_time = end_time - start_time
-            
-            # 解析响应
-            if "candidates" in result and len(result["candidates"]) > 0:
-                candidate = result["candidates"][0]
-                if "content" in candidate and "parts" in candidate["content"]:
-                    parts = candidate["content"]["parts"]
-                    if len(parts) > 0 and "text" in parts[0]:
-                        logger.info(f"Gemini响应成功，耗时: {response_time:.2f}秒")
-                        return parts[0]["text"].strip()
+            text = self.generate_content_raw(
+                prompt, temperature, top_p, top_k, max_output_tokens, 
+                model_name=model_name, history_turns=history_turns, 
+                media_parts=media_parts, history=history
+            )
+            if text:
+                return text
             
             logger.warning("Gemini返回空响应")
-            return "抱歉，我无法处理这个问题，请换个方式提问。"
+            return EMPTY_REPLY
             
+        except (DeadlineExceeded, requests.exceptions.Timeout) as e:
+            logger.error("Gemini 生成超时: %s", e)
+            return TIMEOUT_REPLY
+        except GenerationCancelled:
+            return CANCELLED_REPLY
         except requests.exceptions.RequestException as e:
-            logger.error(f"API请求失败: {e}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
+            logger.error("API请求失败: %s", e)
+            return UNAVAILABLE_REPLY
         except Exception as e:
-            logger.error(f"调用 Gemini 模型失败: {e}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
+            logger.error("调用 Gemini 模型失败: %s", e)
+            return UNAVAILABLE_REPLY
 
 # 全局简单客户端实例
 _simple_gemini_client: Optional[SimpleGeminiClient] = None
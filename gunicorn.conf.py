@@ -1,8 +1,14 @@
+from config import Config
+
 bind = "0.0.0.0:5000"
-workers = 4
-worker_class = "sync"
+# 使用 gthread worker：每个 worker 用多个线程同时处理请求，线程数多于 SCHEDULER_SLOTS，
+# 超出名额的请求在 worker 内排队，按优先级和会话公平调度（sync worker 同时只处理一个请求，不会排队）
+workers = Config.GUNICORN_WORKERS
+worker_class = "gthread"
+threads = max(Config.GUNICORN_THREADS, Config.SCHEDULER_SLOTS + 1)
 worker_connections = 1000
-timeout = 30
+# worker 超时在请求截止时间（REQUEST_TIMEOUT）之外留出发送和收尾的余量，避免回答途中被杀掉
+timeout = Config.REQUEST_TIMEOUT + 10
 keepalive = 2
 max_requests = 1000
 max_requests_jitter = 50
@@ -12,4 +18,10 @@ daemon = False
 pidfile = "/tmp/gunicorn.pid"
 accesslog = "/tmp/gunicorn_access.log"
 errorlog = "/tmp/gunicorn_error.log"
-loglevel = "info"
\ No newline at end of file
+loglevel = "info"
+
+
+def post_worker_init(worker):
+    """worker 加载应用后、开始接收请求前预热 DNS、连接池和访问令牌"""
+    from warmup import run_worker_warmup
+    run_worker_warmup()
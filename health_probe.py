@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后台健康探测模块
+后台线程按固定间隔检查访问令牌是否有效、Vertex AI 和钉钉是否可达及其延迟，
+/health/ready 直接返回缓存的最近一次结果，不在请求中发起任何网络调用
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import Config
+from http_pool import get_session
+
+logger = logging.getLogger(__name__)
+
+
+def check_host(host: str) -> Callable[[float], bool]:
+    """
+    生成主机可达性检查：任意 HTTP 响应都说明 DNS、TCP 和 TLS 正常
+
+    Args:
+        host: 主机名
+    """
+    def check(timeout: float) -> bool:
+        get_session().head(f"https://{host}/", timeout=timeout)
+        return True
+    return check
+
+
+class HealthProber:
+    """后台健康探测器，结果整体替换，读取时无需加锁"""
+
+    def __init__(self, interval: Optional[float] = None, timeout: Optional[float] = None):
+        """
+        Args:
+            interval: 探测间隔（秒），默认读取 HEALTH_PROBE_INTERVAL
+            timeout: 单项探测超时（秒），默认读取 HEALTH_PROBE_TIMEOUT
+        """
+        self.interval = interval or Config.HEALTH_PROBE_INTERVAL
+        self.timeout = timeout or Config.HEALTH_PROBE_TIMEOUT
+        self._probes: List[Tuple[str, Callable[[float], Any], bool]] = []
+        self._result: Dict[str, Any] = {"status": "starting", "checked_at": None, "probes": {}}
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def register(self, name: str, check: Callable[[float], Any], critical: bool = True):
+        """
+        注册探测项
+
+        Args:
+            name: 探测项名称
+            check: 检查函数，参数为超时时间，返回假值或抛出异常表示失败
+            critical: 失败时是否判定为未就绪
+        """
+        with self._lock:
+            self._probes = [probe for probe in self._probes if probe[0] != name]
+            self._probes.append((name, check, critical))
+
+    def probe_once(self) -> Dict[str, Any]:
+        """执行一轮探测并更新缓存结果"""
+        probes = {}
+        ready = True
+        for name, check, critical in list(self._probes):
+            start_time = time.time()
+            try:
+                ok = bool(check(self.timeout))
+                error = None if ok else "检查未通过"
+            except Exception as e:
+                ok, error = False, str(e)
+            probes[name] = {
+                "ok": ok,
+                "latency_ms": round((time.time() - start_time) * 1000, 1),
+                "critical": critical,
+            }
+            if error:
+                probes[name]["error"] = error[:200]
+            ready = ready and (ok or not critical)
+
+        result = {
+            "status": "ready" if ready else "not_ready",
+            "checked_at": time.time(),
+            "probes": probes,
+        }
+        self._result = result
+        if not ready:
+            logger.warning("健康探测未通过: %s", {name: probe.get("error") for name, probe in probes.items() if not probe["ok"]})
+        return result
+
+    def _run(self):
+        while True:
+            try:
+                self.probe_once()
+            except Exception as e:
+                logger.error(f"健康探测异常: {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        """启动后台探测线程；gunicorn fork 出的 worker 中会重新启动"""
+        pid = os.getpid()
+        if self._thread_pid == pid:
+            return
+        with self._lock:
+            if self._thread_pid == pid:
+                return
+            self._thread = threading.Thread(target=self._run, name='health-prober', daemon=True)
+            self._thread.start()
+            self._thread_pid = pid
+
+    def readiness(self) -> Tuple[bool, Dict[str, Any]]:
+        """
+        获取缓存的就绪状态
+
+        Returns:
+            tuple: (是否就绪, 最近一次探测结果及其距今秒数)
+        """
+        self.start()
+        result = self._result
+        checked_at = result["checked_at"]
+        age = None if checked_at is None else round(time.time() - checked_at, 1)
+        # 探测线程卡住时结果会过期，此时不再认为就绪
+        stale = age is None or age > self.interval * 3 + self.timeout * len(self._probes)
+        ready = result["status"] == "ready" and not stale
+        return ready, {**result, "age_s": age, "stale": stale}
+
+
+# 进程级全局探测器
+_prober: Optional[HealthProber] = None
+
+
+def get_health_prober() -> HealthProber:
+    """获取全局健康探测器，首次获取时注册钉钉和 Vertex AI 的可达性探测"""
+    global _prober
+
+    if _prober is None:
+        _prober = HealthProber()
+        _prober.register('dingtalk', check_host('oapi.dingtalk.com'))
+        _prober.register('vertex_ai', check_host(f'{Config.GCP_LOCATION}-aiplatform.googleapis.com'))
+    return _prober
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP 连接池模块
+为 Vertex AI 和钉钉请求提供进程内共享的 keep-alive 连接池
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    获取当前进程共享的 HTTP 会话
+
+    gunicorn fork 出的 worker 不能复用父进程的套接字，因此按进程ID重建会话
+
+    Returns:
+        requests.Session: 带连接池的会话
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=Config.HTTP_POOL_CONNECTIONS,
+                pool_maxsize=Config.HTTP_POOL_MAXSIZE
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = pid
+
+    return _session
+
+
+def open_connections(hosts: List[str], timeout: float = 5) -> Dict[str, Optional[float]]:
+    """
+    预先建立到各主机的 TLS 连接并保留在连接池中
+
+    Args:
+        hosts: 主机名列表
+        timeout: 单个主机的超时时间（秒）
+
+    Returns:
+        dict: 各主机建立连接的耗时（秒），失败为 None
+    """
+    session = get_session()
+    results = {}
+
+    for host in hosts:
+        start_time = time.time()
+        try:
+            # 任意 HTTP 响应都说明连接已建立，状态码无关紧要
+            session.head(f"https://{host}/", timeout=timeout)
+            results[host] = time.time() - start_time
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"预建立到 {host} 的连接失败: {e}")
+            results[host] = None
+
+    return results
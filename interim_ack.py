@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+中间确认消息模块
+生成回答超过阈值时间仍未完成时，先发送一条简短的"正在思考…"消息，
+避免用户以为没有响应而重复提问；阈值内完成的回答不会产生额外消息
+"""
+
+import logging
+import threading
+from typing import Callable, Optional
+
+from cancellation import current_cancel_token
+from config import Config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class InterimAck:
+    """
+    中间确认计时器，用法：
+
+        with InterimAck(lambda: send_message("正在思考…")) as ack:
+            answer = generate()
+        # ack.sent 表示是否已发送确认，最终回答作为后续消息发送
+
+    确认消息发送期间生成完成时，退出 with 块会等待确认发送结束，保证确认消息先于回答到达；
+    请求已被取消时不再发送确认
+    """
+
+    def __init__(self, send_ack: Callable[[], object], threshold: Optional[float] = None):
+        """
+        Args:
+            send_ack: 发送确认消息的函数
+            threshold: 阈值（秒），默认读取 INTERIM_ACK_SECONDS；未启用时不发送
+        """
+        self.send_ack = send_ack
+        self.threshold = Config.INTERIM_ACK_SECONDS if threshold is None else threshold
+        self.sent = False
+        self._done = False
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        # 计时器线程中取不到请求上下文，创建时记下取消令牌
+        self._cancel_token = current_cancel_token()
+
+    def _fire(self):
+        # 持有锁发送，finish() 会等待发送完成
+        with self._lock:
+            if self._done or (self._cancel_token and self._cancel_token.cancelled):
+                return
+            self.sent = True
+            try:
+                self.send_ack()
+                metrics.inc("interim_acks")
+            except Exception as e:
+                logger.warning("发送中间确认消息失败: %s", e)
+
+    def start(self) -> "InterimAck":
+        """开始计时"""
+        if Config.INTERIM_ACK_ENABLED and self.threshold > 0:
+            self._timer = threading.Timer(self.threshold, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def finish(self):
+        """生成结束，取消尚未触发的确认"""
+        if self._timer is not None:
+            self._timer.cancel()
+        with self._lock:
+            self._done = True
+
+    def __enter__(self) -> "InterimAck":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish()
+        return False
+
+
+def generate_with_interim_ack(
+    generate: Callable[[], str],
+    send_ack: Callable[[], object],
+    threshold: Optional[float] = None
+) -> str:
+    """
+    调用生成函数，超过阈值时先发送确认消息
+
+    Args:
+        generate: 生成回答的函数
+        send_ack: 发送确认消息的函数
+        threshold: 阈值（秒），默认读取配置
+
+    Returns:
+        str: 生成的回答
+    """
+    with InterimAck(send_ack, threshold) as ack:
+        answer = generate()
+    if ack.sent:
+        logger.info("回答超过 %.1f 秒，已先发送确认消息", ack.threshold)
+    return answer
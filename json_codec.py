@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON 编解码模块
+每个请求要解析 webhook 报文、编码 Vertex AI 请求体、逐段解析流式响应、编码钉钉消息体，
+还要在记录日志时再序列化一次报文。这里统一提供编解码函数：
+安装了 orjson 时使用 orjson，否则退回标准库 json（紧凑格式、不转义中文，结果与 orjson 一致）。
+
+- dumps() 返回 UTF-8 字节，直接作为 requests 的 data 发送，不再经过 str 中转
+- loads() 接受 bytes/str，直接解析 response.content 和 SSE 数据行
+- 每次请求都相同的内容（例如安全设置）用 Fragment 预先编码一次，dumps() 时原样拼接
+- register_json_provider() 让 Flask 的 request.get_json() 和 jsonify() 也使用同一实现
+
+python json_codec.py 对比一次典型请求中各步骤改用本模块前后的耗时
+"""
+
+import sys
+import json
+import time
+import argparse
+from typing import Any, Callable, Dict, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 当前使用的实现
+BACKEND = "orjson" if orjson is not None else "json"
+
+# 发送 JSON 请求体时的请求头
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+if orjson is not None:
+    # 与标准库一致，允许非字符串的字典键
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def _dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+        return orjson.dumps(obj, default=default, option=_OPTIONS)
+
+    def dumps_str(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        """
+        序列化为字符串（日志、WebSocket 文本帧等需要 str 的场合）
+
+        Args:
+            obj: 要序列化的对象
+            default: 无法序列化的对象的转换函数
+
+        Returns:
+            str: 紧凑格式的 JSON，中文不转义
+        """
+        return orjson.dumps(obj, default=default, option=_OPTIONS).decode('utf-8')
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        """
+        解析 JSON
+
+        Args:
+            data: JSON 字节或字符串
+
+        Returns:
+            解析结果
+
+        Raises:
+            ValueError: 不是合法的 JSON（json.JSONDecodeError 的子类）
+        """
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def _dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+        return dumps_str(obj, default).encode('utf-8')
+
+    def dumps_str(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        """
+        序列化为字符串（日志、WebSocket 文本帧等需要 str 的场合）
+
+        Args:
+            obj: 要序列化的对象
+            default: 无法序列化的对象的转换函数
+
+        Returns:
+            str: 紧凑格式的 JSON，中文不转义
+        """
+        if default is None:
+            return _encoder.encode(obj)
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=default)
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        """
+        解析 JSON
+
+        Args:
+            data: JSON 字节或字符串
+
+        Returns:
+            解析结果
+
+        Raises:
+            ValueError: 不是合法的 JSON（json.JSONDecodeError 的子类）
+        """
+        # 钉钉和 Vertex AI 的响应都是 UTF-8，直接解码比 json.loads 自动检测编码快
+        if not isinstance(data, str):
+            data = str(data, 'utf-8')
+        return json.loads(data)
+
+
+class Fragment:
+    """预先编码好的 JSON 片段，作为 dumps() 顶层字典的值时原样拼接"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, value: Any):
+        """
+        Args:
+            value: 片段内容，创建时编码一次
+        """
+        self.data = _dumps(value)
+
+
+def _dumps_with_fragments(obj: Dict[Any, Any], default: Optional[Callable[[Any], Any]]) -> bytes:
+    parts = [
+        _dumps(str(key)) + b':' + (value.data if type(value) is Fragment else _dumps(value, default))
+        for key, value in obj.items()
+    ]
+    return b'{' + b','.join(parts) + b'}'
+
+
+def dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """
+    序列化为 UTF-8 字节
+
+    Args:
+        obj: 要序列化的对象；顶层字典的值可以是 Fragment
+        default: 无法序列化的对象的转换函数
+
+    Returns:
+        bytes: 紧凑格式的 JSON，中文不转义
+    """
+    if type(obj) is dict and any(type(value) is Fragment for value in obj.values()):
+        return _dumps_with_fragments(obj, default)
+    return _dumps(obj, default)
+
+
+def register_json_provider(app):
+    """
+    让 Flask 应用的 request.get_json() 和 jsonify() 使用本模块的编解码实现
+
+    Args:
+        app: Flask 应用
+    """
+    from flask.json.provider import DefaultJSONProvider
+
+    class CodecJSONProvider(DefaultJSONProvider):
+        def dumps(self, obj: Any, **kwargs: Any) -> str:
+            return dumps_str(obj, default=self.default)
+
+        def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+            return loads(s)
+
+    app.json = CodecJSONProvider(app)
+
+
+def _sample_request() -> Dict[str, Any]:
+    """一次典型请求中各步骤处理的数据：webhook 报文、Vertex AI 请求体和流式响应、钉钉消息体"""
+    from gemini_simple import SAFETY_SETTINGS
+
+    question = "请帮我总结一下上周项目例会的主要结论，并列出下周需要跟进的三件事。"
+    answer = "上周例会的主要结论如下：\n1. 接口联调已经完成，性能测试排期到周三。\n" * 8
+    webhook = {
+        "conversationId": "cidEXAMPLE0000000000000000==",
+        "atUsers": [{"dingtalkId": "$:LWCP_v1:$EXAMPLE"}],
+        "chatbotUserId": "$:LWCP_v1:$EXAMPLE",
+        "msgId": "msgEXAMPLE00000000000000==",
+        "senderNick": "张三",
+        "isAdmin": False,
+        "senderStaffId": "manager1234",
+        "sessionWebhookExpiredTime": 1700000000000,
+        "createAt": 1699990000000,
+        "conversationType": "2",
+        "senderId": "$:LWCP_v1:$EXAMPLE",
+        "conversationTitle": "项目组",
+        "isInAtList": True,
+        "sessionWebhook": "https://oapi.dingtalk.com/robot/sendBySession?session=0000000000",
+        "text": {"content": f" {question}"},
+        "robotCode": "dingEXAMPLE",
+        "msgtype": "text",
+    }
+    history = [
+        {"role": "user", "parts": [{"text": "例会一般什么时候开？"}]},
+        {"role": "model", "parts": [{"text": "项目例会通常在每周一上午十点召开。"}]},
+    ]
+    vertex_body = {
+        "contents": history + [{"role": "user", "parts": [{"text": question}]}],
+        "generation_config": {
+            "temperature": 0.3, "top_p": 0.8, "top_k": 40, "max_output_tokens": 1024,
+            "thinking_config": {"thinking_budget": 0},
+        },
+        "safety_settings": SAFETY_SETTINGS,
+    }
+    step = 40
+    sse_chunks = [
+        {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": answer[i:i + step]}]}}],
+            "usageMetadata": {"promptTokenCount": 120, "candidatesTokenCount": i // 2},
+            "modelVersion": "gemini-2.5-flash",
+        }
+        for i in range(0, len(answer), step)
+    ]
+    dingtalk_body = {
+        "msgtype": "text",
+        "text": {"content": answer},
+        "at": {"atMobiles": [], "atUserIds": ["manager1234"], "isAtAll": False},
+    }
+    return {"webhook": webhook, "vertex_body": vertex_body, "sse_chunks": sse_chunks, "dingtalk_body": dingtalk_body}
+
+
+def _time_per_call(func: Callable[[], Any], rounds: int) -> float:
+    """func 每次调用的平均耗时（微秒），取 5 轮中最快的一轮"""
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        best = min(best, (time.perf_counter() - start) / rounds)
+    return best * 1e6
+
+
+def benchmark(rounds: int = 2000) -> Dict[str, Dict[str, float]]:
+    """
+    对比一次典型请求的 JSON 处理耗时：改用本模块前的写法（requests 的 json= / response.json()、
+    Flask 默认实现、每次重新编码安全设置）与当前写法
+
+    Args:
+        rounds: 每个步骤的重复次数
+
+    Returns:
+        dict: {步骤: {"before": 微秒, "after": 微秒}}
+    """
+    sample = _sample_request()
+    webhook_raw = json.dumps(sample["webhook"]).encode('utf-8')
+    sse_lines = [b"data: " + json.dumps(chunk, ensure_ascii=False).encode('utf-8') for chunk in sample["sse_chunks"]]
+    dingtalk_reply = b'{"errcode":0,"errmsg":"ok"}'
+    # 与 gemini_simple 相同，安全设置预先编码
+    vertex_body = dict(sample["vertex_body"], safety_settings=Fragment(sample["vertex_body"]["safety_settings"]))
+
+    steps = {
+        "webhook 解析": (
+            lambda: json.loads(webhook_raw.decode('utf-8')),
+            lambda: loads(webhook_raw),
+        ),
+        "Vertex 请求体编码": (
+            # requests 的 json= 参数：complexjson.dumps(allow_nan=False) 后再编码为 UTF-8
+            lambda: json.dumps(sample["vertex_body"], allow_nan=False).encode('utf-8'),
+            lambda: dumps(vertex_body),
+        ),
+        "Vertex 流式响应解析": (
+            lambda: [json.loads(line[5:]) for line in sse_lines],
+            lambda: [loads(line[5:]) for line in sse_lines],
+        ),
+        "钉钉消息体编码": (
+            lambda: json.dumps(sample["dingtalk_body"], allow_nan=False).encode('utf-8'),
+            lambda: dumps(sample["dingtalk_body"]),
+        ),
+        "钉钉响应解析": (
+            lambda: json.loads(dingtalk_reply.decode('utf-8')),
+            lambda: loads(dingtalk_reply),
+        ),
+        "报文日志序列化": (
+            lambda: json.dumps(sample["webhook"], ensure_ascii=False, default=str),
+            lambda: dumps_str(sample["webhook"], default=str),
+        ),
+    }
+    return {
+        name: {"before": _time_per_call(before, rounds), "after": _time_per_call(after, rounds)}
+        for name, (before, after) in steps.items()
+    }
+
+
+def main():
+    """命令行入口：输出一次典型请求中各步骤的 JSON 处理耗时"""
+    parser = argparse.ArgumentParser(description='对比每个请求的 JSON 编解码耗时')
+    parser.add_argument('--rounds', type=int, default=2000, help='每个步骤的重复次数')
+    args = parser.parse_args()
+
+    results = benchmark(args.rounds)
+    print(f"📊 JSON 编解码耗时（当前实现: {BACKEND}，单位: 微秒/请求）")
+    print(f"{'改用前':>10} {'改用后':>10} {'节省':>8}  步骤")
+    total_before = total_after = 0.0
+    for name, result in results.items():
+        before, after = result["before"], result["after"]
+        total_before += before
+        total_after += after
+        print(f"{before:>10.1f} {after:>10.1f} {(1 - after / before) * 100:>7.0f}%  {name}")
+    print(f"{total_before:>10.1f} {total_after:>10.1f} {(1 - total_after / total_before) * 100:>7.0f}%  合计")
+    if orjson is None:
+        print("💡 安装 orjson（pip install orjson）后自动使用更快的实现")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按键有序执行模块
+同一个键（会话ID）的任务按提交顺序逐个执行，不同键的任务在线程池中并行执行，
+同一会话连续发来的两条消息不会因为并行处理而乱序回复。
+
+每个有任务的键对应一个队列，队列中的任务全部完成后立即删除，空闲的键不占内存；
+一个键的任务执行完后，下一个任务重新排到线程池队尾，消息很多的会话不会长期占住一个线程
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+_Task = Tuple[Future, Callable[..., Any], tuple, dict]
+
+
+class KeyedExecutor:
+    """同键串行、异键并行的执行器"""
+
+    def __init__(self, max_workers: Optional[int] = None, thread_name_prefix: str = ''):
+        """
+        Args:
+            max_workers: 线程数
+            thread_name_prefix: 线程名前缀
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        # 有任务在执行的键 -> 等待执行的任务
+        self._queues: Dict[Hashable, Deque[_Task]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: Optional[Hashable], fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """
+        提交任务
+
+        Args:
+            key: 排序键，相同键的任务按提交顺序执行；为空时不参与排序，直接并行执行
+            fn: 任务函数
+            args: 位置参数
+            kwargs: 关键字参数
+
+        Returns:
+            Future: 任务结果
+        """
+        if key is None or key == '':
+            return self._executor.submit(fn, *args, **kwargs)
+
+        task: _Task = (Future(), fn, args, kwargs)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                # 该键已有任务在执行，排在它后面
+                queue.append(task)
+                return task[0]
+            self._queues[key] = deque()
+        try:
+            self._executor.submit(self._run, key, task)
+        except RuntimeError:
+            with self._lock:
+                del self._queues[key]
+            raise
+        return task[0]
+
+    def _run(self, key: Hashable, task: _Task):
+        while True:
+            future, fn, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                task = queue.popleft()
+            try:
+                self._executor.submit(self._run, key, task)
+                return
+            except RuntimeError:
+                # 执行器已关闭，在当前线程中把剩余任务执行完
+                continue
+
+    def cancel_pending(self, key: Optional[Hashable], predicate: Callable[..., bool]) -> int:
+        """
+        取消某个键下排队等待、尚未开始执行的任务
+
+        Args:
+            key: 排序键
+            predicate: 判断是否取消的函数，参数与任务函数相同
+
+        Returns:
+            int: 取消的任务数
+        """
+        with self._lock:
+            tasks = list(self._queues.get(key) or ())
+        return sum(1 for future, _, args, kwargs in tasks if predicate(*args, **kwargs) and future.cancel())
+
+    @property
+    def active_keys(self) -> int:
+        """有任务在执行或等待的键数"""
+        return len(self._queues)
+
+    def shutdown(self, wait: bool = True):
+        """
+        关闭执行器
+
+        Args:
+            wait: 是否等待已提交的任务完成
+        """
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+非阻塞日志模块
+请求线程只把日志记录放入队列，格式化和写出由后台线程完成；
+webhook 报文等大对象按采样率和长度上限记录
+"""
+
+import os
+import sys
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+from config import Config
+from json_codec import dumps_str
+
+# 标准 LogRecord 自带的属性，JSON 输出时不作为附加字段
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional["NonBlockingQueueHandler"] = None
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """不在请求线程格式化、队列满时直接丢弃的队列处理器"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 同进程队列无需序列化，参数留给后台线程格式化
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """结构化 JSON 日志格式，extra 传入的字段原样输出"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return dumps_str(entry, default=str)
+
+
+class LogClip:
+    """延迟截断的日志参数，避免完整记录过长的文本"""
+
+    __slots__ = ('text', 'max_chars')
+
+    def __init__(self, text: Any, max_chars: Optional[int] = None):
+        self.text = text
+        self.max_chars = Config.LOG_TEXT_MAX_CHARS if max_chars is None else max_chars
+
+    def __str__(self) -> str:
+        text = str(self.text)
+        if self.max_chars <= 0 or len(text) <= self.max_chars:
+            return text
+        return f"{text[:self.max_chars]}...(共{len(text)}字符)"
+
+
+def clip(text: Any, max_chars: Optional[int] = None) -> LogClip:
+    """包装需要截断记录的长文本"""
+    return LogClip(text, max_chars)
+
+
+def log_payload(
+    logger: logging.Logger,
+    message: str,
+    payload: Any,
+    level: int = logging.DEBUG,
+    sample_rate: Optional[float] = None
+):
+    """
+    按采样率和长度上限记录报文，未命中级别或采样时不做任何序列化
+
+    Args:
+        logger: 日志记录器
+        message: 日志说明
+        payload: 报文对象
+        level: 日志级别
+        sample_rate: 采样率，默认读取 LOG_PAYLOAD_SAMPLE_RATE
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    if sample_rate is None:
+        sample_rate = Config.LOG_PAYLOAD_SAMPLE_RATE
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return
+
+    # 在调用线程序列化：报文可能在记录之后被继续修改，留到后台线程序列化会记录到修改后的内容，
+    # 或者遍历时因字典大小变化而出错；截断仍留给后台线程
+    logger.log(level, "%s: %s", message, LogClip(dumps_str(payload, default=str), Config.LOG_PAYLOAD_MAX_CHARS))
+
+
+def _build_output_handler(json_format: bool) -> logging.Handler:
+    """创建实际写出日志的处理器"""
+    handler = logging.StreamHandler(sys.stderr)
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    return handler
+
+
+def _restart_listener_after_fork():
+    """fork 出的子进程不会继承后台线程，需要重新启动监听器"""
+    global _listener
+
+    if _listener is None or _queue_handler is None:
+        return
+
+    _queue_handler.queue = queue.Queue(Config.LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(
+        _queue_handler.queue, *_listener.handlers, respect_handler_level=True
+    )
+    _listener.start()
+
+
+def setup_logging(level: Any = None, json_format: Optional[bool] = None):
+    """
+    配置根日志记录器使用队列异步写出，可重复调用
+
+    Args:
+        level: 日志级别，默认读取 LOG_LEVEL
+        json_format: 是否输出结构化 JSON，默认读取 LOG_JSON
+    """
+    global _listener, _queue_handler
+
+    if level is None:
+        level = Config.LOG_LEVEL
+    if isinstance(level, str):
+        level = getattr(logging, level.upper(), logging.INFO)
+    if json_format is None:
+        json_format = Config.LOG_JSON
+
+    root = logging.getLogger()
+    root.setLevel(level)
+
+    if _listener is not None:
+        return
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(Config.LOG_QUEUE_SIZE))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(
+        _queue_handler.queue, _build_output_handler(json_format), respect_handler_level=True
+    )
+    _listener.start()
+
+    atexit.register(shutdown_logging)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
+
+def shutdown_logging():
+    """停止后台线程并写出队列中剩余的日志"""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_dropped_count() -> int:
+    """获取因队列已满被丢弃的日志条数"""
+    return _queue_handler.dropped if _queue_handler else 0
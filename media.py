@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片和文件消息处理模块
+通过钉钉的 downloadCode 流式下载媒体文件，按内容 sha256 去重；
+图片缩小尺寸并重新编码后作为 inline_data 发送给 Gemini，减少上传字节数和输入 token；
+解码、缩放、编码等 CPU 密集的处理放在独立线程池中执行，不占用请求线程
+"""
+
+import io
+import base64
+import hashlib
+import logging
+import mimetypes
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from config import Config
+from deadline import send_timeout
+from http_pool import get_session
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Gemini 可以直接理解的图片格式
+_IMAGE_MIME_TYPES = {"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"}
+# 可以作为 inline_data 直接发送的文档格式
+_DOCUMENT_MIME_TYPES = {"application/pdf"}
+# 按文本读取并放入提示的文件扩展名
+_TEXT_EXTENSIONS = {
+    ".txt", ".md", ".csv", ".json", ".log", ".xml", ".yaml", ".yml", ".ini", ".conf",
+    ".py", ".js", ".ts", ".java", ".go", ".c", ".cpp", ".h", ".sql", ".sh", ".html", ".css",
+}
+
+
+class MediaError(Exception):
+    """媒体文件无法处理，消息内容可以直接回复给用户"""
+
+
+class MediaPart(NamedTuple):
+    """发送给 Gemini 的一个媒体片段"""
+    mime_type: str
+    data: bytes
+    sha256: str
+
+    def to_rest(self) -> Dict[str, Any]:
+        """转换为 REST 接口的 inline_data 片段"""
+        return {"inline_data": {"mime_type": self.mime_type, "data": base64.b64encode(self.data).decode('ascii')}}
+
+
+class IncomingMessage(NamedTuple):
+    """从 webhook 消息中解析出的用户输入"""
+    text: str
+    media: Tuple[MediaPart, ...]
+
+
+def _sniff_image_mime(data: bytes) -> Optional[str]:
+    """根据文件头判断图片格式"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return "image/jpeg"
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return "image/png"
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return "image/webp"
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return "image/gif"
+    if data[:2] == b'BM':
+        return "image/bmp"
+    return None
+
+
+def downscale_image(data: bytes, max_side: Optional[int] = None, quality: Optional[int] = None) -> Tuple[bytes, str]:
+    """
+    缩小图片并重新编码
+
+    长边超过 max_side 时等比缩小；不透明图片编码为 JPEG，带透明通道的编码为 PNG。
+    重新编码后反而更大时保留原图。未安装 Pillow 时原样返回
+
+    Args:
+        data: 原始图片
+        max_side: 长边最大像素，默认读取 IMAGE_MAX_SIDE
+        quality: JPEG 质量，默认读取 IMAGE_JPEG_QUALITY
+
+    Returns:
+        tuple: (图片数据, MIME 类型)
+    """
+    original_mime = _sniff_image_mime(data) or "application/octet-stream"
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, original_mime
+
+    max_side = max_side or Config.IMAGE_MAX_SIDE
+    quality = quality or Config.IMAGE_JPEG_QUALITY
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', (max_side, max_side))  # JPEG 解码时直接按缩小后的尺寸解码
+        image.load()
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        output = io.BytesIO()
+        if has_alpha:
+            image.save(output, format='PNG', optimize=True)
+            mime_type = "image/png"
+        else:
+            image.convert('RGB').save(output, format='JPEG', quality=quality, optimize=True)
+            mime_type = "image/jpeg"
+
+    encoded = output.getvalue()
+    if len(encoded) >= len(data) and original_mime in _IMAGE_MIME_TYPES:
+        return data, original_mime
+    return encoded, mime_type
+
+
+class MediaProcessor:
+    """媒体下载和处理：按内容哈希缓存处理结果，图片处理在线程池中执行"""
+
+    def __init__(self, max_workers: Optional[int] = None, cache_bytes: Optional[int] = None):
+        """
+        Args:
+            max_workers: 图片处理线程数，默认读取 MEDIA_WORKERS
+            cache_bytes: 处理结果缓存的总字节数上限，默认读取 MEDIA_CACHE_BYTES
+        """
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or Config.MEDIA_WORKERS, thread_name_prefix='media'
+        )
+        self.cache_bytes = cache_bytes or Config.MEDIA_CACHE_BYTES
+        self._cache: "OrderedDict[str, MediaPart]" = OrderedDict()
+        self._cached_size = 0
+        # 钉钉重发同一条消息时 downloadCode 相同，可以跳过下载
+        self._code_to_hash: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_get(self, sha256: str) -> Optional[MediaPart]:
+        with self._lock:
+            part = self._cache.get(sha256)
+            if part is not None:
+                self._cache.move_to_end(sha256)
+            return part
+
+    def _cache_put(self, download_code: str, part: MediaPart, original_sha256: str):
+        with self._lock:
+            if original_sha256 not in self._cache:
+                self._cache[original_sha256] = part
+                self._cached_size += len(part.data)
+            self._code_to_hash[download_code] = original_sha256
+            while self._cached_size > self.cache_bytes and self._cache:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_size -= len(evicted.data)
+            while len(self._code_to_hash) > 10000:
+                self._code_to_hash.popitem(last=False)
+
+    @staticmethod
+    def download(url: str, max_bytes: Optional[int] = None) -> Tuple[bytes, str]:
+        """
+        流式下载文件，边下载边计算 sha256，超过大小上限时中止
+
+        Args:
+            url: 下载地址
+            max_bytes: 文件大小上限，默认读取 MEDIA_MAX_BYTES
+
+        Returns:
+            tuple: (文件内容, sha256)
+        """
+        max_bytes = max_bytes or Config.MEDIA_MAX_BYTES
+        hasher = hashlib.sha256()
+        buffer = bytearray()
+        with get_session().get(url, stream=True, timeout=send_timeout(30)) as response:
+            response.raise_for_status()
+            if int(response.headers.get('Content-Length') or 0) > max_bytes:
+                raise MediaError(f"文件超过 {max_bytes // (1024 * 1024)}MB，暂不支持")
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                hasher.update(chunk)
+                buffer += chunk
+                if len(buffer) > max_bytes:
+                    raise MediaError(f"文件超过 {max_bytes // (1024 * 1024)}MB，暂不支持")
+        metrics.observe("media_download_bytes", len(buffer))
+        return bytes(buffer), hasher.hexdigest()
+
+    def fetch(self, openapi, download_code: str, robot_code: str = "") -> Tuple[bytes, str, Optional[MediaPart]]:
+        """
+        按 downloadCode 获取文件，已处理过的内容直接返回缓存结果
+
+        Returns:
+            tuple: (文件内容, sha256, 缓存的处理结果)；命中缓存时文件内容为空
+        """
+        with self._lock:
+            known_hash = self._code_to_hash.get(download_code)
+        if known_hash:
+            part = self._cache_get(known_hash)
+            if part is not None:
+                metrics.inc("media_cache_hits")
+                return b"", known_hash, part
+
+        url = openapi.get_download_url(download_code, robot_code)
+        data, sha256 = self.download(url)
+        part = self._cache_get(sha256)
+        if part is not None:
+            metrics.inc("media_cache_hits")
+            with self._lock:
+                self._code_to_hash[download_code] = sha256
+        return data, sha256, part
+
+    def process_image(self, openapi, download_code: str, robot_code: str = "") -> MediaPart:
+        """
+        下载并处理图片
+
+        Args:
+            openapi: DingTalkOpenAPI
+            download_code: 图片的 downloadCode
+            robot_code: 机器人编码
+
+        Returns:
+            MediaPart: 处理后的图片
+        """
+        data, sha256, part = self.fetch(openapi, download_code, robot_code)
+        if part is not None:
+            return part
+
+        if _sniff_image_mime(data) is None:
+            raise MediaError("无法识别的图片格式")
+        # 解码和编码在线程池中执行，避免多个请求同时处理大图时占满请求线程
+        processed, mime_type = self._executor.submit(downscale_image, data).result()
+        if mime_type not in _IMAGE_MIME_TYPES:
+            raise MediaError("暂不支持该图片格式，请发送 JPG 或 PNG 图片")
+        metrics.observe("media_image_bytes_saved", len(data) - len(processed))
+        part = MediaPart(mime_type, processed, sha256)
+        self._cache_put(download_code, part, sha256)
+        return part
+
+    def process_file(
+        self, openapi, download_code: str, file_name: str, robot_code: str = ""
+    ) -> Tuple[Optional[MediaPart], str]:
+        """
+        下载并处理文件：图片和 PDF 作为媒体片段，文本文件读取为文本
+
+        Returns:
+            tuple: (媒体片段, 文件文本)，两者只有一个有值
+        """
+        extension = ('.' + file_name.rsplit('.', 1)[-1].lower()) if '.' in file_name else ''
+        mime_type = mimetypes.guess_type(file_name)[0] or ''
+        if extension not in _TEXT_EXTENSIONS and not mime_type.startswith('image/') \
+                and mime_type not in _DOCUMENT_MIME_TYPES:
+            raise MediaError(f"暂不支持 {extension or '该类型的'} 文件，目前支持图片、PDF 和文本文件")
+
+        if mime_type.startswith('image/'):
+            return self.process_image(openapi, download_code, robot_code), ""
+
+        data, sha256, part = self.fetch(openapi, download_code, robot_code)
+        if part is not None:
+            return (part, "") if part.mime_type in _DOCUMENT_MIME_TYPES else (None, part.data.decode('utf-8'))
+
+        if mime_type in _DOCUMENT_MIME_TYPES:
+            part = MediaPart(mime_type, data, sha256)
+            self._cache_put(download_code, part, sha256)
+            return part, ""
+
+        for encoding in ('utf-8', 'gb18030'):
+            try:
+                text = data.decode(encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            raise MediaError("无法读取文件内容，请确认文件编码")
+        # 以 UTF-8 缓存文本文件，命中缓存时直接解码
+        self._cache_put(download_code, MediaPart("text/plain", text.encode('utf-8'), sha256), sha256)
+        return None, text
+
+
+def parse_incoming_message(data: Dict[str, Any], openapi=None, processor: Optional[MediaProcessor] = None) -> IncomingMessage:
+    """
+    解析 webhook 消息中的文本、图片和文件
+
+    Args:
+        data: webhook 消息
+        openapi: DingTalkOpenAPI，用于下载图片和文件；为 None 时遇到媒体消息会报错
+        processor: 媒体处理器，默认使用全局实例
+
+    Returns:
+        IncomingMessage: 文本和媒体片段
+
+    Raises:
+        MediaError: 媒体无法下载或处理，消息内容可以直接回复给用户
+    """
+    msg_type = data.get('msgtype')
+    if msg_type == 'text':
+        return IncomingMessage(data.get('text', {}).get('content', '').strip(), ())
+
+    if msg_type not in ('picture', 'file', 'richText'):
+        raise MediaError(f"暂不支持 {msg_type} 类型的消息")
+    if openapi is None:
+        raise MediaError("未配置钉钉应用凭证（DINGTALK_APP_KEY/DINGTALK_APP_SECRET），暂时无法读取图片和文件")
+
+    processor = processor or get_media_processor()
+    robot_code = data.get('robotCode', '')
+    content = data.get('content') or {}
+    texts: List[str] = []
+    media: List[MediaPart] = []
+
+    try:
+        if msg_type == 'picture':
+            media.append(processor.process_image(openapi, content.get('downloadCode', ''), robot_code))
+        elif msg_type == 'file':
+            file_name = content.get('fileName', '')
+            part, file_text = processor.process_file(openapi, content.get('downloadCode', ''), file_name, robot_code)
+            if part is not None:
+                media.append(part)
+            else:
+                texts.append(f"文件 {file_name} 的内容：\n{file_text}")
+        else:
+            for item in content.get('richText', []):
+                if item.get('text'):
+                    texts.append(item['text'].strip())
+                elif item.get('downloadCode'):
+                    media.append(processor.process_image(openapi, item['downloadCode'], robot_code))
+    except MediaError:
+        raise
+    except Exception as e:
+        logger.error("下载或处理媒体文件失败: %s", e)
+        raise MediaError("图片或文件读取失败，请稍后重试")
+
+    metrics.inc("media_messages", msgtype=msg_type)
+    return IncomingMessage("\n".join(text for text in texts if text), tuple(media))
+
+
+# 进程级全局媒体处理器
+_processor: Optional[MediaProcessor] = None
+_processor_lock = threading.Lock()
+
+
+def get_media_processor() -> MediaProcessor:
+    """获取全局媒体处理器"""
+    global _processor
+
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = MediaProcessor()
+    return _processor
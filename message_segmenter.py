@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+长回复分段模块
+按代码块、段落、句子边界把回答切分为不超过钉钉消息长度限制的多段，
+并为每段选择 text 或 markdown 消息类型
+"""
+
+import re
+import queue
+import contextvars
+import logging
+import threading
+from typing import Iterator, List, Optional, Sequence, Tuple, Callable
+
+from cancellation import current_cancel_token
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 代码块（```lang ... ```）
+_CODE_BLOCK_RE = re.compile(r'```[^\n]*\n.*?(?:```|$)', re.S)
+# 句子结束位置：中英文句末标点或换行之后
+_SENTENCE_END_RE = re.compile(r'(?<=[。！？；!?;])|(?<=\.\s)|(?<=\n)')
+# 需要使用 markdown 消息才能正确显示的格式
+_MARKDOWN_RE = re.compile(r'```|^#{1,6}\s|^\s*[-*+]\s|^\s*\d+\.\s|\*\*[^*]+\*\*|\[[^\]]+\]\([^)]+\)|^\|.*\|$', re.M)
+
+
+def _byte_len(text: str) -> int:
+    return len(text.encode('utf-8'))
+
+
+def _split_blocks(text: str) -> List[Tuple[str, bool]]:
+    """
+    把文本拆分为代码块和段落
+
+    Returns:
+        list: (块内容, 是否代码块) 列表
+    """
+    blocks = []
+    position = 0
+    for match in _CODE_BLOCK_RE.finditer(text):
+        for paragraph in re.split(r'\n\s*\n', text[position:match.start()]):
+            if paragraph.strip():
+                blocks.append((paragraph.strip('\n'), False))
+        blocks.append((match.group(0).rstrip(), True))
+        position = match.end()
+
+    for paragraph in re.split(r'\n\s*\n', text[position:]):
+        if paragraph.strip():
+            blocks.append((paragraph.strip('\n'), False))
+    return blocks
+
+
+def _hard_split(text: str, max_bytes: int) -> Iterator[str]:
+    """在字符边界上按字节数强制切分"""
+    current = []
+    size = 0
+    for char in text:
+        char_size = _byte_len(char)
+        if size + char_size > max_bytes and current:
+            yield ''.join(current)
+            current, size = [], 0
+        current.append(char)
+        size += char_size
+    if current:
+        yield ''.join(current)
+
+
+def _split_paragraph(paragraph: str, max_bytes: int) -> Iterator[str]:
+    """把超长段落按句子切分，单句仍超长时强制切分"""
+    current = ''
+    for sentence in _SENTENCE_END_RE.split(paragraph):
+        if not sentence:
+            continue
+        if _byte_len(current + sentence) <= max_bytes:
+            current += sentence
+            continue
+        if current:
+            yield current
+        if _byte_len(sentence) <= max_bytes:
+            current = sentence
+        else:
+            *pieces, current = _hard_split(sentence, max_bytes)
+            yield from pieces
+    if current:
+        yield current
+
+
+def _split_code_block(block: str, max_bytes: int) -> Iterator[str]:
+    """把超长代码块按行切分，每段重新补齐代码围栏"""
+    lines = block.split('\n')
+    fence_open = lines[0]
+    body = lines[1:-1] if lines[-1].strip() == '```' else lines[1:]
+    overhead = _byte_len(fence_open) + len('\n\n```')
+
+    current: List[str] = []
+    size = overhead
+    for line in body:
+        line_size = _byte_len(line) + 1
+        if size + line_size > max_bytes and current:
+            yield '\n'.join([fence_open, *current, '```'])
+            current, size = [], overhead
+        if overhead + line_size > max_bytes:
+            for piece in _hard_split(line, max_bytes - overhead):
+                yield '\n'.join([fence_open, piece, '```'])
+            continue
+        current.append(line)
+        size += line_size
+    if current:
+        yield '\n'.join([fence_open, *current, '```'])
+
+
+def segment_text(text: str, max_bytes: int) -> Iterator[str]:
+    """
+    按代码块、段落、句子边界切分长文本，每段不超过 max_bytes 字节
+
+    以生成器形式逐段产出，调用方可以在后续分段计算完成前先发送第一段
+
+    Args:
+        text: 原始文本
+        max_bytes: 每段最大字节数（UTF-8）
+
+    Yields:
+        str: 分段文本
+    """
+    if _byte_len(text) <= max_bytes:
+        yield text
+        return
+
+    current = ''
+    for block, is_code in _split_blocks(text):
+        candidate = f"{current}\n\n{block}" if current else block
+        if _byte_len(candidate) <= max_bytes:
+            current = candidate
+            continue
+
+        if current:
+            yield current
+            current = ''
+
+        if _byte_len(block) <= max_bytes:
+            current = block
+            continue
+
+        pieces = list(_split_code_block(block, max_bytes) if is_code else _split_paragraph(block, max_bytes))
+        yield from pieces[:-1]
+        current = pieces[-1]
+
+    if current:
+        yield current
+
+
+def choose_msgtype(segment: str) -> str:
+    """
+    根据内容选择钉钉消息类型
+
+    Args:
+        segment: 分段文本
+
+    Returns:
+        str: 'markdown' 或 'text'
+    """
+    return 'markdown' if _MARKDOWN_RE.search(segment) else 'text'
+
+
+def with_mentions(segment: str, msgtype: str, at_user_ids: Optional[Sequence[str]]) -> str:
+    """
+    markdown 消息中的 @ 需要正文里同时出现 "@用户ID"，只设置 at.atUserIds 不会提醒对方
+
+    Args:
+        segment: 分段文本
+        msgtype: 消息类型
+        at_user_ids: 要 @ 的用户ID列表
+
+    Returns:
+        str: markdown 消息在开头补上缺少的 "@用户ID"，text 消息原样返回
+    """
+    if msgtype != 'markdown' or not at_user_ids:
+        return segment
+    missing = [f"@{user_id}" for user_id in at_user_ids if f"@{user_id}" not in segment]
+    return f"{' '.join(missing)}\n\n{segment}" if missing else segment
+
+
+def send_in_segments(
+    text: str,
+    send_segment: Callable[[str, str, int], bool],
+    max_bytes: int,
+    at_user_ids: Optional[Sequence[str]] = None
+) -> bool:
+    """
+    分段发送长文本：后台线程按顺序发送，当前线程继续切分和格式化后续分段；
+    不需要分段时直接在当前线程发送
+
+    Args:
+        text: 原始文本
+        send_segment: 发送函数，参数为 (分段文本, 消息类型, 分段序号)，返回是否成功
+        max_bytes: 每段最大字节数
+        at_user_ids: 第一段要 @ 的用户ID列表，markdown 分段会在正文中补上 "@用户ID"
+
+    Returns:
+        bool: 所有分段是否都发送成功（请求被取消、剩余分段未发送时为 False）
+    """
+    cancel_token = current_cancel_token()
+
+    if _byte_len(text) <= max_bytes:
+        if cancel_token is not None and cancel_token.cancelled:
+            metrics.inc("segments_cancelled")
+            return False
+        msgtype = choose_msgtype(text)
+        return send_segment(with_mentions(text, msgtype, at_user_ids), msgtype, 0)
+
+    segments: "queue.Queue" = queue.Queue()
+    results: List[bool] = []
+
+    def sender():
+        index = 0
+        while True:
+            item = segments.get()
+            if item is None:
+                return
+            segment, msgtype = item
+            # 前一段失败后不再发送，避免用户收到不完整且乱序的内容
+            if results and not results[-1]:
+                continue
+            # 用户已取消或重新提问，剩余分段不再发送
+            if cancel_token is not None and cancel_token.cancelled:
+                metrics.inc("segments_cancelled")
+                results.append(False)
+                continue
+            if index == 0:
+                segment = with_mentions(segment, msgtype, at_user_ids)
+            results.append(send_segment(segment, msgtype, index))
+            index += 1
+
+    # 发送线程沿用当前上下文（例如请求截止时间）
+    context = contextvars.copy_context()
+    sender_thread = threading.Thread(target=context.run, args=(sender,), name='segment-sender', daemon=True)
+    sender_thread.start()
+
+    count = 0
+    try:
+        for segment in segment_text(text, max_bytes):
+            segments.put((segment, choose_msgtype(segment)))
+            count += 1
+    finally:
+        segments.put(None)
+        sender_thread.join()
+
+    if count > 1:
+        logger.info("长回复分 %d 段发送", count)
+    return bool(results) and all(results)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+进程内指标模块
+记录计数器和耗时/数值分布，通过 /metrics 接口以 JSON 输出
+"""
+
+import time
+import threading
+from collections import deque
+from typing import Dict, Any, Deque
+
+# 每个分布指标保留的最近样本数，用于计算分位数
+_SAMPLE_WINDOW = 1024
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> str:
+    if not labels:
+        return name
+    label_text = ','.join(f"{key}={labels[key]}" for key in sorted(labels))
+    return f"{name}{{{label_text}}}"
+
+
+class _Summary:
+    """数值分布：累计次数/总和/最值，以及最近样本的分位数"""
+
+    __slots__ = ('count', 'total', 'min', 'max', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.samples: Deque[float] = deque(maxlen=_SAMPLE_WINDOW)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def snapshot(self) -> Dict[str, float]:
+        ordered = sorted(self.samples)
+
+        def quantile(q: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 4),
+            "min": round(self.min, 4),
+            "max": round(self.max, 4),
+            "p50": quantile(0.5),
+            "p95": quantile(0.95),
+        }
+
+
+class Metrics:
+    """线程安全的指标注册表"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._summaries: Dict[str, _Summary] = {}
+        self._started_at = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        累加计数器
+
+        Args:
+            name: 指标名
+            value: 增量
+            labels: 标签，例如 model="gemini-2.5-flash"
+        """
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        记录一个样本值（耗时、比例等）
+
+        Args:
+            name: 指标名
+            value: 样本值
+            labels: 标签
+        """
+        key = _metric_key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = _Summary()
+            summary.observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """获取所有指标的当前值"""
+        with self._lock:
+            return {
+                "uptime_s": round(time.time() - self._started_at, 1),
+                "counters": dict(self._counters),
+                "summaries": {key: summary.snapshot() for key, summary in self._summaries.items()},
+            }
+
+
+# 进程级全局指标
+metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """获取全局指标注册表"""
+    return metrics
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模型路由模块
+根据问题长度、关键词、是否包含代码和对话轮数，在本地判断问题复杂度，
+简单问题使用 lite 模型，复杂问题使用 pro 模型，其余使用默认的 flash 模型
+"""
+
+import re
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from config import Config
+from metrics import metrics
+from token_estimator import classify_question
+
+logger = logging.getLogger(__name__)
+
+# 提示需要深入推理的关键词
+_HARD_KEYWORDS_RE = re.compile(
+    r'为什么|原理|分析|对比|比较|区别|设计|架构|优化|性能|排查|报错|异常|调试|算法|证明|推导|'
+    r'权衡|方案|评估|重构|并发|死锁|内存泄漏|why|explain|analy[sz]e|design|architecture|'
+    r'optimi[sz]e|debug|trade-?off|prove|algorithm',
+    re.I
+)
+# 代码或堆栈特征
+_CODE_RE = re.compile(r'```|Traceback \(most recent call last\)|Exception|^\s+at \S+\(|[{};]\s*$|^\s*(def|class|import|function|public|SELECT)\s', re.M)
+# 多个问题
+_QUESTION_MARK_RE = re.compile(r'[?？]')
+
+# 路由档位
+TIER_LITE = "lite"
+TIER_FLASH = "flash"
+TIER_PRO = "pro"
+
+
+class RouteDecision(NamedTuple):
+    """路由结果"""
+    tier: str
+    model_name: str
+    score: int
+    reasons: Tuple[str, ...]
+
+
+class ModelRouter:
+    """基于规则打分的模型路由器，纯本地计算，每次判断耗时在微秒级"""
+
+    def __init__(self, models: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            models: 各档位使用的模型名称，默认读取配置
+        """
+        self.models = models or {
+            TIER_LITE: Config.MODEL_LITE,
+            TIER_FLASH: Config.MODEL_NAME,
+            TIER_PRO: Config.MODEL_PRO,
+        }
+
+    def score(self, question: str, history_turns: int = 0) -> Tuple[int, List[str]]:
+        """
+        计算问题复杂度分数
+
+        Args:
+            question: 问题内容
+            history_turns: 当前会话已有的对话轮数
+
+        Returns:
+            tuple: (分数, 加减分原因)
+        """
+        score = 0
+        reasons = []
+        length = len(question)
+
+        if length < 20:
+            score -= 1
+            reasons.append("short")
+        elif length > 1500:
+            score += 2
+            reasons.append("very_long")
+        elif length > 300:
+            score += 1
+            reasons.append("long")
+
+        if _CODE_RE.search(question):
+            score += 2
+            reasons.append("code")
+
+        keyword_hits = len(_HARD_KEYWORDS_RE.findall(question))
+        if keyword_hits:
+            score += min(keyword_hits, 2)
+            reasons.append("keywords")
+
+        if classify_question(question) == "long_form":
+            score += 2
+            reasons.append("long_form")
+
+        if len(_QUESTION_MARK_RE.findall(question)) >= 3:
+            score += 1
+            reasons.append("multi_question")
+
+        if history_turns >= 4:
+            score += 1
+            reasons.append("history")
+
+        return score, reasons
+
+    def tier(self, question: str, history_turns: int = 0) -> Tuple[str, int, List[str]]:
+        """
+        判断问题的档位，不记录指标
+
+        Args:
+            question: 问题内容
+            history_turns: 当前会话已有的对话轮数
+
+        Returns:
+            tuple: (档位, 得分, 原因)
+        """
+        if classify_question(question) == "greeting":
+            score, reasons = -2, ["greeting"]
+        else:
+            score, reasons = self.score(question, history_turns)
+
+        if score <= 0:
+            return TIER_LITE, score, reasons
+        if score >= 3:
+            return TIER_PRO, score, reasons
+        return TIER_FLASH, score, reasons
+
+    def route(self, question: str, history_turns: int = 0) -> RouteDecision:
+        """
+        为问题选择模型
+
+        Args:
+            question: 问题内容
+            history_turns: 当前会话已有的对话轮数
+
+        Returns:
+            RouteDecision: 路由结果
+        """
+        tier, score, reasons = self.tier(question, history_turns)
+        decision = RouteDecision(tier, self.models[tier], score, tuple(reasons))
+        metrics.inc("route_decisions", tier=tier, model=decision.model_name)
+        logger.debug("模型路由: %s -> %s (score=%d, %s)", tier, decision.model_name, score, reasons)
+        return decision
+
+
+# 进程级全局路由器
+_router: Optional[ModelRouter] = None
+
+
+def get_model_router() -> Optional[ModelRouter]:
+    """获取全局模型路由器，未启用路由时返回 None"""
+    global _router
+
+    if not Config.MODEL_ROUTING_ENABLED:
+        return None
+    if _router is None:
+        _router = ModelRouter()
+    return _router
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+回复路由模块
+缓存每个会话的 sessionWebhook（按 sessionWebhookExpiredTime 过期），
+为每条回复选择代价最低的可用通道：sessionWebhook → OpenAPI → robot/send，
+当前通道过期或发送失败时自动改用下一个。
+
+自定义机器人的 robot/send 只能发到机器人所在的那个群，只用于回复该群（或没有会话信息的消息），
+单聊和其他群的 sessionWebhook 过期后只能通过 OpenAPI 回复，避免回复被发到错误的群
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from config import Config
+from metrics import metrics
+from message_segmenter import send_in_segments
+from utils import SharedTokenBucket
+
+logger = logging.getLogger(__name__)
+
+ROUTE_SESSION_WEBHOOK = "session_webhook"
+ROUTE_ROBOT_SEND = "robot_send"
+ROUTE_OPENAPI = "openapi"
+
+# 钉钉单聊的 conversationType
+_SINGLE_CHAT = "1"
+
+
+class ReplyTarget(NamedTuple):
+    """回复目标：从 webhook 消息中提取的会话信息"""
+    conversation_id: str
+    conversation_type: str
+    sender_staff_id: str
+
+
+class SessionWebhookCache:
+    """按会话缓存 sessionWebhook，线程安全，超过容量时淘汰最久未使用的会话"""
+
+    def __init__(self, max_size: Optional[int] = None, margin: Optional[float] = None):
+        """
+        Args:
+            max_size: 最多缓存的会话数，默认读取 SESSION_WEBHOOK_CACHE_SIZE
+            margin: 距离过期不足该秒数时视为已过期，默认读取 SESSION_WEBHOOK_EXPIRY_MARGIN
+        """
+        self.max_size = max_size or Config.SESSION_WEBHOOK_CACHE_SIZE
+        self.margin = Config.SESSION_WEBHOOK_EXPIRY_MARGIN if margin is None else margin
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, conversation_id: str, session_webhook: str, expired_time_ms: Optional[int]):
+        """
+        记录会话最新的 sessionWebhook
+
+        Args:
+            conversation_id: 会话ID
+            session_webhook: sessionWebhook 地址
+            expired_time_ms: sessionWebhookExpiredTime（毫秒时间戳），缺失时不缓存
+        """
+        if not conversation_id or not session_webhook or not expired_time_ms:
+            return
+        with self._lock:
+            self._entries[conversation_id] = (session_webhook, int(expired_time_ms) / 1000.0)
+            self._entries.move_to_end(conversation_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get(self, conversation_id: str) -> Optional[str]:
+        """
+        获取会话仍然有效的 sessionWebhook
+
+        Returns:
+            str: sessionWebhook 地址，不存在或即将过期时为 None
+        """
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return None
+            session_webhook, expires_at = entry
+            if time.time() + self.margin >= expires_at:
+                del self._entries[conversation_id]
+                return None
+            self._entries.move_to_end(conversation_id)
+            return session_webhook
+
+    def invalidate(self, conversation_id: str):
+        """发送失败时移除会话的 sessionWebhook"""
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ReplyRouter:
+    """回复路由器：为每条回复选择代价最低的可用通道，失败时自动回退"""
+
+    def __init__(
+        self, 
+        bot=None, 
+        openapi=None, 
+        cache: Optional[SessionWebhookCache] = None,
+        namespace: str = "",
+        robot_send_per_minute: Optional[int] = None,
+        robot_conversation_id: Optional[str] = None
+    ):
+        """
+        Args:
+            bot: DingTalkBot，提供 sessionWebhook 和 robot/send 通道
+            openapi: DingTalkOpenAPI，未配置应用凭证时为 None
+            cache: sessionWebhook 缓存，默认新建；多个机器人可以共用一个缓存
+            namespace: 共用缓存时区分机器人的键前缀（同一个群里不同机器人的 sessionWebhook 不同）
+            robot_send_per_minute: robot/send 每分钟限额，默认读取 ROBOT_SEND_PER_MINUTE
+            robot_conversation_id: 自定义机器人所在群的 conversationId，默认读取 DINGTALK_ROBOT_CONVERSATION_ID；
+                未配置时 robot/send 只用于没有会话信息的消息
+        """
+        self.bot = bot
+        self.openapi = openapi
+        self.cache = cache or SessionWebhookCache()
+        self.namespace = namespace
+        self.robot_conversation_id = (
+            Config.DINGTALK_ROBOT_CONVERSATION_ID if robot_conversation_id is None else robot_conversation_id
+        )
+        # 自定义机器人 robot/send 每分钟最多 20 条；计数放在共享内存中，多个 worker 合计不超过限额
+        per_minute = robot_send_per_minute or Config.ROBOT_SEND_PER_MINUTE
+        self.robot_send_limiter = SharedTokenBucket(per_minute / 60.0, capacity=per_minute)
+    
+    def _cache_key(self, conversation_id: str) -> str:
+        return f"{self.namespace}:{conversation_id}" if self.namespace else conversation_id
+
+    def remember(self, data: Dict[str, Any]) -> ReplyTarget:
+        """
+        从 webhook 消息中记录 sessionWebhook 并提取回复目标
+
+        Args:
+            data: 钉钉 webhook 消息
+
+        Returns:
+            ReplyTarget: 回复目标
+        """
+        target = ReplyTarget(
+            conversation_id=data.get('conversationId', ''),
+            conversation_type=str(data.get('conversationType', '')),
+            sender_staff_id=data.get('senderStaffId', '')
+        )
+        if target.conversation_id:
+            self.cache.update(
+                self._cache_key(target.conversation_id), 
+                data.get('sessionWebhook', ''), 
+                data.get('sessionWebhookExpiredTime')
+            )
+        return target
+
+    def _routes(self, target: ReplyTarget) -> List[str]:
+        """按代价从低到高列出当前可用的通道"""
+        routes = []
+        if target.conversation_id and self.cache.get(self._cache_key(target.conversation_id)):
+            routes.append(ROUTE_SESSION_WEBHOOK)
+
+        if self.openapi is not None and (
+            target.sender_staff_id if target.conversation_type == _SINGLE_CHAT else target.conversation_id
+        ):
+            routes.append(ROUTE_OPENAPI)
+        # robot/send 固定发到机器人所在的群，不能用于单聊或其他群
+        if self.bot and self.bot.access_token and target.conversation_type != _SINGLE_CHAT and (
+            not target.conversation_id or target.conversation_id == self.robot_conversation_id
+        ):
+            routes.append(ROUTE_ROBOT_SEND)
+        return routes
+
+    def _send_via(
+        self,
+        route: str,
+        target: ReplyTarget,
+        msg: str,
+        at_user_ids: Optional[List[str]],
+        msgtype: str
+    ) -> dict:
+        if route == ROUTE_SESSION_WEBHOOK:
+            session_webhook = self.cache.get(self._cache_key(target.conversation_id))
+            if not session_webhook:
+                return {"errcode": -1, "errmsg": "sessionWebhook 已过期"}
+            return self.bot.send_session_message(session_webhook, msg, at_user_ids=at_user_ids, msgtype=msgtype)
+        if route == ROUTE_ROBOT_SEND:
+            return self.bot.send_message(msg, at_user_ids=at_user_ids, msgtype=msgtype)
+        if target.conversation_type == _SINGLE_CHAT:
+            return self.openapi.send_user_message([target.sender_staff_id], msg, msgtype=msgtype)
+        return self.openapi.send_group_message(target.conversation_id, msg, msgtype=msgtype)
+
+    def send(
+        self,
+        target: Optional[ReplyTarget],
+        msg: str,
+        at_user_ids: Optional[List[str]] = None,
+        msgtype: str = "text"
+    ) -> dict:
+        """
+        发送一条回复
+
+        Args:
+            target: 回复目标，None 表示只能使用 robot/send
+            msg: 消息内容
+            at_user_ids: @的用户ID列表
+            msgtype: 消息类型，text 或 markdown
+
+        Returns:
+            dict: 最后一次尝试的钉钉API响应
+        """
+        target = target or ReplyTarget('', '', '')
+        result = {"errcode": -1, "errmsg": "没有可用的回复通道"}
+        routes = self._routes(target)
+        for route in routes:
+            if (route == ROUTE_ROBOT_SEND and ROUTE_OPENAPI in routes 
+                    and not self.robot_send_limiter.try_acquire()):
+                # OpenAPI 已经失败且 robot/send 本分钟限额已用尽，不再尝试
+                continue
+            result = self._send_via(route, target, msg, at_user_ids, msgtype)
+            if result.get("errcode") == 0:
+                metrics.inc("reply_route", route=route)
+                return result
+
+            metrics.inc("reply_route_failures", route=route)
+            logger.warning("通过 %s 回复失败，尝试下一个通道: %s", route, result.get("errmsg"))
+            if route == ROUTE_SESSION_WEBHOOK:
+                self.cache.invalidate(self._cache_key(target.conversation_id))
+        return result
+
+    def send_long(
+        self,
+        target: Optional[ReplyTarget],
+        msg: str,
+        at_user_ids: Optional[List[str]] = None,
+        max_bytes: Optional[int] = None
+    ) -> dict:
+        """
+        分段发送可能超过单条消息长度限制的回复，@只在第一段中出现
+
+        Returns:
+            dict: 最后一次发送的钉钉API响应
+        """
+        last_result = {"errcode": -1, "errmsg": "消息为空"}
+
+        def send_segment(segment: str, msgtype: str, index: int) -> bool:
+            nonlocal last_result
+            last_result = self.send(target, segment, at_user_ids if index == 0 else None, msgtype)
+            return last_result.get("errcode") == 0
+
+        send_in_segments(msg, send_segment, max_bytes or Config.DINGTALK_MAX_MESSAGE_BYTES, at_user_ids)
+        return last_result
@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地检索增强模块
+把内部文档目录切分成文档块，建立哈希 TF-IDF 稀疏索引，以 NumPy 数组保存并通过内存映射读取；
+提问时用向量化的稀疏点积为所有文档块打分，只把最相关的几段放进提示，而不是整篇粘贴文档。
+
+文档变化后增量重建：未变化文件的文档块直接从旧索引复制，只重新切分和向量化新增或修改的文件。
+每次重建写入新的版本目录，再原子地更新 CURRENT 指针，多个 worker 可以同时读取。
+
+用法：
+    python retrieval.py build [--full]          # 增量（或全量）重建索引
+    python retrieval.py query "报销流程是什么"    # 查看检索结果
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import shutil
+import logging
+import argparse
+import threading
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from config import Config
+from metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只在单进程时使用
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 参与索引的文档类型
+DOC_EXTENSIONS = {".md", ".txt", ".rst"}
+
+# 英文单词和数字按词切分，中日韩文字按相邻两字切分
+_TOKEN_RE = re.compile(r'[a-z0-9_]+|[぀-ヿ㐀-䶿一-鿿가-힯]+')
+
+# 索引数组文件
+_ARRAYS = ("indptr", "indices", "tf", "values", "rows", "idf", "text_offsets", "texts")
+
+_EMPTY_INDICES = np.zeros(0, dtype=np.int32)
+_EMPTY_VALUES = np.zeros(0, dtype=np.float32)
+
+
+class SearchHit(NamedTuple):
+    """一条检索结果"""
+    source: str
+    text: str
+    score: float
+
+
+class HashingVectorizer:
+    """
+    哈希特征向量化：特征哈希到固定维度，不需要保存词表
+
+    可以替换为嵌入模型：vectorize 返回 (np.arange(dim), 归一化的嵌入向量) 即可，
+    索引的存储和打分方式不变
+    """
+
+    def __init__(self, dim: Optional[int] = None):
+        """
+        Args:
+            dim: 特征维度，默认读取 RAG_HASH_DIM
+        """
+        self.dim = dim or Config.RAG_HASH_DIM
+
+    @staticmethod
+    def tokens(text: str) -> List[str]:
+        """切分文本"""
+        tokens = []
+        for run in _TOKEN_RE.findall(text.lower()):
+            if run[0].isascii():
+                if len(run) > 1:
+                    tokens.append(run)
+            elif len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        return tokens
+
+    def vectorize(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        把文本转换为稀疏向量（对数词频，L2 归一化）
+
+        Returns:
+            tuple: (按升序排列的特征下标 int32, 特征值 float32)
+        """
+        counts = Counter(zlib.crc32(token.encode('utf-8')) % self.dim for token in self.tokens(text))
+        if not counts:
+            return _EMPTY_INDICES, _EMPTY_VALUES
+        indices = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+        values = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        order = np.argsort(indices)
+        values = values[order]
+        return indices[order], values / np.linalg.norm(values)
+
+
+def chunk_text(text: str, chunk_chars: Optional[int] = None, overlap: Optional[int] = None) -> List[str]:
+    """
+    按段落把文档切分为文档块，相邻文档块保留少量重叠
+
+    Args:
+        text: 文档内容
+        chunk_chars: 每块最大字符数，默认读取 RAG_CHUNK_CHARS
+        overlap: 相邻块重叠的字符数，默认读取 RAG_CHUNK_OVERLAP
+
+    Returns:
+        list: 文档块
+    """
+    chunk_chars = chunk_chars or Config.RAG_CHUNK_CHARS
+    overlap = Config.RAG_CHUNK_OVERLAP if overlap is None else overlap
+    step = max(chunk_chars - overlap, 1)
+
+    chunks: List[str] = []
+    current = ""
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 2 > chunk_chars:
+            chunks.append(current)
+            current = current[-overlap:] if overlap else ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+        # 单个段落过长时按固定长度切开
+        while len(current) > chunk_chars:
+            chunks.append(current[:chunk_chars])
+            current = current[step:]
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+
+class _IndexData:
+    """一个版本的索引：稀疏矩阵（CSR）和文档块文本，数组以内存映射方式打开"""
+
+    def __init__(self, path: str, manifest: Dict[str, Any]):
+        self.path = path
+        self.version = manifest["version"]
+        self.manifest = manifest
+        self.files: List[Dict[str, Any]] = manifest["files"]
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r'))
+        self.size = len(self.indptr) - 1
+        # 文档块所属文件，用于在结果中标注来源
+        ends = np.array([entry["end"] for entry in self.files], dtype=np.int64)
+        self.row_file = np.searchsorted(ends, np.arange(self.size), side='right')
+
+    def text(self, row: int) -> str:
+        start, end = self.text_offsets[row], self.text_offsets[row + 1]
+        return bytes(self.texts[start:end]).decode('utf-8')
+
+    def source(self, row: int) -> str:
+        return self.files[int(self.row_file[row])]["path"]
+
+
+def _read_current(index_dir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(index_dir, "CURRENT"), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _load_index(index_dir: str) -> Optional[_IndexData]:
+    version = _read_current(index_dir)
+    if version is None:
+        return None
+    path = os.path.join(index_dir, version)
+    with open(os.path.join(path, "manifest.json"), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    return _IndexData(path, manifest)
+
+
+def _scan_docs(docs_dir: str) -> List[Tuple[str, str, os.stat_result]]:
+    """列出文档目录中参与索引的文件：(相对路径, 绝对路径, stat)"""
+    found = []
+    for root, _, names in os.walk(docs_dir):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in DOC_EXTENSIONS:
+                full_path = os.path.join(root, name)
+                found.append((os.path.relpath(full_path, docs_dir), full_path, os.stat(full_path)))
+    return sorted(found)
+
+
+def build_index(
+    docs_dir: Optional[str] = None,
+    index_dir: Optional[str] = None,
+    vectorizer: Optional[HashingVectorizer] = None,
+    full: bool = False
+) -> Dict[str, Any]:
+    """
+    增量重建索引：未变化的文件复用旧索引中的文档块，文件没有任何变化时不写入新版本
+
+    Args:
+        docs_dir: 文档目录，默认读取 RAG_DOCS_DIR
+        index_dir: 索引目录，默认读取 RAG_INDEX_DIR
+        vectorizer: 向量化器，默认 HashingVectorizer
+        full: 是否忽略旧索引全量重建
+
+    Returns:
+        dict: 重建统计（文件数、文档块数、重新处理的文件数、删除的文件数、是否写入新版本）
+    """
+    docs_dir = docs_dir or Config.RAG_DOCS_DIR
+    index_dir = index_dir or Config.RAG_INDEX_DIR
+    vectorizer = vectorizer or HashingVectorizer()
+    start_time = time.time()
+    os.makedirs(index_dir, exist_ok=True)
+
+    # 多个 worker 同时重建时只让一个写入
+    with open(os.path.join(index_dir, ".lock"), 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        settings = {"dim": vectorizer.dim, "chunk_chars": Config.RAG_CHUNK_CHARS, "chunk_overlap": Config.RAG_CHUNK_OVERLAP}
+        old = None if full else _load_index(index_dir)
+        if old is not None and old.manifest.get("settings") != settings:
+            old = None
+        old_files = {entry["path"]: entry for entry in old.files} if old is not None else {}
+
+        docs = _scan_docs(docs_dir) if os.path.isdir(docs_dir) else []
+        changed = 0
+        nnz_counts: List[np.ndarray] = []
+        indices: List[np.ndarray] = []
+        tf: List[np.ndarray] = []
+        text_lengths: List[np.ndarray] = []
+        texts: List[np.ndarray] = []
+        files: List[Dict[str, Any]] = []
+        rows = 0
+
+        for rel_path, full_path, stat in docs:
+            entry = old_files.get(rel_path)
+            if entry is not None and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                # 文件未变化，直接复制旧索引中的文档块
+                start, end = entry["start"], entry["end"]
+                nnz_counts.append(np.diff(old.indptr[start:end + 1]))
+                indices.append(np.asarray(old.indices[old.indptr[start]:old.indptr[end]]))
+                tf.append(np.asarray(old.tf[old.indptr[start]:old.indptr[end]]))
+                text_lengths.append(np.diff(old.text_offsets[start:end + 1]))
+                texts.append(np.asarray(old.texts[old.text_offsets[start]:old.text_offsets[end]]))
+                count = end - start
+            else:
+                changed += 1
+                with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
+                    chunks = chunk_text(f.read())
+                vectors = [vectorizer.vectorize(chunk) for chunk in chunks]
+                encoded = [chunk.encode('utf-8') for chunk in chunks]
+                nnz_counts.append(np.array([len(v[0]) for v in vectors], dtype=np.int64))
+                indices.extend(v[0] for v in vectors)
+                tf.extend(v[1] for v in vectors)
+                text_lengths.append(np.array([len(b) for b in encoded], dtype=np.int64))
+                texts.append(np.frombuffer(b"".join(encoded), dtype=np.uint8))
+                count = len(chunks)
+            files.append({
+                "path": rel_path, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                "start": rows, "end": rows + count
+            })
+            rows += count
+
+        removed = len(set(old_files) - {entry["path"] for entry in files})
+        stats = {"files": len(files), "chunks": rows, "changed": changed, "removed": removed, "written": False}
+        if old is not None and not changed and not removed:
+            return stats
+
+        counts = np.concatenate(nnz_counts) if nnz_counts else np.zeros(0, dtype=np.int64)
+        arrays = {
+            "indptr": np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            "indices": np.concatenate(indices).astype(np.int32) if indices else _EMPTY_INDICES,
+            "tf": np.concatenate(tf).astype(np.float32) if tf else _EMPTY_VALUES,
+            "rows": np.repeat(np.arange(rows, dtype=np.int32), counts),
+            "text_offsets": np.concatenate(([0], np.cumsum(np.concatenate(text_lengths) if text_lengths else []))).astype(np.int64),
+            "texts": np.concatenate(texts) if texts else np.zeros(0, dtype=np.uint8),
+        }
+        # IDF 随文档集合变化，每次重建都用全部文档块重新计算，再得到归一化的 TF-IDF 值
+        document_frequency = np.bincount(arrays["indices"], minlength=vectorizer.dim)
+        arrays["idf"] = (np.log((1.0 + rows) / (1.0 + document_frequency)) + 1.0).astype(np.float32)
+        weighted = arrays["tf"] * arrays["idf"][arrays["indices"]]
+        norms = np.sqrt(np.bincount(arrays["rows"], weights=weighted * weighted, minlength=rows))
+        arrays["values"] = (weighted / np.maximum(norms, 1e-12)[arrays["rows"]]).astype(np.float32)
+
+        version = f"v{time.time_ns()}"
+        path = os.path.join(index_dir, version)
+        os.makedirs(path)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), arrays[name])
+        with open(os.path.join(path, "manifest.json"), 'w', encoding='utf-8') as f:
+            json.dump({"version": version, "settings": settings, "files": files}, f, ensure_ascii=False)
+
+        pointer = os.path.join(index_dir, "CURRENT")
+        with open(pointer + ".tmp", 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(pointer + ".tmp", pointer)
+
+        # 保留上一个版本给仍在读取它的进程，更早的版本删除
+        versions = sorted(name for name in os.listdir(index_dir) if name.startswith("v"))
+        for stale in versions[:-2]:
+            shutil.rmtree(os.path.join(index_dir, stale), ignore_errors=True)
+
+    stats["written"] = True
+    elapsed = time.time() - start_time
+    metrics.observe("rag_reindex_seconds", elapsed)
+    metrics.inc("rag_reindexed_files", changed)
+    logger.info("文档索引已更新: %d 个文件，%d 个文档块，重新处理 %d 个，删除 %d 个，耗时 %.2f秒",
+                len(files), rows, changed, removed, elapsed)
+    return stats
+
+
+class Retriever:
+    """文档检索器：按需加载最新版本的索引，后台线程定期增量重建"""
+
+    def __init__(
+        self,
+        docs_dir: Optional[str] = None,
+        index_dir: Optional[str] = None,
+        vectorizer: Optional[HashingVectorizer] = None,
+        top_k: Optional[int] = None,
+        min_score: Optional[float] = None
+    ):
+        """
+        Args:
+            docs_dir: 文档目录，默认读取 RAG_DOCS_DIR
+            index_dir: 索引目录，默认读取 RAG_INDEX_DIR
+            vectorizer: 向量化器，默认 HashingVectorizer
+            top_k: 最多返回的文档块数，默认读取 RAG_TOP_K
+            min_score: 最低相似度（余弦），默认读取 RAG_MIN_SCORE
+        """
+        self.docs_dir = docs_dir or Config.RAG_DOCS_DIR
+        self.index_dir = index_dir or Config.RAG_INDEX_DIR
+        self.vectorizer = vectorizer or HashingVectorizer()
+        self.top_k = top_k or Config.RAG_TOP_K
+        self.min_score = Config.RAG_MIN_SCORE if min_score is None else min_score
+        self._index: Optional[_IndexData] = None
+        self._thread_pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        """
+        CURRENT 指向新版本时加载新索引（整体替换，查询无需加锁）
+
+        Returns:
+            bool: 是否加载了新版本
+        """
+        version = _read_current(self.index_dir)
+        if version is None or (self._index is not None and self._index.version == version):
+            return False
+        self._index = _load_index(self.index_dir)
+        return True
+
+    def reindex(self, full: bool = False) -> Dict[str, Any]:
+        """增量重建索引并加载新版本"""
+        stats = build_index(self.docs_dir, self.index_dir, self.vectorizer, full)
+        self.refresh()
+        return stats
+
+    def _run(self):
+        while True:
+            time.sleep(Config.RAG_REINDEX_INTERVAL)
+            try:
+                self.reindex()
+            except Exception as e:
+                logger.error(f"重建文档索引失败: {e}")
+
+    def start(self):
+        """启动后台增量重建线程；gunicorn fork 出的 worker 中会重新启动"""
+        pid = os.getpid()
+        if Config.RAG_REINDEX_INTERVAL <= 0 or self._thread_pid == pid:
+            return
+        with self._lock:
+            if self._thread_pid == pid:
+                return
+            threading.Thread(target=self._run, name='rag-reindex', daemon=True).start()
+            self._thread_pid = pid
+
+    def search(self, query: str, top_k: Optional[int] = None) -> List[SearchHit]:
+        """
+        检索与问题最相关的文档块
+
+        Args:
+            query: 问题
+            top_k: 最多返回的文档块数
+
+        Returns:
+            list: 按相似度降序排列、且不低于 min_score 的检索结果
+        """
+        start_time = time.perf_counter()
+        index = self._index
+        if index is None or index.size == 0:
+            return []
+
+        query_indices, query_values = self.vectorizer.vectorize(query)
+        if len(query_indices) == 0:
+            return []
+
+        # 查询向量同样按 TF-IDF 加权并归一化，分数即余弦相似度
+        weights = np.zeros(self.vectorizer.dim, dtype=np.float32)
+        weights[query_indices] = query_values * index.idf[query_indices]
+        weights /= max(float(np.linalg.norm(weights)), 1e-12)
+        # 稀疏矩阵与查询向量相乘：逐个非零元素取权重，再按文档块求和
+        scores = np.bincount(index.rows, weights=index.values * weights[index.indices], minlength=index.size)
+
+        k = min(top_k or self.top_k, index.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        hits = [
+            SearchHit(index.source(row), index.text(row), float(scores[row]))
+            for row in top if scores[row] >= self.min_score
+        ]
+
+        metrics.observe("rag_query_seconds", time.perf_counter() - start_time)
+        metrics.inc("rag_hits" if hits else "rag_misses")
+        return hits
+
+
+def build_context_prompt(prompt: str, hits: List[SearchHit], max_chars: Optional[int] = None) -> str:
+    """
+    把检索到的文档块放在问题之前
+
+    Args:
+        prompt: 原始问题
+        hits: 检索结果
+        max_chars: 参考资料的最大字符数，默认读取 RAG_MAX_CONTEXT_CHARS
+
+    Returns:
+        str: 带参考资料的提示
+    """
+    max_chars = max_chars or Config.RAG_MAX_CONTEXT_CHARS
+    sections = []
+    used = 0
+    for number, hit in enumerate(hits, 1):
+        text = hit.text[:max(max_chars - used, 0)]
+        if not text:
+            break
+        sections.append(f"[{number}] 来源：{hit.source}\n{text}")
+        used += len(text)
+    return (
+        "以下是内部文档中与问题相关的内容，回答时优先依据这些内容；如果与问题无关请忽略：\n\n"
+        + "\n\n".join(sections)
+        + f"\n\n问题：{prompt}"
+    )
+
+
+# 进程级全局检索器
+_retriever: Optional[Retriever] = None
+_retriever_lock = threading.Lock()
+
+
+def get_retriever() -> Optional[Retriever]:
+    """获取全局检索器，未启用 RAG_ENABLED 时返回 None；首次获取时加载索引，没有索引时先建立"""
+    global _retriever
+
+    if not Config.RAG_ENABLED:
+        return None
+    if _retriever is None:
+        with _retriever_lock:
+            if _retriever is None:
+                retriever = Retriever()
+                if not retriever.refresh():
+                    retriever.reindex()
+                retriever.start()
+                _retriever = retriever
+    return _retriever
+
+
+def augment_prompt(prompt: str) -> str:
+    """
+    为问题附加检索到的文档块，未启用检索、没有相关内容或检索失败时原样返回
+
+    Args:
+        prompt: 问题
+
+    Returns:
+        str: 提示
+    """
+    try:
+        retriever = get_retriever()
+        hits = retriever.search(prompt) if retriever is not None else []
+    except Exception as e:
+        logger.error(f"文档检索失败: {e}")
+        return prompt
+    return build_context_prompt(prompt, hits) if hits else prompt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="内部文档检索索引")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="增量重建索引")
+    build_parser.add_argument("--full", action="store_true", help="忽略旧索引全量重建")
+
+    query_parser = subparsers.add_parser("query", help="查看检索结果")
+    query_parser.add_argument("text", help="问题")
+    query_parser.add_argument("--top-k", type=int, default=None, help="返回的文档块数")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    retriever = Retriever()
+    if args.command == "build":
+        print(json.dumps(retriever.reindex(full=args.full), ensure_ascii=False))
+        return 0
+
+    if not retriever.refresh():
+        retriever.reindex()
+    for hit in retriever.search(args.text, args.top_k):
+        print(f"[{hit.score:.3f}] {hit.source}\n{hit.text}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成调度模块
+进程内同时调用 Gemini 的请求数限制为 SCHEDULER_SLOTS，超出的请求排队，空出名额时按优先级挑选下一个，
+而不是先到先得：大量"写一篇报告"之类的长请求不会拖慢单聊和一句话的简短问题。
+
+优先级数值越小越先处理，由以下几项相加：
+- 会话类型：单聊 0，群聊 1
+- 预计开销：输入较长、长文类问题、会路由到 pro 模型的问题各加 1
+- VIP 群（SCHEDULER_VIP_GROUPS）减去 SCHEDULER_VIP_BOOST
+
+排队每满 SCHEDULER_AGING_SECONDS 秒相当于优先级提高 1，低优先级的请求不会一直等下去。
+
+不同会话（conversationId）之间按加权公平排队：会话有请求在排队或生成时记录一个虚拟完成时间，
+每来一个请求往后推 1/权重（SCHEDULER_GROUP_WEIGHTS，默认 1），起点不早于当前时间（按老化间隔换算）。
+一个群短时间内发来大量请求时，只有它自己的请求越排越后，其他会话的新请求照常插到前面；
+会话的请求全部完成后记录即被删除，空闲会话不占内存。
+各会话的排队时间见 /metrics 中 scheduler 的 conversations。
+
+多线程处理请求时（Stream 模式、gunicorn.conf.py 默认的 gthread worker）才会出现排队，优先级和会话公平排队
+才起作用；sync worker 每个进程同时只处理一个请求，不会排队，会话排队统计也始终为 0。
+调度在每个 worker 进程内独立进行，/metrics 返回的是处理该请求的 worker 的统计
+"""
+
+import time
+import heapq
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from cancellation import current_cancel_token
+from config import Config
+from deadline import get_deadline
+from metrics import metrics
+from model_router import TIER_PRO, get_model_router
+from token_estimator import classify_question, get_token_estimator
+
+logger = logging.getLogger(__name__)
+
+# 钉钉单聊的 conversationType
+_SINGLE_CHAT = "1"
+# 保留排队统计的会话数
+_WAIT_STATS_SIZE = 256
+
+
+class _Waiter:
+    """排队中的一个请求"""
+
+    __slots__ = ('key', 'seq', 'chat', 'enqueued_at', 'event', 'granted')
+
+    def __init__(self, key: float, seq: int, chat: str, enqueued_at: float):
+        self.key = key
+        self.seq = seq
+        self.chat = chat
+        self.enqueued_at = enqueued_at
+        self.event = threading.Event()
+        self.granted = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.key, self.seq) < (other.key, other.seq)
+
+
+class GenerationScheduler:
+    """按优先级分配生成名额的调度器"""
+
+    def __init__(
+        self,
+        slots: Optional[int] = None,
+        aging_seconds: Optional[float] = None,
+        vip_groups: Optional[List[str]] = None,
+        weights: Optional[Dict[str, float]] = None
+    ):
+        """
+        Args:
+            slots: 同时生成的请求数，默认读取 SCHEDULER_SLOTS
+            aging_seconds: 排队多少秒相当于优先级提高 1，默认读取 SCHEDULER_AGING_SECONDS
+            vip_groups: VIP 群的 conversationId，默认读取 SCHEDULER_VIP_GROUPS
+            weights: 会话的公平排队权重 {conversationId: 权重}，默认读取 SCHEDULER_GROUP_WEIGHTS
+        """
+        self.slots = slots or Config.SCHEDULER_SLOTS
+        self.aging_seconds = aging_seconds or Config.SCHEDULER_AGING_SECONDS
+        self.vip_groups = set(Config.SCHEDULER_VIP_GROUPS if vip_groups is None else vip_groups)
+        self.weights = dict(Config.SCHEDULER_GROUP_WEIGHTS if weights is None else weights)
+        self.active = 0
+        self._waiting: List[_Waiter] = []
+        # 有请求在排队或生成的会话：[虚拟完成时间, 未完成的请求数]
+        self._flows: Dict[str, List[float]] = {}
+        # 每个会话的排队统计：[次数, 总等待, 最长等待]
+        self._wait_stats: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        """排队中的请求数"""
+        return len(self._waiting)
+
+    def priority(self, data: Dict[str, Any], question: str, history_turns: int = 0) -> float:
+        """
+        计算消息的优先级，数值越小越先处理
+
+        Args:
+            data: webhook 消息
+            question: 用户问题
+            history_turns: 当前会话已有的对话轮数
+
+        Returns:
+            float: 优先级
+        """
+        level = 0.0 if str(data.get('conversationType', '')) == _SINGLE_CHAT else 1.0
+
+        if get_token_estimator().estimate(question) > Config.SCHEDULER_LONG_INPUT_TOKENS:
+            level += 1
+        if classify_question(question) == "long_form":
+            level += 1
+        router = get_model_router()
+        if router and router.tier(question, history_turns)[0] == TIER_PRO:
+            level += 1
+
+        if data.get('conversationId') in self.vip_groups:
+            level -= Config.SCHEDULER_VIP_BOOST
+        return level
+
+    def _enter_flow(self, conversation: str, now: float) -> float:
+        """会话新增一个请求，推进并返回虚拟完成时间（调用方持有锁）"""
+        virtual_now = now / self.aging_seconds
+        flow = self._flows.get(conversation)
+        if flow is None:
+            flow = self._flows[conversation] = [virtual_now, 0]
+        flow[0] = max(virtual_now, flow[0]) + 1 / self.weights.get(conversation, 1.0)
+        flow[1] += 1
+        return flow[0]
+
+    def _leave_flow(self, conversation: str):
+        """会话的一个请求结束，没有未完成的请求时删除记录（调用方持有锁）"""
+        flow = self._flows[conversation]
+        flow[1] -= 1
+        if flow[1] <= 0:
+            del self._flows[conversation]
+
+    def _record_wait(self, conversation: str, chat: str, waited: float):
+        metrics.observe("scheduler_wait_seconds", waited, chat=chat)
+        with self._lock:
+            stats = self._wait_stats.get(conversation)
+            if stats is None:
+                stats = self._wait_stats[conversation] = [0, 0.0, 0.0]
+            self._wait_stats.move_to_end(conversation)
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+            while len(self._wait_stats) > _WAIT_STATS_SIZE:
+                self._wait_stats.popitem(last=False)
+
+    def _acquire(self, priority: float, conversation: str, chat: str) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            # 直接开始的请求同样推进会话的虚拟完成时间，持续占用名额的会话在出现排队时排在后面
+            tag = self._enter_flow(conversation, now)
+            if self.active < self.slots and not self._waiting:
+                self.active += 1
+                waiter = None
+            else:
+                # 老化速度对所有请求相同，排序键在入队时即可确定：优先级 + 会话的虚拟完成时间
+                waiter = _Waiter(priority + tag, next(self._seq), chat, now)
+                heapq.heappush(self._waiting, waiter)
+        if waiter is None:
+            self._record_wait(conversation, chat, 0.0)
+            return True
+
+        # 等到截止时间为止；超时后不再占用名额，由生成步骤按截止时间返回超时提示
+        deadline = get_deadline()
+        timeout = max(deadline.remaining() - Config.DEADLINE_SEND_RESERVE, 0) if deadline else None
+        # 请求被取消时立即离开队列
+        cancel_token = current_cancel_token()
+        if cancel_token is not None:
+            cancel_token.add_callback(waiter.event.set)
+        waiter.event.wait(timeout)
+        if cancel_token is not None:
+            cancel_token.remove_callback(waiter.event.set)
+        with self._lock:
+            if not waiter.granted:
+                self._waiting.remove(waiter)
+                heapq.heapify(self._waiting)
+                self._leave_flow(conversation)
+                if not (cancel_token and cancel_token.cancelled):
+                    metrics.inc("scheduler_timeouts", chat=chat)
+                return False
+        self._record_wait(conversation, chat, time.monotonic() - waiter.enqueued_at)
+        return True
+
+    def _release(self, conversation: str):
+        with self._lock:
+            self._leave_flow(conversation)
+            if self._waiting:
+                # 名额直接交给优先级最高的等待者
+                waiter = heapq.heappop(self._waiting)
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self.active -= 1
+
+    @contextmanager
+    def slot(self, data: Dict[str, Any], question: str, history_turns: int = 0) -> Iterator[bool]:
+        """
+        获取一个生成名额，with 块结束时释放
+
+        Args:
+            data: webhook 消息
+            question: 用户问题
+            history_turns: 当前会话已有的对话轮数
+
+        Yields:
+            bool: 是否获得名额（等到截止时间仍未获得或请求被取消时为 False）
+        """
+        chat = "direct" if str(data.get('conversationType', '')) == _SINGLE_CHAT else "group"
+        conversation = data.get('conversationId', '')
+        acquired = self._acquire(self.priority(data, question, history_turns), conversation, chat)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self._release(conversation)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前状态，供 /metrics 使用；conversations 为最长排队时间最大的会话"""
+        with self._lock:
+            stats = list(self._wait_stats.items())
+        stats.sort(key=lambda item: item[1][2], reverse=True)
+        return {
+            "slots": self.slots,
+            "active": self.active,
+            "waiting": self.waiting,
+            "conversations": [
+                {
+                    "conversation": conversation[-12:],
+                    "weight": self.weights.get(conversation, 1.0),
+                    "count": int(count),
+                    "avg_wait": round(total / count, 3),
+                    "max_wait": round(max_wait, 3),
+                }
+                for conversation, (count, total, max_wait) in stats[:20]
+            ],
+        }
+
+
+# 进程级全局调度器
+_scheduler: Optional[GenerationScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Optional[GenerationScheduler]:
+    """获取全局生成调度器，未启用 SCHEDULER_ENABLED 时返回 None"""
+    global _scheduler
+
+    if not Config.SCHEDULER_ENABLED:
+        return None
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = GenerationScheduler()
+    return _scheduler
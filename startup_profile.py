@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动耗时分析模块
+记录重量级依赖的按需导入耗时和各初始化阶段耗时，用于排查冷启动延迟
+
+命令行用法：
+    python startup_profile.py app_v2 --top 20
+"""
+
+import sys
+import time
+import logging
+import argparse
+import importlib
+import threading
+import subprocess
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple, Iterator
+
+logger = logging.getLogger(__name__)
+
+# 冷启动时不在模块加载阶段导入，而是按需或在预热阶段导入的重量级模块
+HEAVY_MODULES = [
+    'google.auth',
+    'google.auth.transport.requests',
+    'vertexai',
+    'vertexai.generative_models',
+]
+
+
+class StartupProfiler:
+    """启动耗时记录器"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._created_at = time.time()
+        self.imports: Dict[str, float] = {}
+        self.phases: Dict[str, float] = {}
+
+    def import_module(self, name: str):
+        """
+        导入模块并记录耗时，已导入的模块直接返回
+
+        Args:
+            name: 模块全名
+
+        Returns:
+            module: 导入的模块对象
+        """
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+
+        start_time = time.perf_counter()
+        module = importlib.import_module(name)
+        elapsed = time.perf_counter() - start_time
+
+        with self._lock:
+            self.imports.setdefault(name, elapsed)
+        logger.debug(f"导入 {name} 耗时: {elapsed * 1000:.1f}毫秒")
+        return module
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        记录一个初始化阶段的耗时，同名阶段耗时累加
+
+        Args:
+            name: 阶段名称
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def report(self) -> Dict[str, Any]:
+        """
+        生成启动耗时报告
+
+        Returns:
+            dict: 各模块导入和各阶段耗时（毫秒）
+        """
+        with self._lock:
+            imports = dict(self.imports)
+            phases = dict(self.phases)
+
+        return {
+            "imports_ms": {name: round(t * 1000, 1) for name, t in imports.items()},
+            "phases_ms": {name: round(t * 1000, 1) for name, t in phases.items()},
+            "total_import_ms": round(sum(imports.values()) * 1000, 1),
+            "total_phase_ms": round(sum(phases.values()) * 1000, 1),
+            "uptime_s": round(time.time() - self._created_at, 1)
+        }
+
+    def log_report(self):
+        """将启动耗时报告写入日志"""
+        report = self.report()
+        logger.info(
+            "启动耗时报告: 导入 %sms %s, 初始化 %sms %s",
+            report["total_import_ms"], report["imports_ms"],
+            report["total_phase_ms"], report["phases_ms"]
+        )
+
+
+# 进程级全局记录器
+_profiler = StartupProfiler()
+
+
+def lazy_import(name: str):
+    """按需导入模块并记录导入耗时"""
+    return _profiler.import_module(name)
+
+
+def profile_phase(name: str):
+    """记录初始化阶段耗时的上下文管理器"""
+    return _profiler.phase(name)
+
+
+def get_startup_report() -> Dict[str, Any]:
+    """获取当前进程的启动耗时报告"""
+    return _profiler.report()
+
+
+def log_startup_report():
+    """输出当前进程的启动耗时报告"""
+    _profiler.log_report()
+
+
+def preload_heavy_modules(modules: List[str] = None) -> Dict[str, bool]:
+    """
+    在预热阶段预先导入重量级模块，导入失败不影响启动
+
+    Args:
+        modules: 模块名列表，默认 HEAVY_MODULES
+
+    Returns:
+        dict: 各模块是否导入成功
+    """
+    results = {}
+    with profile_phase('preload_heavy_modules'):
+        for name in modules or HEAVY_MODULES:
+            try:
+                lazy_import(name)
+                results[name] = True
+            except ImportError as e:
+                logger.debug(f"预加载模块 {name} 失败: {e}")
+                results[name] = False
+    return results
+
+
+def measure_import_tree(module_name: str) -> List[Tuple[str, int, int]]:
+    """
+    在子进程中使用 -X importtime 导入指定模块，统计各模块导入耗时
+
+    Args:
+        module_name: 要导入的模块名，例如 app_v2
+
+    Returns:
+        list: (模块名, 自身耗时微秒, 累计耗时微秒) 列表，按累计耗时降序
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+        capture_output=True,
+        text=True
+    )
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        # 格式: import time:   自身 |   累计 | 模块名
+        try:
+            self_us, cumulative_us, name = line.split(':', 1)[1].split('|')
+            rows.append((name.strip(), int(self_us), int(cumulative_us)))
+        except ValueError:
+            continue
+
+    if result.returncode != 0:
+        logger.warning(f"导入 {module_name} 失败: {result.stderr.strip().splitlines()[-1:]}")
+
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows
+
+
+def main():
+    """命令行入口：输出应用模块的导入耗时分布"""
+    parser = argparse.ArgumentParser(description='统计应用冷启动的模块导入耗时')
+    parser.add_argument('module', nargs='?', default='app_v2', help='要分析的应用模块')
+    parser.add_argument('--top', type=int, default=20, help='显示耗时最多的前N个模块')
+    args = parser.parse_args()
+
+    rows = measure_import_tree(args.module)
+    if not rows:
+        print(f"❌ 未能获取 {args.module} 的导入耗时")
+        return 1
+
+    print(f"📊 {args.module} 导入耗时（累计耗时前 {args.top} 的模块）")
+    print(f"{'累计(ms)':>10} {'自身(ms)':>10}  模块")
+    for name, self_us, cumulative_us in rows[:args.top]:
+        print(f"{cumulative_us / 1000:>10.1f} {self_us / 1000:>10.1f}  {name}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+钉钉 Stream 模式接入
+与钉钉保持一条 WebSocket 长连接接收机器人消息，不需要公网可访问的 HTTP 回调地址和内网穿透：
+每条消息收到后立即确认（避免钉钉超时重投），再交给线程池按与 HTTP 回调相同的流程处理：
+不同会话的消息并行处理，同一会话的消息按收到的顺序逐条处理，回复不会乱序。
+
+钉钉定期发送 SYSTEM/ping，原样回复即可；WebSocket 层另外发送 ping 检测已经失效的连接。
+连接断开后重新申请连接凭证并按指数退避（带随机抖动）重连，连接稳定一段时间后退避时间复位
+"""
+
+import json
+import time
+import random
+import socket
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import quote
+
+from cancellation import cancel_key, get_cancellation_registry, is_cancel_command
+from config import Config
+from deadline import deadline_scope
+from debounce import MessageDebouncer
+from http_pool import get_session
+from json_codec import Fragment, dumps, loads
+from keyed_executor import KeyedExecutor
+from metrics import metrics
+from startup_profile import lazy_import
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_URL = "https://api.dingtalk.com/v1.0/gateway/connections/open"
+TOPIC_ROBOT_MESSAGE = "/v1.0/im/bot/messages/get"
+
+# 连接保持超过该秒数视为稳定，之后断开从最小退避时间重新开始
+_STABLE_CONNECTION_SECONDS = 60
+# 用于去重的最近消息ID数
+_RECENT_MESSAGE_IDS = 2048
+# 确认机器人消息时固定的回复内容，预先编码
+_ACK_DATA = Fragment(json.dumps({"response": None}))
+
+
+class StreamClient:
+    """钉钉 Stream 模式客户端：一个应用一条长连接"""
+
+    def __init__(
+        self,
+        app_key: str,
+        app_secret: str,
+        on_message: Callable[[Dict[str, Any]], Any],
+        name: str = "default",
+        gateway_url: str = GATEWAY_URL,
+        max_workers: Optional[int] = None,
+        ping_interval: Optional[float] = None,
+        reconnect_min: Optional[float] = None,
+        reconnect_max: Optional[float] = None,
+        debounce: Optional[bool] = None
+    ):
+        """
+        Args:
+            app_key: 应用 AppKey（clientId）
+            app_secret: 应用 AppSecret（clientSecret）
+            on_message: 机器人消息处理函数，参数为与 HTTP 回调相同的消息数据
+            name: 连接名称（机器人名称），用于日志和指标
+            gateway_url: 申请连接凭证的地址
+            max_workers: 处理消息的线程数，默认读取 STREAM_WORKERS
+            ping_interval: WebSocket ping 间隔（秒），默认读取 STREAM_PING_INTERVAL，0 表示不发送
+            reconnect_min: 最小重连等待（秒），默认读取 STREAM_RECONNECT_MIN
+            reconnect_max: 最大重连等待（秒），默认读取 STREAM_RECONNECT_MAX
+            debounce: 是否合并同一发送者连续发来的文本消息，默认读取 DEBOUNCE_ENABLED
+        """
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.on_message = on_message
+        self.name = name
+        self.gateway_url = gateway_url
+        self.ping_interval = Config.STREAM_PING_INTERVAL if ping_interval is None else ping_interval
+        self.reconnect_min = reconnect_min or Config.STREAM_RECONNECT_MIN
+        self.reconnect_max = reconnect_max or Config.STREAM_RECONNECT_MAX
+        self.connections = 0
+        self.connected = threading.Event()
+        self.max_workers = max_workers or Config.STREAM_WORKERS
+        self._executor = self._new_executor()
+        self._executor_closed = False
+        debounce = Config.DEBOUNCE_ENABLED if debounce is None else debounce
+        self._debouncer = MessageDebouncer(self._submit) if debounce else None
+        self._recent_ids: "OrderedDict[str, None]" = OrderedDict()
+        self._recent_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._ws = None
+        self._thread: Optional[threading.Thread] = None
+
+    def _new_executor(self) -> KeyedExecutor:
+        # 同一会话的消息按收到的顺序处理，不同会话并行处理
+        return KeyedExecutor(max_workers=self.max_workers, thread_name_prefix=f'stream-{self.name}')
+
+    def open_connection(self) -> str:
+        """
+        申请连接凭证
+
+        Returns:
+            str: 带 ticket 的 WebSocket 地址
+        """
+        response = get_session().post(
+            self.gateway_url,
+            json={
+                "clientId": self.app_key,
+                "clientSecret": self.app_secret,
+                "subscriptions": [{"type": "CALLBACK", "topic": TOPIC_ROBOT_MESSAGE}],
+                "ua": "dingding-gemini-chatbot",
+                "localIp": socket.gethostbyname(socket.gethostname()),
+            },
+            timeout=10
+        )
+        response.raise_for_status()
+        result = response.json()
+        return f"{result['endpoint']}?ticket={quote(result['ticket'])}"
+
+    def _seen(self, message_id: str) -> bool:
+        """记录消息ID，重复投递的消息返回 True"""
+        if not message_id:
+            return False
+        with self._recent_lock:
+            if message_id in self._recent_ids:
+                return True
+            self._recent_ids[message_id] = None
+            while len(self._recent_ids) > _RECENT_MESSAGE_IDS:
+                self._recent_ids.popitem(last=False)
+        return False
+
+    def handle_frame(self, ws, raw: str):
+        """
+        处理一帧消息：回复 ping、确认并分发机器人消息
+
+        Args:
+            ws: WebSocket 连接
+            raw: 消息文本
+        """
+        frame = loads(raw)
+        headers = frame.get("headers") or {}
+        topic = headers.get("topic")
+
+        if frame.get("type") == "SYSTEM":
+            if topic == "ping":
+                ws.send(dumps({"code": 200, "headers": headers, "message": "OK", "data": frame.get("data")}))
+            elif topic == "disconnect":
+                # 服务端即将断开（例如升级），主动关闭后重连
+                logger.info("Stream 连接 %s 收到断开通知，准备重连", self.name)
+                ws.close()
+            return
+
+        # 先确认再处理，生成回答的耗时不会导致钉钉重投
+        ws.send(dumps({
+            "code": 200,
+            "headers": {"contentType": "application/json", "messageId": headers.get("messageId")},
+            "message": "OK",
+            "data": _ACK_DATA,
+        }))
+        if topic != TOPIC_ROBOT_MESSAGE:
+            return
+
+        data = loads(frame.get("data") or "{}")
+        if self._seen(data.get("msgId") or headers.get("messageId", "")):
+            metrics.inc("stream_duplicates", tenant=self.name)
+            return
+        metrics.inc("stream_messages", tenant=self.name)
+        # 同一会话的消息排队串行处理，取消指令和重新提问在收到时就通知正在进行的生成；
+        # 取消指令同时跳过该发送者在队列中尚未开始处理的消息
+        cancellation = get_cancellation_registry()
+        if cancellation:
+            content = (data.get("text") or {}).get("content", "") if data.get("msgtype") == "text" else ""
+            sender = cancel_key(data)
+            command = is_cancel_command(content)
+            cancellation.signal(sender, command=command)
+            if command:
+                skipped = self._executor.cancel_pending(
+                    data.get("conversationId"), lambda queued: cancel_key(queued) == sender
+                )
+                if skipped:
+                    logger.info("收到取消指令，跳过 %d 条排队中的消息", skipped)
+        if self._debouncer is not None:
+            # 连续发来的文本消息等待片刻合并后再处理
+            self._debouncer.offer(data)
+        else:
+            self._submit(data)
+
+    def _submit(self, data: Dict[str, Any]):
+        self._executor.submit(data.get("conversationId"), self._process, data)
+
+    def _process(self, data: Dict[str, Any]):
+        try:
+            # 与 HTTP 回调相同，每条消息从收到时开始计算截止时间
+            with deadline_scope():
+                self.on_message(data)
+        except Exception as e:
+            logger.error("处理 Stream 消息失败: %s", e)
+
+    def _on_open(self, ws):
+        self.connections += 1
+        self.connected.set()
+        logger.info("Stream 连接 %s 已建立", self.name)
+
+    def _on_message(self, ws, raw: str):
+        try:
+            self.handle_frame(ws, raw)
+        except Exception as e:
+            logger.error("解析 Stream 消息失败: %s", e)
+
+    def _on_error(self, ws, error):
+        logger.warning("Stream 连接 %s 异常: %s", self.name, error)
+
+    def _on_close(self, ws, status_code, reason):
+        self.connected.clear()
+        logger.info("Stream 连接 %s 已断开: %s %s", self.name, status_code, reason or "")
+
+    def run_once(self):
+        """建立一次连接并阻塞到连接断开"""
+        websocket = lazy_import('websocket')
+        url = self.open_connection()
+        self._ws = websocket.WebSocketApp(
+            url,
+            on_open=self._on_open,
+            on_message=self._on_message,
+            on_error=self._on_error,
+            on_close=self._on_close,
+        )
+        self._ws.run_forever(
+            ping_interval=self.ping_interval or 0,
+            # websocket-client 要求 ping_timeout 小于 ping_interval
+            ping_timeout=min(Config.STREAM_PING_TIMEOUT, self.ping_interval / 2) if self.ping_interval else None,
+        )
+
+    def _run(self):
+        backoff = self.reconnect_min
+        while not self._stop.is_set():
+            start_time = time.time()
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning("Stream 连接 %s 失败: %s", self.name, e)
+            self.connected.clear()
+            if self._stop.is_set():
+                break
+
+            if time.time() - start_time >= _STABLE_CONNECTION_SECONDS:
+                backoff = self.reconnect_min
+            delay = random.uniform(backoff / 2, backoff)
+            metrics.inc("stream_reconnects", tenant=self.name)
+            logger.info("Stream 连接 %s 将在 %.1f 秒后重连", self.name, delay)
+            self._stop.wait(delay)
+            backoff = min(backoff * 2, self.reconnect_max)
+
+    def start(self):
+        """在后台线程中建立连接，断开后自动重连"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._executor_closed:
+            # stop() 已关闭线程池，重新启动时换一个新的
+            self._executor = self._new_executor()
+            self._executor_closed = False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'stream-{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        """关闭连接并停止重连"""
+        self._stop.set()
+        ws = self._ws
+        connection = ws.sock if ws is not None else None
+        if connection is not None and connection.sock is not None:
+            # 从其他线程关闭文件描述符不会唤醒阻塞在 epoll 上的读取线程（不发送 WebSocket ping 时读取没有超时），
+            # 因此只发送关闭帧并 shutdown，由读取线程收到连接结束后自行清理
+            ws.keep_running = False
+            try:
+                connection.send_close()
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                ws.close()
+        elif ws is not None:
+            ws.close()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+        self._executor_closed = True
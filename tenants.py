@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多机器人（多租户）模块
+一个进程内服务多个钉钉机器人：每个机器人有自己的 access_token/secret、回复限额和 Gemini 调用份额，
+HTTP 连接池、Gemini 客户端和 sessionWebhook 缓存在机器人之间共用。
+
+机器人配置从 TENANTS_FILE 指定的 JSON 文件读取，格式见 tenants.example.json；
+未配置时使用 DINGTALK_ACCESS_TOKEN 等环境变量作为唯一的 default 机器人
+"""
+
+import os
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from config import Config
+from dingtalk_bot import DingTalkBot
+from dingtalk_openapi import create_openapi_client
+from reply_router import ReplyRouter, SessionWebhookCache
+from utils import SharedTokenBucket
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+
+
+class Tenant:
+    """单个机器人的配置和运行时状态"""
+
+    def __init__(self, name: str, settings: Dict[str, Any], cache: SessionWebhookCache, gemini_rate: float):
+        """
+        Args:
+            name: 机器人名称，对应 /webhook/<name>
+            settings: 机器人配置
+            cache: 共用的 sessionWebhook 缓存
+            gemini_rate: 分配给该机器人的 Gemini 调用速率（次/秒）
+        """
+        self.name = name
+        self.robot_code = settings.get('robot_code', '')
+        self.webhook_secret = settings.get('webhook_secret', '')
+        self.model_name = settings.get('model') or None
+        self.bot = DingTalkBot(settings.get('access_token', ''), settings.get('secret', ''))
+        openapi = create_openapi_client(
+            settings.get('app_key', ''), settings.get('app_secret', ''), self.robot_code
+        )
+        self.reply_router = ReplyRouter(
+            self.bot, openapi, cache=cache, namespace=name,
+            robot_send_per_minute=settings.get('robot_send_per_minute'),
+            robot_conversation_id=settings.get('robot_conversation_id', '')
+        )
+        # Gemini 调用份额，允许短时突发；计数放在共享内存中，多个 worker 合计不超过份额
+        self.gemini_limiter = SharedTokenBucket(gemini_rate, capacity=max(gemini_rate * 10, 1.0))
+
+    def try_acquire_gemini(self) -> bool:
+        """占用一次 Gemini 调用份额，份额用尽时返回 False"""
+        return self.gemini_limiter.try_acquire()
+
+
+class TenantRegistry:
+    """机器人注册表：按名称或 robotCode 查找机器人"""
+
+    def __init__(self, tenant_settings: Dict[str, Dict[str, Any]]):
+        """
+        Args:
+            tenant_settings: 机器人名称到配置的映射
+        """
+        # 各机器人按 quota_share 权重分配总的 Gemini 调用速率
+        total_rate = Config.GEMINI_REQUESTS_PER_MINUTE / 60.0
+        total_share = sum(float(settings.get('quota_share', 1)) for settings in tenant_settings.values()) or 1.0
+
+        self.cache = SessionWebhookCache()
+        self._tenants: Dict[str, Tenant] = {}
+        self._by_robot_code: Dict[str, Tenant] = {}
+        for name, settings in tenant_settings.items():
+            rate = total_rate * float(settings.get('quota_share', 1)) / total_share
+            tenant = Tenant(name, settings, self.cache, rate)
+            self._tenants[name] = tenant
+            if tenant.robot_code:
+                self._by_robot_code[tenant.robot_code] = tenant
+
+    def get(self, name: str) -> Optional[Tenant]:
+        """按名称查找机器人"""
+        return self._tenants.get(name)
+
+    def resolve(self, name: Optional[str], data: Dict[str, Any]) -> Optional[Tenant]:
+        """
+        确定消息所属的机器人：优先使用路径中的名称，其次是消息中的 robotCode，
+        只有一个机器人时直接使用它
+
+        Args:
+            name: /webhook/<name> 中的名称
+            data: webhook 消息
+
+        Returns:
+            Tenant: 机器人，无法确定时为 None
+        """
+        if name:
+            return self._tenants.get(name)
+        tenant = self._by_robot_code.get(data.get('robotCode', ''))
+        if tenant is not None:
+            return tenant
+        if len(self._tenants) == 1:
+            return next(iter(self._tenants.values()))
+        return self._tenants.get(DEFAULT_TENANT)
+
+    def names(self) -> List[str]:
+        """所有机器人名称"""
+        return list(self._tenants)
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+
+def load_tenant_settings(path: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    读取机器人配置
+
+    Args:
+        path: JSON 配置文件路径，默认读取 TENANTS_FILE
+
+    Returns:
+        dict: 机器人名称到配置的映射
+    """
+    path = path if path is not None else Config.TENANTS_FILE
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+        # 允许在配置中用 "$ENV_NAME" 引用环境变量，避免把密钥写进文件
+        return {
+            name: {
+                key: os.getenv(value[1:], '') if isinstance(value, str) and value.startswith('$') else value
+                for key, value in tenant.items()
+            }
+            for name, tenant in settings.items()
+        }
+
+    return {
+        DEFAULT_TENANT: {
+            'access_token': os.getenv('DINGTALK_ACCESS_TOKEN', ''),
+            'secret': os.getenv('DINGTALK_SECRET', ''),
+            'app_key': Config.DINGTALK_APP_KEY,
+            'app_secret': Config.DINGTALK_APP_SECRET,
+            'robot_code': Config.DINGTALK_ROBOT_CODE,
+            'robot_conversation_id': Config.DINGTALK_ROBOT_CONVERSATION_ID,
+        }
+    }
+
+
+# 进程级全局注册表
+_registry: Optional[TenantRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_tenant_registry() -> Optional[TenantRegistry]:
+    """获取全局机器人注册表"""
+    return _registry
+
+
+def initialize_tenant_registry(path: Optional[str] = None) -> bool:
+    """
+    初始化全局机器人注册表
+
+    Args:
+        path: JSON 配置文件路径，默认读取 TENANTS_FILE
+
+    Returns:
+        bool: 是否初始化成功（至少有一个可以回复消息的机器人）
+    """
+    global _registry
+
+    try:
+        settings = load_tenant_settings(path)
+    except (OSError, ValueError) as e:
+        logger.error(f"读取机器人配置失败: {e}")
+        return False
+
+    with _registry_lock:
+        _registry = TenantRegistry(settings)
+
+    usable = [
+        name for name in _registry.names()
+        if _registry.get(name).bot.access_token or _registry.get(name).reply_router.openapi
+    ]
+    if not usable:
+        logger.error("没有可用的机器人：请设置 DINGTALK_ACCESS_TOKEN 或 DINGTALK_APP_KEY/DINGTALK_APP_SECRET，或配置 TENANTS_FILE")
+        return False
+
+    logger.info("已加载 %d 个机器人: %s", len(_registry), ", ".join(_registry.names()))
+    return True
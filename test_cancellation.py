@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成取消测试脚本
+验证取消指令、重新提问的取代窗口、取消信号不影响之后开始的请求，
+通过共享内存传到其他 worker 的信号只取消同一发送者的请求（哈希分到同一个槽的其他发送者不受影响），
+以及中止流式响应时阻塞中的读取立即返回
+"""
+
+import os
+import sys
+import time
+import threading
+import http.server
+import socketserver
+
+import requests
+
+from cancellation import (
+    REASON_COMMAND, REASON_SUPERSEDED, CancellationRegistry, cancel_key, is_cancel_command
+)
+from gemini_simple import abort_response
+
+KEY_A = ("dingA:cidGROUP", "user_a")
+KEY_B = ("dingA:cidGROUP", "user_b")
+
+
+def signal_from_other_worker(registry: CancellationRegistry, key, command: bool = False):
+    """在 fork 出的子进程中发送信号，模拟由另一个 gunicorn worker 接收的消息"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            registry.signal(key, command=command)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def test_cancel_command():
+    assert is_cancel_command("算了")
+    assert is_cancel_command(" /stop ")
+    assert not is_cancel_command("算了吧，换个问题：今天周几？")
+
+    registry = CancellationRegistry(slots=64, supersede_window=5)
+    token = registry.begin(KEY_A)
+    other = registry.begin(KEY_B)
+    registry.signal(KEY_A, command=True)
+    assert token.cancelled and token.reason == REASON_COMMAND
+    assert not other.cancelled
+    registry.end(token)
+    registry.end(other)
+
+
+def test_supersede_window():
+    registry = CancellationRegistry(slots=64, supersede_window=5)
+    token = registry.begin(KEY_A)
+    token.started_at -= 1
+    registry.signal(KEY_A)
+    assert token.cancelled and token.reason == REASON_SUPERSEDED
+    registry.end(token)
+
+    # 生成开始太久以后的新消息不取代原请求
+    token = registry.begin(KEY_A)
+    token.started_at -= 10
+    registry.signal(KEY_A)
+    registry.poll()
+    assert not token.cancelled
+    registry.end(token)
+
+    # 取代窗口为 0 时只响应取消指令
+    registry = CancellationRegistry(slots=64, supersede_window=0)
+    token = registry.begin(KEY_A)
+    token.started_at -= 1
+    registry.signal(KEY_A)
+    registry.poll()
+    assert not token.cancelled
+    registry.end(token)
+
+
+def test_signal_before_start_is_ignored():
+    registry = CancellationRegistry(slots=64, supersede_window=5)
+    registry.signal(KEY_A, command=True)
+    token = registry.begin(KEY_A)
+    registry.poll()
+    assert not token.cancelled
+    registry.end(token)
+
+
+def test_signal_from_other_worker():
+    if not hasattr(os, "fork"):
+        print("⏭️ 需要 os.fork，跳过")
+        return
+    registry = CancellationRegistry(slots=64, supersede_window=5)
+    token = registry.begin(KEY_A)
+    token.started_at -= 1
+    signal_from_other_worker(registry, KEY_A, command=True)
+    assert not token.cancelled
+    registry.poll()
+    assert token.cancelled and token.reason == REASON_COMMAND
+    registry.end(token)
+
+
+def test_colliding_key_does_not_cancel():
+    if not hasattr(os, "fork"):
+        print("⏭️ 需要 os.fork，跳过")
+        return
+    # 只有一个槽，所有发送者都分到同一个槽
+    registry = CancellationRegistry(slots=1, supersede_window=5)
+    token = registry.begin(KEY_A)
+    token.started_at -= 1
+    signal_from_other_worker(registry, KEY_B, command=True)
+    signal_from_other_worker(registry, KEY_B)
+    registry.poll()
+    assert not token.cancelled
+
+    # 同一个槽随后写入本发送者的信号时仍然生效
+    signal_from_other_worker(registry, KEY_A)
+    registry.poll()
+    assert token.cancelled and token.reason == REASON_SUPERSEDED
+    registry.end(token)
+
+
+def test_cancel_key():
+    data = {"conversationId": "cidGROUP", "robotCode": "dingA", "senderStaffId": "user_a", "senderId": "$:LWCP"}
+    assert cancel_key(data) == KEY_A
+    assert cancel_key({"conversationId": "cidGROUP", "senderId": "$:LWCP"}) == ("cidGROUP", "$:LWCP")
+
+
+class SlowStreamHandler(http.server.BaseHTTPRequestHandler):
+    """发出第一段数据后长时间不再发送，模拟生成中的流式响应"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        body = b"data: {}\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(body), body))
+        self.wfile.flush()
+        time.sleep(3)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def test_abort_response_interrupts_blocked_read():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SlowStreamHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        response = requests.get(f"http://127.0.0.1:{server.server_address[1]}/", stream=True, timeout=10)
+        threading.Timer(0.2, abort_response, (response,)).start()
+        start_time = time.monotonic()
+        try:
+            for _ in response.iter_lines(chunk_size=None):
+                pass
+            raise AssertionError("中止后读取没有抛出异常")
+        except requests.exceptions.RequestException:
+            pass
+        assert time.monotonic() - start_time < 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    """运行所有测试"""
+    print("🧪 生成取消测试")
+    print("=" * 50)
+
+    tests = [
+        ("取消指令", test_cancel_command),
+        ("重新提问的取代窗口", test_supersede_window),
+        ("开始前的信号不生效", test_signal_before_start_is_ignored),
+        ("其他 worker 发出的信号", test_signal_from_other_worker),
+        ("哈希冲突的发送者不受影响", test_colliding_key_does_not_cancel),
+        ("取消键", test_cancel_key),
+        ("中止阻塞中的流式读取", test_abort_response_interrupts_blocked_read),
+    ]
+
+    failed = 0
+    for name, test in tests:
+        try:
+            test()
+            print(f"✅ {name}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {name}: {e}")
+
+    print("=" * 50)
+    print("🎉 所有测试通过！" if not failed else f"⚠️ {failed} 项测试失败")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
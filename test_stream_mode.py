@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stream 模式测试脚本
+使用本地替身服务（仅依赖标准库）模拟钉钉的连接凭证接口和 WebSocket 网关，
+验证 ping 回复、消息确认与分发、重复消息去重、断线重连、同一会话按顺序处理、连续消息合并、
+取消指令丢弃同一发送者未处理的消息和 WebSocket 心跳
+"""
+
+import sys
+import json
+import time
+import queue
+import base64
+import socket
+import struct
+import hashlib
+import threading
+import socketserver
+
+from stream_mode import StreamClient, TOPIC_ROBOT_MESSAGE
+
+_WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class StandInGateway(socketserver.ThreadingTCPServer):
+    """钉钉 Stream 网关替身：POST 申请连接凭证，GET 升级为 WebSocket"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _GatewayHandler)
+        self.port = self.server_address[1]
+        self.tickets = 0
+        self.connections = 0
+        self.pings = 0
+        self.received: "queue.Queue[dict]" = queue.Queue()
+        self.current = None
+        self.connected = threading.Event()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def gateway_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1.0/gateway/connections/open"
+
+    def send(self, frame: dict):
+        """向当前连接发送一帧 JSON 消息"""
+        self.current.send_frame(0x1, json.dumps(frame).encode("utf-8"))
+
+    def drop(self):
+        """关闭当前连接，模拟网络中断"""
+        self.connected.clear()
+        self.current.send_frame(0x8, struct.pack("!H", 1001))
+        self.current.request.close()
+
+    def expect(self, predicate, timeout: float = 5) -> dict:
+        """等待客户端发来满足条件的消息"""
+        end_time = time.time() + timeout
+        while time.time() < end_time:
+            try:
+                frame = self.received.get(timeout=max(end_time - time.time(), 0.01))
+            except queue.Empty:
+                break
+            if predicate(frame):
+                return frame
+        raise AssertionError("未收到预期的客户端消息")
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _GatewayHandler(socketserver.BaseRequestHandler):
+
+    def _read_request(self):
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return None, {}
+            data += chunk
+        head = data.split(b"\r\n\r\n", 1)[0].decode("latin-1").split("\r\n")
+        headers = {}
+        for line in head[1:]:
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return head[0], headers
+
+    def handle(self):
+        request_line, headers = self._read_request()
+        if request_line is None:
+            return
+        server = self.server
+
+        if request_line.startswith("POST"):
+            length = int(headers.get("content-length", 0))
+            # 请求体可能与请求头一起到达，这里不需要内容，只要读完即可
+            self.request.settimeout(0.2)
+            try:
+                while length > 0:
+                    chunk = self.request.recv(length)
+                    if not chunk:
+                        break
+                    length -= len(chunk)
+            except socket.timeout:
+                pass
+            server.tickets += 1
+            body = json.dumps({"endpoint": f"ws://127.0.0.1:{server.port}/connect", "ticket": f"t-{server.tickets}"}).encode()
+            self.request.sendall(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            return
+
+        accept = base64.b64encode(
+            hashlib.sha1((headers["sec-websocket-key"] + _WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+        self.request.sendall(
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+        )
+        self.request.settimeout(None)
+        self.lock = threading.Lock()
+        server.connections += 1
+        server.current = self
+        server.connected.set()
+
+        try:
+            while True:
+                opcode, payload = self._read_frame()
+                if opcode == 0x1:
+                    server.received.put(json.loads(payload))
+                elif opcode == 0x9:
+                    server.pings += 1
+                    self.send_frame(0xA, payload)
+                elif opcode == 0x8:
+                    self.send_frame(0x8, payload[:2])
+                    return
+        except (OSError, ConnectionError):
+            return
+
+    def _recv_exact(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("连接已关闭")
+            data += chunk
+        return data
+
+    def _read_frame(self):
+        first, second = self._recv_exact(2)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._recv_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._recv_exact(8))[0]
+        mask = self._recv_exact(4) if second & 0x80 else b"\0\0\0\0"
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self._recv_exact(length)))
+        return first & 0x0F, payload
+
+    def send_frame(self, opcode: int, payload: bytes):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self.lock:
+            self.request.sendall(header + payload)
+
+
+def _robot_frame(message_id: str, msg_id: str, content: str, conversation_id: str = "cid-1", sender: str = "u1") -> dict:
+    return {
+        "specVersion": "1.0",
+        "type": "CALLBACK",
+        "headers": {"topic": TOPIC_ROBOT_MESSAGE, "messageId": message_id, "contentType": "application/json"},
+        "data": json.dumps({
+            "msgId": msg_id, "conversationId": conversation_id, "senderStaffId": sender,
+            "msgtype": "text", "text": {"content": content}
+        }),
+    }
+
+
+def _start_client(gateway: StandInGateway, on_message, ping_interval: float = 0, debounce: bool = False) -> StreamClient:
+    client = StreamClient(
+        "app-key", "app-secret", on_message, name="test", gateway_url=gateway.gateway_url,
+        ping_interval=ping_interval, reconnect_min=0.05, reconnect_max=0.2, debounce=debounce
+    )
+    client.start()
+    assert client.connected.wait(5), "客户端未能建立连接"
+    assert gateway.connected.wait(5)
+    return client
+
+
+def test_ping_ack_and_dispatch():
+    """ping 原样回复；机器人消息先确认再分发，重复投递只处理一次"""
+    gateway = StandInGateway()
+    received = queue.Queue()
+    client = _start_client(gateway, received.put)
+    try:
+        gateway.send({"type": "SYSTEM", "headers": {"topic": "ping", "messageId": "p1"}, "data": '{"opaque":"x"}'})
+        pong = gateway.expect(lambda frame: frame["headers"].get("messageId") == "p1")
+        assert pong["code"] == 200 and pong["data"] == '{"opaque":"x"}'
+
+        gateway.send(_robot_frame("m1", "msg-1", "你好"))
+        ack = gateway.expect(lambda frame: frame["headers"].get("messageId") == "m1")
+        assert ack["code"] == 200
+        message = received.get(timeout=5)
+        assert message["text"]["content"] == "你好"
+
+        # 同一条消息以新的 messageId 重投：仍然确认，但不再处理
+        gateway.send(_robot_frame("m2", "msg-1", "你好"))
+        gateway.expect(lambda frame: frame["headers"].get("messageId") == "m2")
+        time.sleep(0.2)
+        assert received.empty()
+    finally:
+        client.stop()
+        gateway.stop()
+
+
+def test_reconnect_after_drop():
+    """连接中断后重新申请凭证并重连，新连接上的消息正常处理"""
+    gateway = StandInGateway()
+    received = queue.Queue()
+    client = _start_client(gateway, received.put)
+    try:
+        gateway.drop()
+        assert gateway.connected.wait(5), "客户端未能重连"
+        assert client.connected.wait(5)
+        assert gateway.connections == 2 and gateway.tickets == 2
+
+        gateway.send(_robot_frame("m3", "msg-3", "重连后的消息"))
+        gateway.expect(lambda frame: frame["headers"].get("messageId") == "m3")
+        assert received.get(timeout=5)["msgId"] == "msg-3"
+
+        # 服务端发出断开通知时客户端主动断开并重连
+        gateway.connected.clear()
+        gateway.send({"type": "SYSTEM", "headers": {"topic": "disconnect", "messageId": "d1"}, "data": "{}"})
+        assert gateway.connected.wait(5), "收到断开通知后未能重连"
+        assert gateway.connections == 3
+    finally:
+        client.stop()
+        gateway.stop()
+
+
+def test_conversation_order():
+    """同一会话的消息按顺序处理，不同会话的消息并行处理"""
+    gateway = StandInGateway()
+    finished = queue.Queue()
+
+    def on_message(data):
+        if data["text"]["content"] == "慢":
+            time.sleep(0.3)
+        finished.put(data["msgId"])
+
+    client = _start_client(gateway, on_message)
+    try:
+        gateway.send(_robot_frame("o1", "a-1", "慢", "cid-a"))
+        gateway.send(_robot_frame("o2", "a-2", "快", "cid-a"))
+        gateway.send(_robot_frame("o3", "b-1", "快", "cid-b"))
+        order = [finished.get(timeout=5) for _ in range(3)]
+        assert order == ["b-1", "a-1", "a-2"], order
+        # 会话的消息处理完后不再保留队列
+        assert client._executor.active_keys == 0
+    finally:
+        client.stop()
+        gateway.stop()
+
+
+def test_debounce_merge():
+    """同一发送者连续发来的文本消息合并为一条处理，其他发送者的消息不受影响"""
+    gateway = StandInGateway()
+    received = queue.Queue()
+    client = _start_client(gateway, received.put, debounce=True)
+    try:
+        for index, content in enumerate(["帮我看看", "这段代码", "为什么报错"]):
+            gateway.send(_robot_frame(f"d{index}", f"msg-d{index}", content))
+            time.sleep(0.1)
+        gateway.send(_robot_frame("e1", "msg-e1", "你好", sender="u2"))
+
+        messages = {}
+        for _ in range(2):
+            message = received.get(timeout=5)
+            messages[message["senderStaffId"]] = message["text"]["content"]
+        assert messages == {"u1": "帮我看看\n这段代码\n为什么报错", "u2": "你好"}, messages
+        time.sleep(0.2)
+        assert received.empty()
+    finally:
+        client.stop()
+        gateway.stop()
+
+
+def test_cancel_drops_pending():
+    """取消指令跳过同一发送者排队中的消息并丢弃等待合并的文本，其他发送者的消息照常处理"""
+    gateway = StandInGateway()
+    finished = queue.Queue()
+
+    def on_message(data):
+        if data["text"]["content"] == "慢":
+            time.sleep(0.3)
+        finished.put(data["text"]["content"])
+
+    client = _start_client(gateway, on_message)
+    try:
+        gateway.send(_robot_frame("c1", "msg-c1", "慢"))
+        gateway.send(_robot_frame("c2", "msg-c2", "第一个问题"))
+        gateway.send(_robot_frame("c3", "msg-c3", "另一个人的问题", sender="u2"))
+        gateway.send(_robot_frame("c4", "msg-c4", "算了"))
+        order = [finished.get(timeout=5) for _ in range(3)]
+        assert order == ["慢", "另一个人的问题", "算了"], order
+        time.sleep(0.2)
+        assert finished.empty()
+    finally:
+        client.stop()
+        gateway.stop()
+
+    gateway = StandInGateway()
+    client = _start_client(gateway, finished.put, debounce=True)
+    try:
+        gateway.send(_robot_frame("c5", "msg-c5", "帮我看看"))
+        gateway.send(_robot_frame("c6", "msg-c6", "算了"))
+        assert finished.get(timeout=5)["text"]["content"] == "算了"
+        time.sleep(1.5)
+        assert finished.empty()
+    finally:
+        client.stop()
+        gateway.stop()
+
+
+def test_restart_after_stop():
+    """stop() 之后再次 start()，新连接上的消息仍然正常处理"""
+    gateway = StandInGateway()
+    received = queue.Queue()
+    client = _start_client(gateway, received.put)
+    try:
+        client.stop()
+        gateway.connected.clear()
+        client.start()
+        assert gateway.connected.wait(5), "客户端未能重新连接"
+        assert client.connected.wait(5)
+
+        gateway.send(_robot_frame("r1", "msg-r1", "重新启动后的消息"))
+        gateway.expect(lambda frame: frame["headers"].get("messageId") == "r1")
+        assert received.get(timeout=5)["msgId"] == "msg-r1"
+    finally:
+        client.stop()
+        gateway.stop()
+
+
+def test_websocket_heartbeat():
+    """启用心跳时客户端定期发送 WebSocket ping"""
+    gateway = StandInGateway()
+    client = _start_client(gateway, lambda data: None, ping_interval=0.3)
+    try:
+        end_time = time.time() + 5
+        while gateway.pings < 2 and time.time() < end_time:
+            time.sleep(0.05)
+        assert gateway.pings >= 2
+        assert client.connected.is_set()
+    finally:
+        client.stop()
+        gateway.stop()
+
+
+def main():
+    """运行所有测试"""
+    print("🧪 Stream 模式测试")
+    print("=" * 50)
+
+    tests = [
+        ("ping 回复、消息确认与去重", test_ping_ack_and_dispatch),
+        ("断线重连", test_reconnect_after_drop),
+        ("同一会话按顺序处理", test_conversation_order),
+        ("连续消息合并", test_debounce_merge),
+        ("取消指令丢弃未处理的消息", test_cancel_drops_pending),
+        ("停止后重新启动", test_restart_after_stop),
+        ("WebSocket 心跳", test_websocket_heartbeat),
+    ]
+
+    failed = 0
+    for name, test in tests:
+        try:
+            test()
+            print(f"✅ {name}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {name}: {e}")
+
+    print("=" * 50)
+    print("🎉 所有测试通过！" if not failed else f"⚠️ {failed} 项测试失败")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
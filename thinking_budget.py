@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+思考预算模块
+Gemini 2.5 系列默认会先进行内部思考再作答，思考 token 同样计入耗时和 max_output_tokens。
+本模块按模型档位给出默认思考预算，并可按问题类型自动调节：
+在回答保持非空的前提下逐步尝试更小的预算，出现空回答时回升一级
+"""
+
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from config import Config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 自动调节使用的预算档位
+BUDGET_LADDER = (0, 128, 512, 1024, 2048, 4096)
+
+# 空回答时这些结束原因与思考预算无关，不参与调节
+_NON_BUDGET_FINISH_REASONS = frozenset({
+    "SAFETY", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "RECITATION",
+})
+
+# 向下试探失败后，下次试探前所需的连续成功次数上限
+_MAX_PROBE_INTERVAL = 3200
+
+
+def budget_limits(model_name: str) -> Optional[Tuple[int, int, bool]]:
+    """
+    获取模型支持的思考预算范围
+
+    Args:
+        model_name: 模型名称
+
+    Returns:
+        tuple: (最小非零预算, 最大预算, 是否可以关闭思考)，模型不支持思考预算时为 None
+    """
+    if "2.5-pro" in model_name:
+        return 128, 32768, False
+    if "2.5-flash-lite" in model_name:
+        return 512, 24576, True
+    if "2.5-flash" in model_name:
+        return 1, 24576, True
+    return None
+
+
+def clamp_budget(model_name: str, budget: int) -> Optional[int]:
+    """
+    把思考预算限制在模型支持的范围内
+
+    Args:
+        model_name: 模型名称
+        budget: 期望的思考预算
+
+    Returns:
+        int: 实际使用的预算，模型不支持思考预算时为 None
+    """
+    limits = budget_limits(model_name)
+    if limits is None:
+        return None
+    minimum, maximum, can_disable = limits
+    if budget <= 0 and can_disable:
+        return 0
+    return max(minimum, min(budget, maximum))
+
+
+def default_budget(model_name: str) -> int:
+    """按模型所在的路由档位返回默认思考预算"""
+    if model_name == Config.MODEL_PRO:
+        return Config.THINKING_BUDGET_PRO
+    if model_name == Config.MODEL_LITE:
+        return Config.THINKING_BUDGET_LITE
+    return Config.THINKING_BUDGET_FLASH
+
+
+def output_token_limit(max_output_tokens: int, budget: Optional[int]) -> int:
+    """
+    计算请求中的 max_output_tokens
+
+    2.5 系列的思考 token 计入输出上限，开启思考时需要为其额外预留，
+    否则回答部分可能被思考占满而返回空内容
+    """
+    return max_output_tokens + (budget or 0)
+
+
+def is_budget_failure(text: str, finish_reason: Optional[str]) -> bool:
+    """
+    判断空回答是否可能由思考预算不足导致
+
+    Args:
+        text: 模型返回的文本
+        finish_reason: 结束原因
+
+    Returns:
+        bool: 是否应计为一次预算失败
+    """
+    if text:
+        return False
+    return (finish_reason or "").upper() not in _NON_BUDGET_FINISH_REASONS
+
+
+class _TuningState:
+    """单个（模型, 问题类型）的调节状态"""
+
+    __slots__ = ('level', 'successes', 'probe_after', 'probing')
+
+    def __init__(self, level: int, probe_after: int):
+        self.level = level
+        self.successes = 0
+        self.probe_after = probe_after
+        self.probing = False
+
+
+class ThinkingBudgetController:
+    """思考预算控制器：提供默认预算，开启自动调节时按问题类型寻找最小可用预算"""
+
+    def __init__(self, autotune: Optional[bool] = None, probe_interval: Optional[int] = None):
+        """
+        Args:
+            autotune: 是否自动调节，默认读取配置
+            probe_interval: 连续成功多少次后尝试降低一级预算，默认读取配置
+        """
+        self.autotune = Config.THINKING_AUTOTUNE if autotune is None else autotune
+        self.probe_interval = probe_interval or Config.THINKING_PROBE_INTERVAL
+        self._states: Dict[Tuple[str, str], _TuningState] = {}
+        self._lock = threading.Lock()
+
+    def _ladder(self, model_name: str) -> Tuple[int, ...]:
+        """模型可用的预算档位（去掉被限制后重复的档位）"""
+        levels = []
+        for budget in BUDGET_LADDER:
+            clamped = clamp_budget(model_name, budget)
+            if clamped is not None and clamped not in levels:
+                levels.append(clamped)
+        return tuple(levels)
+
+    def _state(self, model_name: str, question_class: str) -> _TuningState:
+        key = (model_name, question_class)
+        state = self._states.get(key)
+        if state is None:
+            ladder = self._ladder(model_name)
+            start = clamp_budget(model_name, default_budget(model_name))
+            # 从不小于默认预算的第一个档位开始
+            level = next((i for i, budget in enumerate(ladder) if budget >= start), len(ladder) - 1)
+            state = self._states[key] = _TuningState(level, self.probe_interval)
+        return state
+
+    def budget_for(self, model_name: str, question_class: str) -> Optional[int]:
+        """
+        获取本次请求使用的思考预算
+
+        Args:
+            model_name: 模型名称
+            question_class: 问题类型（greeting / code / long_form / general）
+
+        Returns:
+            int: 思考预算，模型不支持思考预算时为 None
+        """
+        if budget_limits(model_name) is None:
+            return None
+        if not self.autotune:
+            return clamp_budget(model_name, default_budget(model_name))
+
+        with self._lock:
+            state = self._state(model_name, question_class)
+            return self._ladder(model_name)[state.level]
+
+    def record(
+        self,
+        model_name: str,
+        question_class: str,
+        budget: Optional[int],
+        text: str,
+        finish_reason: Optional[str] = None,
+        thoughts_tokens: int = 0
+    ):
+        """
+        记录一次调用结果，开启自动调节时据此调整预算
+
+        Args:
+            model_name: 模型名称
+            question_class: 问题类型
+            budget: 本次使用的思考预算
+            text: 模型返回的文本
+            finish_reason: 结束原因
+            thoughts_tokens: usageMetadata.thoughtsTokenCount
+        """
+        if budget is None:
+            return
+
+        if thoughts_tokens:
+            metrics.observe("thinking_tokens", thoughts_tokens, model=model_name)
+        failed = is_budget_failure(text, finish_reason)
+        if failed:
+            metrics.inc("thinking_empty_answers", model=model_name, question_class=question_class)
+
+        if not self.autotune:
+            return
+
+        with self._lock:
+            state = self._state(model_name, question_class)
+            ladder = self._ladder(model_name)
+            if ladder[state.level] != budget:
+                # 调节期间已经换了档位，旧请求的结果不再参考
+                return
+
+            if failed:
+                if state.probing:
+                    # 刚降下来的档位不够用，延长下一次试探的间隔
+                    state.probe_after = min(state.probe_after * 2, _MAX_PROBE_INTERVAL)
+                state.probing = False
+                state.successes = 0
+                if state.level < len(ladder) - 1:
+                    state.level += 1
+                    logger.info("思考预算上调: %s/%s -> %d", model_name, question_class, ladder[state.level])
+                return
+
+            state.successes += 1
+            if state.level > 0 and state.successes >= state.probe_after:
+                state.level -= 1
+                state.successes = 0
+                state.probing = True
+                logger.info("思考预算试探下调: %s/%s -> %d", model_name, question_class, ladder[state.level])
+
+    def snapshot(self) -> Dict[str, Any]:
+        """获取各（模型, 问题类型）当前的思考预算"""
+        with self._lock:
+            return {
+                f"{model_name}/{question_class}": self._ladder(model_name)[state.level]
+                for (model_name, question_class), state in self._states.items()
+            }
+
+
+# 进程级全局控制器
+_controller: Optional[ThinkingBudgetController] = None
+
+
+def get_thinking_controller() -> ThinkingBudgetController:
+    """获取全局思考预算控制器"""
+    global _controller
+
+    if _controller is None:
+        _controller = ThinkingBudgetController()
+    return _controller
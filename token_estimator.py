@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 token 估算模块
+在调用 Gemini 前估算输入 token 数，用于裁剪超长输入和确定 max_output_tokens；
+估算值会用 Vertex AI 返回的 usageMetadata 持续校准
+"""
+
+import re
+import logging
+import threading
+from typing import Any, Callable, Optional, Sequence, Tuple
+
+from config import Config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 代码特征
+_CODE_RE = re.compile(r'```|^\s*(def |class |import |from \S+ import|function |public |#include)|[{};]\s*$', re.M)
+# 寒暄类短消息
+_GREETING_RE = re.compile(r'^(你好|您好|hi|hello|hey|在吗|在不在|早上好|晚上好|谢谢|多谢|thanks|thank you|好的|ok)[\s!！。.?？~～]*$', re.I)
+# 长文写作类请求
+_LONG_FORM_RE = re.compile(r'写一篇|写一份|报告|总结|方案|详细|文档|论文|大纲|翻译|report|essay|article', re.I)
+
+# 各类问题的默认输出 token 数
+OUTPUT_TOKENS_BY_TYPE = {
+    "greeting": 256,
+    "general": 1024,
+    "code": 2048,
+    "long_form": 4096,
+}
+
+# 裁剪超长输入时插入的说明
+TRIM_MARKER = "\n……（中间内容过长，已省略）……\n"
+
+# 中日韩字符（UTF-8 下占 3 字节）在 Gemini 分词中大约每个字符 1 个 token，
+# 其他字符大约 4 个字符 1 个 token
+CJK_TOKENS_PER_CHAR = 1.0
+OTHER_CHARS_PER_TOKEN = 4.0
+
+
+def classify_question(text: str) -> str:
+    """
+    粗略判断问题类型
+
+    Args:
+        text: 问题内容
+
+    Returns:
+        str: greeting / code / long_form / general
+    """
+    stripped = text.strip()
+    if len(stripped) <= 12 and _GREETING_RE.match(stripped):
+        return "greeting"
+    if _CODE_RE.search(text):
+        return "code"
+    if _LONG_FORM_RE.search(text):
+        return "long_form"
+    return "general"
+
+
+class TokenEstimator:
+    """基于字符类别的 token 估算器，带在线校准"""
+
+    def __init__(self, smoothing: float = 0.1):
+        """
+        Args:
+            smoothing: 校准系数的指数平滑权重
+        """
+        self.smoothing = smoothing
+        self.calibration = 1.0
+        self._lock = threading.Lock()
+
+    def estimate_raw(self, text: str) -> float:
+        """未校准的估算值"""
+        if not text:
+            return 0.0
+        # 用 UTF-8 字节数估算多字节字符数量，避免逐字符判断
+        cjk = (len(text.encode('utf-8')) - len(text)) / 2
+        spaces = text.count(' ') + text.count('\n')
+        other = max(len(text) - cjk - spaces, 0)
+        return cjk * CJK_TOKENS_PER_CHAR + other / OTHER_CHARS_PER_TOKEN + spaces * 0.1
+
+    def estimate(self, text: str) -> int:
+        """
+        估算文本的 token 数
+
+        Args:
+            text: 文本
+
+        Returns:
+            int: 估算的 token 数
+        """
+        return int(self.estimate_raw(text) * self.calibration + 0.5)
+
+    def record_usage(self, estimated: int, actual: int):
+        """
+        用 Vertex AI 返回的实际 token 数校准估算器
+
+        Args:
+            estimated: 调用前的估算值
+            actual: usageMetadata.promptTokenCount
+        """
+        if estimated <= 0 or actual <= 0:
+            return
+
+        ratio = actual / estimated
+        metrics.observe("token_estimate_ratio", ratio)
+        metrics.observe("token_estimate_abs_error", abs(actual - estimated))
+
+        with self._lock:
+            # 估算值已包含当前校准系数，按比例修正并限制在合理范围
+            target = min(max(self.calibration * ratio, 0.5), 2.0)
+            self.calibration += self.smoothing * (target - self.calibration)
+
+    def trim(self, text: str, max_tokens: int) -> Tuple[str, int]:
+        """
+        输入超过预算时保留开头和结尾、省略中间部分
+
+        Args:
+            text: 原始输入
+            max_tokens: 输入 token 预算
+
+        Returns:
+            tuple: (裁剪后的文本, 估算 token 数)
+        """
+        tokens = self.estimate(text)
+        if tokens <= max_tokens:
+            return text, tokens
+
+        # 按 token 比例估算保留的字符数，开头通常包含问题本身，保留更多
+        keep_chars = max(int(len(text) * max_tokens / tokens) - len(TRIM_MARKER), 0)
+        head = int(keep_chars * 0.7)
+        tail = keep_chars - head
+        trimmed = text[:head] + TRIM_MARKER + (text[-tail:] if tail else '')
+
+        metrics.inc("input_trimmed")
+        logger.info("输入过长（约%d tokens），已裁剪到约%d tokens", tokens, max_tokens)
+        return trimmed, self.estimate(trimmed)
+
+    def size_output(self, question: str, input_tokens: int) -> int:
+        """
+        根据问题类型和剩余预算确定 max_output_tokens
+
+        Args:
+            question: 问题内容
+            input_tokens: 输入 token 估算值
+
+        Returns:
+            int: max_output_tokens
+        """
+        wanted = OUTPUT_TOKENS_BY_TYPE[classify_question(question)]
+        remaining = Config.CONTEXT_TOKEN_BUDGET - input_tokens
+        return max(min(wanted, remaining, Config.MAX_OUTPUT_TOKENS), 64)
+
+
+# 进程级全局估算器
+_estimator = TokenEstimator()
+
+
+def get_token_estimator() -> TokenEstimator:
+    """获取全局 token 估算器"""
+    return _estimator
+
+
+def prepare_generation(
+    prompt: str,
+    max_output_tokens: Optional[int] = None,
+    history: Sequence[Any] = (),
+    augment: Optional[Callable[[str], str]] = None
+) -> Tuple[str, int, int]:
+    """
+    调用 Gemini 前的输入裁剪和输出长度确定
+
+    Args:
+        prompt: 输入提示
+        max_output_tokens: 调用方指定的输出上限，None 表示按问题自动确定
+        history: 随请求发送的对话记录（conversation_store.Turn），计入输入 token
+        augment: 在问题前附加参考资料的函数（例如 retrieval.augment_prompt），返回值以问题结尾；
+            输出长度按原始问题确定，超出输入预算时只裁剪参考资料
+
+    Returns:
+        tuple: (处理后的提示, 输入 token 估算值（含对话记录和参考资料）, max_output_tokens)
+    """
+    # 对话记录占用输入预算，但至少给当前问题留一半
+    history_tokens = sum(_estimator.estimate(turn.text) for turn in history)
+    prompt_budget = max(Config.MAX_INPUT_TOKENS - history_tokens, Config.MAX_INPUT_TOKENS // 2)
+    question, question_tokens = _estimator.trim(prompt, prompt_budget)
+
+    prompt, context_tokens = question, 0
+    augmented = augment(question) if augment is not None else question
+    if augmented != question and augmented.endswith(question):
+        context_budget = prompt_budget - question_tokens
+        if context_budget > 0:
+            context, context_tokens = _estimator.trim(augmented[:-len(question)], context_budget)
+            prompt = context + question
+
+    input_tokens = question_tokens + context_tokens + history_tokens
+    if max_output_tokens is None:
+        max_output_tokens = _estimator.size_output(question, input_tokens)
+    return prompt, input_tokens, max_output_tokens
@@ -5,14 +5,21 @@
 """
 
 import os
-import json
 import hmac
 import hashlib
 import base64
+import mmap
+import time
 import logging
+import threading
+import multiprocessing
 from typing import Dict, Any, Optional, List
 
-import requests
+from config import Config
+from deadline import send_timeout
+from http_pool import get_session
+from json_codec import dumps, loads
+from message_segmenter import send_in_segments
 
 logger = logging.getLogger(__name__)
 
@@ -51,7 +58,9 @@ def send_dingtalk_message(
     message: str, 
     at_mobiles: Optional[List[str]] = None, 
     at_userids: Optional[List[str]] = None,
-    is_at_all: bool = False
+    is_at_all: bool = False,
+    msgtype: str = "text",
+    title: str = "AI助手回复"
 ) -> bool:
     """
     发送消息到钉钉群
@@ -62,17 +71,28 @@ def send_dingtalk_message(
         at_mobiles: @手机号列表
         at_userids: @用户ID列表
         is_at_all: 是否@所有人
+        msgtype: 消息类型，text 或 markdown
+        title: markdown 消息的会话列表标题
         
     Returns:
         bool: 发送是否成功
     """
     try:
-        data = {
-            "msgtype": "text",
-            "text": {
-                "content": message
+        if msgtype == "markdown":
+            data = {
+                "msgtype": "markdown",
+                "markdown": {
+                    "title": title,
+                    "text": message
+                }
+            }
+        else:
+            data = {
+                "msgtype": "text",
+                "text": {
+                    "content": message
+                }
             }
-        }
         
         # 添加@功能
         if at_mobiles or at_userids or is_at_all:
@@ -86,26 +106,54 @@ def send_dingtalk_message(
             "Content-Type": "application/json"
         }
         
-        response = requests.post(
+        response = get_session().post(
             webhook_url, 
-            json=data, 
+            data=dumps(data), 
             headers=headers, 
-            timeout=10
+            timeout=send_timeout()
         )
         response.raise_for_status()
         
-        result = response.json()
+        result = loads(response.content)
         if result.get("errcode") == 0:
             logger.info("消息发送成功")
             return True
         else:
-            logger.error(f"消息发送失败: {result}")
+            logger.error("消息发送失败: %s", result)
             return False
             
     except Exception as e:
-        logger.error(f"发送钉钉消息失败: {e}")
+        logger.error("发送钉钉消息失败: %s", e)
         return False
 
+def send_long_dingtalk_message(
+    webhook_url: str, 
+    message: str, 
+    at_userids: Optional[List[str]] = None,
+    max_bytes: Optional[int] = None
+) -> bool:
+    """
+    发送可能超过单条消息长度限制的回复，按段落/句子边界分段依次发送
+    
+    Args:
+        webhook_url: 钉钉webhook URL
+        message: 消息内容
+        at_userids: @用户ID列表，只在第一段中@
+        max_bytes: 每段最大字节数，默认读取 DINGTALK_MAX_MESSAGE_BYTES
+        
+    Returns:
+        bool: 所有分段是否都发送成功
+    """
+    def send_segment(segment: str, msgtype: str, index: int) -> bool:
+        return send_dingtalk_message(
+            webhook_url, 
+            segment, 
+            at_userids=at_userids if index == 0 else None,
+            msgtype=msgtype
+        )
+    
+    return send_in_segments(message, send_segment, max_bytes or Config.DINGTALK_MAX_MESSAGE_BYTES, at_userids)
+
 def parse_at_users(content: str) -> str:
     """
     解析并清理@用户的文本
@@ -155,17 +203,21 @@ def validate_webhook_data(data: Dict[str, Any]) -> tuple[bool, str]:
         return False, "数据格式不正确"
     
     msg_type = data.get('msgtype')
-    if msg_type != 'text':
+    if msg_type == 'text':
+        text_data = data.get('text', {})
+        if not isinstance(text_data, dict):
+            return False, "文本数据格式不正确"
+        
+        content = text_data.get('content', '').strip()
+        if not content:
+            return False, "消息内容为空"
+    elif msg_type in ('picture', 'file', 'richText'):
+        # 图片和文件的内容需要通过 downloadCode 下载，见 media.py
+        if not isinstance(data.get('content'), dict):
+            return False, "消息内容格式不正确"
+    else:
         return False, f"不支持的消息类型: {msg_type}"
     
-    text_data = data.get('text', {})
-    if not isinstance(text_data, dict):
-        return False, "文本数据格式不正确"
-    
-    content = text_data.get('content', '').strip()
-    if not content:
-        return False, "消息内容为空"
-    
     webhook_url = data.get('sessionWebhook', '')
     if not webhook_url:
         return False, "缺少webhook URL"
@@ -186,4 +238,107 @@ def truncate_text(text: str, max_length: int = 2000) -> str:
     if len(text) <= max_length:
         return text
     
-    return text[:max_length-3] + "..."
\ No newline at end of file
+    return text[:max_length-3] + "..."
+
+class TokenBucket:
+    """令牌桶限速器，线程安全"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        初始化限速器
+        
+        Args:
+            rate: 每秒补充的令牌数
+            capacity: 桶容量（允许的突发量），默认等于 rate 且不小于1
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+    
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """
+        尝试立即获取令牌
+        
+        Args:
+            tokens: 需要的令牌数
+            
+        Returns:
+            bool: 是否获取成功
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+    
+    def acquire(self, tokens: float = 1.0, timeout: Optional[float] = None) -> bool:
+        """
+        阻塞等待直到获取令牌
+        
+        Args:
+            tokens: 需要的令牌数
+            timeout: 最长等待时间（秒），None 表示一直等待
+            
+        Returns:
+            bool: 是否获取成功
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate if self.rate > 0 else 1.0
+            
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    令牌桶限速器，令牌数放在匿名共享内存中：在 gunicorn master 中（fork 之前）创建时，
+    各 worker 共用同一个桶，限额不会随 worker 数成倍放大；fork 之后创建则只在本进程内有效
+    """
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        初始化限速器
+        
+        Args:
+            rate: 每秒补充的令牌数（所有进程合计）
+            capacity: 桶容量（允许的突发量），默认等于 rate 且不小于1
+        """
+        # [令牌数, 上次补充时间]；time.monotonic 在同一台机器的各进程间可以直接比较
+        self._shared = mmap.mmap(-1, 2 * 8)
+        self._state = memoryview(self._shared).cast('d')
+        super().__init__(rate, capacity)
+        self._lock = multiprocessing.Lock()
+    
+    @property
+    def _tokens(self) -> float:
+        return self._state[0]
+    
+    @_tokens.setter
+    def _tokens(self, value: float):
+        self._state[0] = value
+    
+    @property
+    def _updated_at(self) -> float:
+        return self._state[1]
+    
+    @_updated_at.setter
+    def _updated_at(self, value: float):
+        self._state[1] = value
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Worker 预热模块
+在 gunicorn worker 开始接收请求前完成 DNS 解析、连接池建立、访问令牌获取和可选的预热请求
+"""
+
+import time
+import socket
+import logging
+from typing import Dict, Any, List, Tuple, Callable, Optional
+
+from config import Config
+from http_pool import open_connections
+from startup_profile import preload_heavy_modules, profile_phase
+
+logger = logging.getLogger(__name__)
+
+# 应用注册的预热步骤，函数接收 priming 参数
+_warmup_steps: List[Tuple[str, Callable[[bool], Any]]] = []
+
+
+def register_warmup_step(name: str, func: Callable[[bool], Any]):
+    """
+    注册预热步骤，例如初始化AI客户端并获取访问令牌
+
+    Args:
+        name: 步骤名称
+        func: 预热函数，参数为是否发送预热请求
+    """
+    if any(step_name == name for step_name, _ in _warmup_steps):
+        return
+    _warmup_steps.append((name, func))
+
+
+def get_warmup_hosts() -> List[str]:
+    """获取需要预热的上游主机列表"""
+    return [
+        'oapi.dingtalk.com',
+        'oauth2.googleapis.com',
+        f'{Config.GCP_LOCATION}-aiplatform.googleapis.com',
+    ]
+
+
+def resolve_hosts(hosts: List[str]) -> Dict[str, Optional[float]]:
+    """
+    解析主机名，预热系统 DNS 缓存
+
+    Args:
+        hosts: 主机名列表
+
+    Returns:
+        dict: 各主机解析耗时（秒），失败为 None
+    """
+    results = {}
+    for host in hosts:
+        start_time = time.time()
+        try:
+            socket.getaddrinfo(host, 443, type=socket.SOCK_STREAM)
+            results[host] = time.time() - start_time
+        except OSError as e:
+            logger.warning(f"解析 {host} 失败: {e}")
+            results[host] = None
+    return results
+
+
+def run_worker_warmup(priming: Optional[bool] = None) -> Dict[str, Any]:
+    """
+    执行 worker 预热，任何步骤失败都只记录日志，不阻止 worker 启动
+
+    Args:
+        priming: 是否发送预热请求，默认读取 WARMUP_PRIMING 配置
+
+    Returns:
+        dict: 各步骤的结果和耗时
+    """
+    if not Config.WARMUP_ENABLED:
+        return {"enabled": False}
+
+    if priming is None:
+        priming = Config.WARMUP_PRIMING
+
+    start_time = time.time()
+    hosts = get_warmup_hosts()
+    report: Dict[str, Any] = {"enabled": True, "priming": priming}
+
+    try:
+        report["modules"] = preload_heavy_modules()
+
+        with profile_phase('warmup.resolve_hosts'):
+            report["dns"] = resolve_hosts(hosts)
+
+        with profile_phase('warmup.open_connections'):
+            report["connections"] = open_connections(hosts, timeout=Config.WARMUP_TIMEOUT)
+
+        for name, func in _warmup_steps:
+            with profile_phase(f'warmup.{name}'):
+                try:
+                    report[name] = func(priming)
+                except Exception as e:
+                    logger.warning(f"预热步骤 {name} 失败: {e}")
+                    report[name] = False
+    except Exception as e:
+        logger.error(f"Worker 预热失败: {e}")
+
+    report["elapsed"] = round(time.time() - start_time, 3)
+    logger.info(f"Worker 预热完成，耗时: {report['elapsed']:.2f}秒")
+    return report